@@ -0,0 +1,155 @@
+import http.server
+import json
+import random
+import threading
+import time
+import uuid
+
+# First path segment of each stand-in destination. S3 requests arrive as /<bucket>/<key> and are matched by bucket.
+route_names = ("rdio", "openmhz", "broadcastify", "player", "transcribe", "detect")
+
+
+class MockDestinationServer:
+    """
+    Local stand-in for every HTTP destination the uploader sends to, on one port.
+
+    Each route answers the way the real service does, after latency_ms plus up to jitter_ms of delay, and fails with
+    a 503 for error_rate of its requests. Both can be set per route through route_settings. Requests, failures and
+    bytes received are counted per route.
+
+    Routes, relative to url:
+        POST /rdio, POST /openmhz/<short_name>/upload, POST /broadcastify then PUT /broadcastify/audio/<id>,
+        POST /player, PATCH /player/<id>, POST /transcribe, POST /transcribe/batch, POST /detect, PUT /<bucket>/<key>
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency_ms=0, jitter_ms=0, error_rate=0.0, route_settings=None,
+                 s3_bucket="benchmark"):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.route_settings = route_settings or {}
+        self.s3_bucket = s3_bucket
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer((host, port), _MockHandler)
+        self._server.daemon_threads = True
+        self._server.mock = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-destinations", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self):
+        """Dict of route to its requests, errors and bytes received."""
+        with self._stats_lock:
+            return {route: dict(route_stats) for route, route_stats in self._stats.items()}
+
+    def route_setting(self, route, key):
+        return self.route_settings.get(route, {}).get(key, getattr(self, key))
+
+    def count(self, route, body_size, failed):
+        with self._stats_lock:
+            route_stats = self._stats.setdefault(route, {"requests": 0, "errors": 0, "bytes": 0})
+            route_stats["requests"] += 1
+            route_stats["errors"] += int(failed)
+            route_stats["bytes"] += body_size
+
+
+class _MockHandler(http.server.BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections alive like the real services, and answers Expect: 100-continue for boto3.
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self._handle()
+
+    def do_PUT(self):
+        self._handle()
+
+    def do_PATCH(self):
+        self._handle()
+
+    def _handle(self):
+        mock = self.server.mock
+        body = self._read_body()
+        path = self.path.split("?")[0]
+        route = path.strip("/").split("/")[0]
+        if route == mock.s3_bucket:
+            route = "s3"
+        elif route not in route_names:
+            mock.count("unknown", len(body), True)
+            self._reply(404, b"not found")
+            return
+
+        if route == "broadcastify" and self.command == "PUT":
+            route = "broadcastify_audio"
+        elif route == "transcribe" and path.rstrip("/").endswith("/batch"):
+            route = "transcribe_batch"
+        elif route == "player" and self.command == "PATCH":
+            route = "player_update"
+
+        delay = mock.route_setting(route, "latency_ms") + random.uniform(0, mock.route_setting(route, "jitter_ms"))
+        if delay:
+            time.sleep(delay / 1000)
+
+        failed = random.random() < mock.route_setting(route, "error_rate")
+        mock.count(route, len(body), failed)
+        if failed:
+            self._reply(503, b"injected failure")
+            return
+
+        if route == "broadcastify":
+            self._reply(200, f"0 {mock.url}/broadcastify/audio/{uuid.uuid4().hex}".encode("utf-8"), "text/plain")
+        elif route == "transcribe":
+            self._reply_json(_transcript())
+        elif route == "transcribe_batch":
+            self._reply_json([_transcript() for _ in range(body.count(b'name="jsonFiles"'))])
+        elif route == "s3":
+            self._reply(200, b"", headers={"ETag": f'"{uuid.uuid4().hex}"'})
+        elif route == "player" and self.command == "POST":
+            self._reply_json({"success": True, "id": uuid.uuid4().hex})
+        else:
+            self._reply_json({"success": True})
+
+    def _read_body(self):
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            chunks = []
+            while True:
+                chunk_size = int(self.rfile.readline().split(b";")[0].strip() or b"0", 16)
+                if not chunk_size:
+                    # Trailers, such as the checksum boto3 sends after the body, end with a blank line.
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    return b"".join(chunks)
+                chunks.append(self.rfile.read(chunk_size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _reply_json(self, payload):
+        self._reply(200, json.dumps(payload).encode("utf-8"), "application/json")
+
+    def _reply(self, status, body, content_type="text/plain", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _transcript():
+    return {"transcript": "benchmark call", "segments": [{"start": 0.0, "end": 1.0, "text": "benchmark call"}]}
@@ -0,0 +1,290 @@
+"""
+Measures the uploader's throughput against local stand-ins for every destination.
+
+Synthetic trunk-recorder calls are run through process_call_job on a thread pool the same way the daemon runs them,
+with RDIO, OpenMHZ, Broadcastify Calls, iCAD Player, iCAD Transcribe and the legacy tone detector served by a local
+mock HTTP server and archives written to a local directory, a mock S3 endpoint or a local SFTP server.
+
+Run from the repository root:
+
+    python -m benchmark.run_benchmark --calls 200 --concurrency 8 --archive scp --latency-ms 50
+"""
+import argparse
+import copy
+import json
+import os
+import resource
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark.mock_servers import MockDestinationServer
+from benchmark.sftp_server import MockSFTPServer
+from benchmark.synthetic_calls import generate_calls
+from lib.call_processor import process_call_job
+from lib.config_handler import default_config, validate_config, freeze_config
+from lib.logging_handler import CustomLogger
+from lib.metrics_handler import add_stage_listener, remove_stage_listener
+from lib.tone_detect_handler import start_tone_detect_pool, stop_tone_detect_pool
+from lib.transcribe_handler import stop_transcribe_batchers
+
+system_short_name = "benchmark"
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the uploader against local stand-in destinations.")
+    parser.add_argument("--calls", type=int, default=100, help="Synthetic calls to process.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Calls processed at once.")
+    parser.add_argument("--archive", choices=("none", "local", "aws_s3", "scp"), default="local",
+                        help="Archive backend, S3 and SCP go to local stand-ins.")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Delay of every mock HTTP response.")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="Random extra delay of up to this much.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of mock HTTP requests failing with 503.")
+    parser.add_argument("--route", action="append", default=[], metavar="ROUTE:KEY=VALUE",
+                        help="Per route latency_ms, jitter_ms or error_rate, e.g. transcribe:latency_ms=800.")
+    parser.add_argument("--no-tones", action="store_true", help="Turn tone detection off.")
+    parser.add_argument("--tone-pool", action="store_true", help="Detect tones on the process pool.")
+    parser.add_argument("--prefilter", action="store_true", help="Screen calls with the tone prefilter.")
+    parser.add_argument("--no-transcribe", action="store_true", help="Turn transcription off.")
+    parser.add_argument("--transcribe-async", action="store_true", help="Transcribe next to the uploads.")
+    parser.add_argument("--transcribe-batch", action="store_true", help="Batch transcription requests.")
+    parser.add_argument("--result-cache", action="store_true", help="Reuse tones and transcripts of repeated audio.")
+    parser.add_argument("--spool", action="store_true", help="Spool failed deliveries.")
+    parser.add_argument("--breaker", action="store_true", help="Guard each destination with a circuit breaker.")
+    parser.add_argument("--async-engine", action="store_true", help="Upload from the asyncio engine, needs aiohttp.")
+    parser.add_argument("--temp-path", default="/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+                        help="Where the uploader's temp files go, peak usage is measured here.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic calls.")
+    parser.add_argument("--log-level", type=int, default=4, help="Uploader log level, 1 debug to 5 critical.")
+    parser.add_argument("--json", dest="json_path", help="Also write the results to this JSON file.")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated calls and archive.")
+    return parser.parse_args()
+
+
+def parse_route_settings(route_arguments):
+    route_settings = {}
+    for route_argument in route_arguments:
+        route, _, setting = route_argument.partition(":")
+        key, _, value = setting.partition("=")
+        if key not in ("latency_ms", "jitter_ms", "error_rate"):
+            raise SystemExit(f"Unknown route setting {route_argument}")
+        route_settings.setdefault(route, {})[key] = float(value)
+    return route_settings
+
+
+def build_config(args, mock_url, work_path, temp_file_path, sftp_server=None):
+    """Builds a config from the defaults with every destination of one system pointed at the stand-ins."""
+    config_data = copy.deepcopy(default_config)
+    config_data["log_level"] = args.log_level
+    config_data["temp_file_path"] = temp_file_path
+    # Copied, so the same synthetic calls can be processed again.
+    config_data["ingest_mode"] = "copy"
+    config_data["http"]["pool_maxsize"] = max(10, args.concurrency * 2)
+    config_data["http"]["async_engine"] = int(args.async_engine)
+    config_data["circuit_breaker"]["enabled"] = int(args.breaker)
+    config_data["tone_detect_pool"]["enabled"] = int(args.tone_pool)
+    config_data["result_cache"]["enabled"] = int(args.result_cache)
+    config_data["retry_spool"].update(enabled=int(args.spool), spool_path=os.path.join(work_path, "spool"))
+
+    system_config = config_data["systems"].pop("example-system")
+    config_data["systems"] = {system_short_name: system_config}
+
+    archive_config = system_config["archive"]
+    archive_config.update(enabled=int(args.archive != "none"),
+                          archive_type="local" if args.archive == "none" else args.archive,
+                          archive_path=os.path.join(work_path, "archive"), archive_days=1)
+    archive_config["local"]["base_url"] = "http://archive.benchmark/audio"
+    archive_config["aws_s3"].update(access_key_id="benchmark", secret_access_key="benchmark", bucket_name="benchmark",
+                                    region="us-east-1", endpoint_url=mock_url)
+    if sftp_server:
+        archive_config.update(archive_path="/archive")
+        archive_config["scp"].update(host=sftp_server.host, port=sftp_server.port, user="benchmark",
+                                     password="benchmark", max_connections=args.concurrency)
+
+    system_config["audio_compression"]["enabled"] = 1
+    system_config["audio_analysis"]["enabled"] = 1
+    system_config["icad_tone_detect_legacy"][0].update(icad_url=f"{mock_url}/detect")
+    system_config["tone_detection"]["enabled"] = int(not args.no_tones)
+    system_config["tone_detection"]["prefilter"]["enabled"] = int(args.prefilter)
+    system_config["transcribe"].update(enabled=int(not args.no_transcribe), api_url=f"{mock_url}/transcribe",
+                                       **{"async": int(args.transcribe_async)})
+    system_config["transcribe"]["batch"].update(enabled=int(args.transcribe_batch),
+                                                batch_api_url=f"{mock_url}/transcribe/batch")
+    system_config["openmhz"].update(enabled=1, short_name=system_short_name, api_url=f"{mock_url}/openmhz")
+    system_config["broadcastify_calls"].update(enabled=1, system_id=1, api_key="benchmark",
+                                               api_url=f"{mock_url}/broadcastify")
+    system_config["icad_player"].update(enabled=1, api_url=f"{mock_url}/player",
+                                        update_api_url=f"{mock_url}/player/update")
+    system_config["rdio_systems"][0].update(enabled=1, rdio_url=f"{mock_url}/rdio")
+
+    errors = validate_config(config_data)
+    if errors:
+        raise SystemExit("Benchmark config is invalid:\n" + "\n".join(errors))
+    return freeze_config(config_data)
+
+
+class StageTimings:
+    """Collects every stage span's duration, keyed by stage and destination."""
+
+    def __init__(self):
+        self.durations = {}
+        self.failures = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, labels, seconds, failed):
+        stage = labels["stage"] + (f":{labels['destination']}" if labels.get("destination") else "")
+        with self._lock:
+            self.durations.setdefault(stage, []).append(seconds)
+            self.failures[stage] = self.failures.get(stage, 0) + int(failed)
+
+    def summary(self):
+        with self._lock:
+            return {stage: {"count": len(durations), "failed": self.failures[stage],
+                            "p50": percentile(durations, 50), "p95": percentile(durations, 95),
+                            "p99": percentile(durations, 99), "max": max(durations)}
+                    for stage, durations in sorted(self.durations.items())}
+
+
+class UsageSampler:
+    """Polls the bytes in the uploader's temp directory and used on /dev/shm, keeping the peaks."""
+
+    def __init__(self, temp_file_path, interval=0.05):
+        self.temp_file_path = temp_file_path
+        self.interval = interval
+        self.peak_temp_bytes = 0
+        self.peak_shm_bytes = 0
+        self._shm_baseline = self._shm_used()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="usage-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak_temp_bytes = max(self.peak_temp_bytes, _directory_size(self.temp_file_path))
+            self.peak_shm_bytes = max(self.peak_shm_bytes, self._shm_used() - self._shm_baseline)
+
+    @staticmethod
+    def _shm_used():
+        try:
+            return shutil.disk_usage("/dev/shm").used
+        except OSError:
+            return 0
+
+
+def percentile(values, rank):
+    """Nearest rank percentile of values."""
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(rank / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def run_benchmark(args):
+    work_path = tempfile.mkdtemp(prefix="icad_benchmark_")
+    temp_file_path = tempfile.mkdtemp(prefix="icad_benchmark_", dir=args.temp_path)
+    CustomLogger(args.log_level, "icad_tr_uploader", os.path.join(work_path, "benchmark.log"))
+
+    mock_server = MockDestinationServer(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                                        error_rate=args.error_rate,
+                                        route_settings=parse_route_settings(args.route)).start()
+    sftp_server = MockSFTPServer(os.path.join(work_path, "sftp")).start() if args.archive == "scp" else None
+    config_data = build_config(args, mock_server.url, work_path, temp_file_path, sftp_server)
+
+    print(f"Generating {args.calls} synthetic calls in {work_path}")
+    wav_file_paths = generate_calls(os.path.join(work_path, "calls"), args.calls, system_short_name, seed=args.seed)
+
+    if args.tone_pool:
+        start_tone_detect_pool(config_data["tone_detect_pool"])
+
+    stage_timings = StageTimings()
+    add_stage_listener(stage_timings)
+    usage_sampler = UsageSampler(temp_file_path).start()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(
+            lambda wav_file_path: process_call_job(config_data, system_short_name, wav_file_path,
+                                                   retry_spooled=False, clean_archive=False), wav_file_paths))
+    elapsed = time.perf_counter() - start
+
+    usage_sampler.stop()
+    remove_stage_listener(stage_timings)
+    stop_transcribe_batchers()
+    stop_tone_detect_pool()
+    mock_server.stop()
+    if sftp_server:
+        sftp_server.stop()
+
+    report = {
+        "calls": args.calls,
+        "failed_calls": results.count(False),
+        "concurrency": args.concurrency,
+        "archive": args.archive,
+        "seconds": round(elapsed, 3),
+        "calls_per_second": round(args.calls / elapsed, 3) if elapsed else 0.0,
+        # ru_maxrss is in kilobytes on Linux, children covers the tone detection workers.
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "peak_children_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        "peak_temp_mb": round(usage_sampler.peak_temp_bytes / 1024 / 1024, 2),
+        "peak_shm_mb": round(usage_sampler.peak_shm_bytes / 1024 / 1024, 2),
+        "stages": stage_timings.summary(),
+        "destinations": mock_server.stats(),
+    }
+
+    shutil.rmtree(temp_file_path, ignore_errors=True)
+    if not args.keep:
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    return report
+
+
+def print_report(report):
+    print(f"\n{report['calls']} calls, {report['failed_calls']} failed, concurrency {report['concurrency']}, "
+          f"archive {report['archive']}")
+    print(f"{report['seconds']}s, {report['calls_per_second']} calls/s")
+    print(f"Peak RSS {report['peak_rss_mb']} MB, tone workers {report['peak_children_rss_mb']} MB")
+    print(f"Peak temp files {report['peak_temp_mb']} MB, peak /dev/shm {report['peak_shm_mb']} MB\n")
+
+    print(f"{'stage':<34}{'count':>7}{'failed':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage, timings in report["stages"].items():
+        print(f"{stage:<34}{timings['count']:>7}{timings['failed']:>8}" + "".join(
+            f"{timings[key] * 1000:>10.1f}" for key in ("p50", "p95", "p99", "max")))
+
+    print(f"\n{'destination':<34}{'requests':>9}{'errors':>8}{'MB':>10}")
+    for route, route_stats in sorted(report["destinations"].items()):
+        print(f"{route:<34}{route_stats['requests']:>9}{route_stats['errors']:>8}"
+              f"{route_stats['bytes'] / 1024 / 1024:>10.2f}")
+
+
+def _directory_size(path):
+    size = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    size += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return size
+
+
+def main():
+    args = parse_arguments()
+    report = run_benchmark(args)
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w") as json_file:
+            json.dump(report, json_file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import os
+import socket
+import threading
+
+import paramiko
+
+
+class MockSFTPServer:
+    """
+    Local SFTP stand-in for SCP archives. Any user and password is accepted and every path is served from root_path,
+    so the archive writes land in a temp directory.
+    """
+
+    def __init__(self, root_path, host="127.0.0.1", port=0):
+        self.root_path = os.path.abspath(root_path)
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((host, port))
+        self._socket.listen(16)
+        self._transports = []
+        self._stop_event = threading.Event()
+        os.makedirs(self.root_path, exist_ok=True)
+
+    @property
+    def host(self):
+        return self._socket.getsockname()[0]
+
+    @property
+    def port(self):
+        return self._socket.getsockname()[1]
+
+    def start(self):
+        threading.Thread(target=self._accept_loop, name="mock-sftp", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        self._socket.close()
+        for transport in self._transports:
+            transport.close()
+
+    def _accept_loop(self):
+        while not self._stop_event.is_set():
+            try:
+                client, address = self._socket.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, _RootedSFTPServer, self.root_path)
+            transport.start_server(server=_AcceptAllServer())
+            self._transports.append(transport)
+
+
+class _AcceptAllServer(paramiko.ServerInterface):
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == "session" else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class _SFTPHandle(paramiko.SFTPHandle):
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class _RootedSFTPServer(paramiko.SFTPServerInterface):
+
+    def __init__(self, server, root_path, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root_path = root_path
+
+    def _local_path(self, path):
+        return os.path.join(self.root_path, self.canonicalize(path).lstrip("/"))
+
+    def list_folder(self, path):
+        local_path = self._local_path(path)
+        try:
+            attributes = []
+            for file_name in os.listdir(local_path):
+                attribute = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(local_path, file_name)))
+                attribute.filename = file_name
+                attributes.append(attribute)
+            return attributes
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._local_path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self._local_path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        local_path = self._local_path(path)
+        try:
+            file_descriptor = os.open(local_path, flags | getattr(os, "O_BINARY", 0), 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+
+        handle = _SFTPHandle(flags)
+        handle.filename = local_path
+        handle.readfile = handle.writefile = os.fdopen(file_descriptor, mode)
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._local_path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, old_path, new_path):
+        try:
+            os.rename(self._local_path(old_path), self._local_path(new_path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._local_path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self._local_path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
@@ -0,0 +1,121 @@
+import json
+import os
+import wave
+
+import numpy as np
+
+# Each kind of call the benchmark cycles through, with the range of lengths in seconds it is generated at.
+call_kinds = {
+    "voice": (2.0, 20.0),
+    "two_tone": (5.0, 12.0),
+    "long_tone": (4.0, 10.0),
+    "two_tone_voice": (10.0, 30.0),
+    "silence": (1.0, 4.0),
+}
+
+
+def generate_calls(output_path, call_count, short_name, talkgroups=(100, 200, 300), sample_rate=8000, seed=0):
+    """
+    Writes call_count synthetic trunk-recorder calls, each a 16 bit mono WAV with its JSON metadata next to it.
+
+    The calls cycle through call_kinds so every run sees the same mix of voice, paging tones and silence.
+
+    :return: List of WAV file paths.
+    """
+    os.makedirs(output_path, exist_ok=True)
+    random = np.random.default_rng(seed)
+    kinds = list(call_kinds)
+    start_time = 1700000000
+    wav_file_paths = []
+
+    for index in range(call_count):
+        kind = kinds[index % len(kinds)]
+        low, high = call_kinds[kind]
+        duration = round(float(random.uniform(low, high)), 2)
+        samples = render_call(kind, duration, sample_rate, random)
+
+        talkgroup = talkgroups[index % len(talkgroups)]
+        start_time += int(random.integers(1, 30))
+        base_name = f"{talkgroup}-{start_time}_{index:06d}-call_{index}"
+        wav_file_path = os.path.join(output_path, base_name + ".wav")
+
+        with wave.open(wav_file_path, "wb") as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(sample_rate)
+            wav_file.writeframes(samples.astype("<i2").tobytes())
+
+        with open(os.path.join(output_path, base_name + ".json"), "w") as json_file:
+            json.dump(call_metadata(short_name, talkgroup, start_time, duration, index), json_file)
+
+        wav_file_paths.append(wav_file_path)
+
+    return wav_file_paths
+
+
+def render_call(kind, duration, sample_rate, random):
+    """Returns the int16 samples of one call of the given kind."""
+    sample_count = int(duration * sample_rate)
+    if kind == "silence":
+        return _mix(_noise(sample_count, -60, random))
+
+    if kind == "voice":
+        return _mix(_voice(sample_count, sample_rate, random), _noise(sample_count, -55, random))
+
+    tone_a, tone_b = (float(frequency) for frequency in random.uniform(300, 2500, size=2))
+    if kind == "long_tone":
+        return _mix(_tone(tone_a, sample_count, sample_rate), _noise(sample_count, -55, random))
+
+    # Quick call paging, A for one second then B for three, as tone_detect looks for it.
+    tones = np.concatenate((_tone(tone_a, sample_rate, sample_rate), _tone(tone_b, 3 * sample_rate, sample_rate)))
+    samples = np.zeros(sample_count, dtype=np.float32)
+    samples[:min(sample_count, len(tones))] = tones[:sample_count]
+    if kind == "two_tone_voice" and sample_count > len(tones):
+        samples[len(tones):] = _voice(sample_count - len(tones), sample_rate, random)
+    return _mix(samples, _noise(sample_count, -55, random))
+
+
+def call_metadata(short_name, talkgroup, start_time, duration, index):
+    """Call JSON in the shape trunk-recorder writes next to each recording."""
+    return {
+        "freq": 851012500,
+        "start_time": start_time,
+        "stop_time": start_time + int(duration),
+        "emergency": 0,
+        "encrypted": 0,
+        "call_length": duration,
+        "talkgroup": talkgroup,
+        "talkgroup_tag": f"Benchmark {talkgroup}",
+        "talkgroup_description": f"Benchmark talkgroup {talkgroup}",
+        "talkgroup_group_tag": "Benchmark",
+        "talkgroup_group": "Benchmark",
+        "audio_type": "digital",
+        "short_name": short_name,
+        "freqList": [{"freq": 851012500, "time": start_time, "pos": 0.0, "len": duration, "error_count": 0,
+                      "spike_count": 0}],
+        "srcList": [{"src": 1000 + index % 50, "time": start_time, "pos": 0.0, "emergency": 0, "signal_system": "",
+                     "tag": ""}]
+    }
+
+
+def _tone(frequency, sample_count, sample_rate, level_dbfs=-6):
+    time_index = np.arange(sample_count, dtype=np.float32) / sample_rate
+    return (10 ** (level_dbfs / 20) * np.sin(2 * np.pi * frequency * time_index)).astype(np.float32)
+
+
+def _voice(sample_count, sample_rate, random):
+    # Band limited noise under a syllable rate envelope spreads its energy the way speech does.
+    noise = random.standard_normal(sample_count).astype(np.float32)
+    kernel = np.hanning(9).astype(np.float32)
+    noise = np.convolve(noise, kernel / kernel.sum(), mode="same")
+    time_index = np.arange(sample_count, dtype=np.float32) / sample_rate
+    envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 4 * time_index + float(random.uniform(0, np.pi)))
+    return (0.3 * envelope * noise / max(float(np.max(np.abs(noise))), 1e-6)).astype(np.float32)
+
+
+def _noise(sample_count, level_dbfs, random):
+    return (10 ** (level_dbfs / 20) * random.standard_normal(sample_count)).astype(np.float32)
+
+
+def _mix(*signals):
+    return (np.clip(np.sum(signals, axis=0), -1, 1) * 32767).astype(np.int16)
@@ -1,29 +1,34 @@
+import contextvars
 import logging
 import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-from lib.remote_storage_handler import get_archive_class
+from lib.remote_storage_handler import archive_class_for
 
 module_logger = logging.getLogger('icad_tr_uploader.archive')
 
 
-def archive_files(archive_config, source_path, wav_filename, call_data, system_short_name):
-    wav_url_path = None
-    m4a_url_path = None
-    json_url_path = None
+def archive_files(archive_config, call_audio, call_data, system_short_name, extensions=None):
+    """
+    Uploads the call's files for each of the archive's extensions.
+
+    :param call_audio: CallAudio holding the call's files, each upload streams from its shared buffer.
+    :param extensions: Only upload these of the archive's extensions, e.g. [".json"] to replace the metadata.
+
+    :return: Dict of extension to archived URL, None for an extension that failed to upload.
+    """
+    url_paths = {}
 
     if not archive_config.get("archive_path", "") and archive_config.get('archive_type', '') not in ["google_cloud", "aws_s3"]:
         module_logger.warning("<<Archive>> <<error>> No Archive Path Set")
-        return wav_url_path, m4a_url_path, json_url_path
+        return url_paths
 
     if not archive_config.get('archive_type', '') or archive_config.get('archive_type', '') not in ["google_cloud", "aws_s3", "scp", "local"]:
         module_logger.warning(f"<<Archive>> <<error>> Archive Type Not Set or Invalid. {archive_config.get('archive_type', '')}")
-        return wav_url_path, m4a_url_path, json_url_path
-
-    archive_class = get_archive_class(archive_config)
-    if not archive_class:
-        module_logger.warning(f"<<Archive>> <<error>> Can not start the Archive Class for {archive_config.get('archive_type', '')}")
-        return wav_url_path, m4a_url_path, json_url_path
+        return url_paths
 
     # Convert the epoch timestamp to a datetime object in UTC
     call_date = datetime.utcfromtimestamp(call_data['start_time'])
@@ -34,37 +39,163 @@ def archive_files(archive_config, source_path, wav_filename, call_data, system_s
     # Create folder structure using current date
     folder_path = os.path.join(archive_config.get("archive_path"), generated_folder_path)
 
-    m4a_filename = wav_filename.replace(".wav", ".m4a")
-    json_filename = wav_filename.replace(".wav", ".json")
-
-    source_wav_path = os.path.join(source_path, wav_filename)
-    destination_wav_path = os.path.join(folder_path, wav_filename)
-
-    source_m4a_path = os.path.join(source_path, m4a_filename)
-    destination_m4a_path = os.path.join(folder_path, m4a_filename)
-
-    source_json_path = os.path.join(source_path, json_filename)
-    destination_json_path = os.path.join(folder_path, json_filename)
-
-    module_logger.info(f"Archiving {' '.join(archive_config.get('archive_extensions', []))} files via {archive_config.get('archive_type', '')} to: {folder_path}")
-
-    for extension in archive_config.get('archive_extensions', []):
-        if extension == ".wav":
-            upload_response = archive_class.upload_file(source_wav_path, destination_wav_path, generated_folder_path)
-            if upload_response:
-                wav_url_path = upload_response
-        elif extension == ".m4a":
-            upload_response = archive_class.upload_file(source_m4a_path, destination_m4a_path, generated_folder_path)
-            if upload_response:
-                m4a_url_path = upload_response
-        elif extension == ".json":
-            upload_response = archive_class.upload_file(source_json_path, destination_json_path, generated_folder_path)
-            if upload_response:
-                json_url_path = upload_response
-        else:
-            module_logger.warning("<<Archive>> <<error>> Unknown Archive Extension")
+    archive_extensions = [extension for extension in archive_config.get('archive_extensions', [])
+                          if extensions is None or extension in extensions]
 
-    if archive_config.get("archive_days", 0) >= 1:
-        archive_class.clean_files(os.path.join(archive_config.get("archive_path"), system_short_name), archive_config.get("archive_days", 1))
+    module_logger.info(f"Archiving {' '.join(archive_extensions)} files via {archive_config.get('archive_type', '')} to: {folder_path}")
 
-    return wav_url_path, m4a_url_path, json_url_path
+    # Upload every extension at once so archiving takes about as long as the slowest file.
+    uploads = {}
+    for extension in archive_extensions:
+        if not extension.startswith("."):
+            module_logger.warning("<<Archive>> <<error>> Unknown Archive Extension")
+            continue
+        if not call_audio.has(extension):
+            module_logger.warning(f"<<Archive>> No {extension} file for this call, skipping it")
+            url_paths[extension] = None
+            continue
+        uploads[extension] = os.path.join(folder_path, call_audio.name(extension))
+
+    if not uploads:
+        return url_paths
+
+    with archive_class_for(archive_config) as archive_class:
+        if not archive_class:
+            module_logger.warning(f"<<Archive>> <<error>> Can not start the Archive Class for {archive_config.get('archive_type', '')}")
+            return url_paths
+
+        with ThreadPoolExecutor(max_workers=len(uploads)) as executor:
+            futures = {executor.submit(contextvars.copy_context().run, archive_class.upload_file,
+                                       call_audio.path(extension), destination_file_path, generated_folder_path,
+                                       source_reader=call_audio.reader(extension)): extension
+                       for extension, destination_file_path in uploads.items()}
+            for future, extension in futures.items():
+                try:
+                    url_paths[extension] = future.result() or None
+                except Exception as e:
+                    module_logger.error(f"<<Archive>> <<error>> uploading {extension} file: {e}")
+
+    return url_paths
+
+
+def clean_archive_if_due(archive_config, system_short_name, state_path):
+    """
+    Removes expired date partitions from a system's archive, at most once per cleanup_interval.
+
+    The last run is recorded as a stamp file in state_path and a lock file keeps concurrent uploader processes from
+    sweeping the same system at the same time. The lock holds the PID of the sweeping process, so a lock is only
+    taken over once that process is gone, however long its sweep takes.
+
+    :return: True if a sweep ran.
+    """
+    if archive_config.get("enabled", 0) != 1 or archive_config.get("archive_days", 0) < 1:
+        return False
+
+    cleanup_interval = archive_config.get("cleanup_interval", 3600)
+    stamp_path = os.path.join(state_path, f".archive_sweep_{system_short_name}")
+    lock_path = stamp_path + ".lock"
+
+    if not _sweep_due(stamp_path, cleanup_interval):
+        return False
+
+    lock_token = f"{os.getpid()} {uuid.uuid4().hex}"
+    try:
+        os.makedirs(state_path, exist_ok=True)
+        lock_fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        _remove_stale_lock(lock_path, cleanup_interval)
+        return False
+    except OSError as e:
+        module_logger.warning(f"<<Archive>> <<cleanup>> could not take its lock {lock_path}: {e}")
+        return False
+
+    try:
+        os.write(lock_fd, lock_token.encode())
+    except OSError as e:
+        module_logger.warning(f"<<Archive>> <<cleanup>> could not write its lock {lock_path}: {e}")
+    finally:
+        os.close(lock_fd)
+
+    try:
+        # Another process may have finished a sweep between the first check and taking the lock.
+        if not _sweep_due(stamp_path, cleanup_interval):
+            return False
+
+        with archive_class_for(archive_config) as archive_class:
+            if not archive_class:
+                module_logger.warning(f"<<Archive>> <<cleanup>> can not start the Archive Class for {archive_config.get('archive_type', '')}")
+                return False
+
+            module_logger.info(f"<<Archive>> <<cleanup>> removing files older than {archive_config.get('archive_days')} days for {system_short_name}")
+            archive_class.clean_files(os.path.join(archive_config.get("archive_path", ""), system_short_name),
+                                      archive_config.get("archive_days", 1))
+
+        with open(stamp_path, "w") as stamp_file:
+            stamp_file.write(str(time.time()))
+        return True
+    except Exception as e:
+        module_logger.error(f"<<Archive>> <<cleanup>> <<failed>> for {system_short_name}: {e}")
+        return False
+    finally:
+        # The lock is only removed while it is still ours.
+        if _read_lock(lock_path) == lock_token:
+            try:
+                os.remove(lock_path)
+            except OSError as e:
+                module_logger.warning(f"<<Archive>> <<cleanup>> could not remove its lock {lock_path}: {e}")
+
+
+def _sweep_due(stamp_path, cleanup_interval):
+    try:
+        return time.time() - os.path.getmtime(stamp_path) >= cleanup_interval
+    except FileNotFoundError:
+        return True
+    except OSError as e:
+        module_logger.warning(f"<<Archive>> <<cleanup>> could not read its stamp {stamp_path}: {e}")
+        return False
+
+
+def _read_lock(lock_path):
+    try:
+        with open(lock_path, "r") as lock_file:
+            return lock_file.read()
+    except OSError:
+        return None
+
+
+def _remove_stale_lock(lock_path, cleanup_interval):
+    """Removes a lock left behind by a process that died mid sweep, the lock may be released at any moment."""
+    lock_token = _read_lock(lock_path)
+    if lock_token is None:
+        return
+
+    try:
+        lock_pid = int(lock_token.split(" ", 1)[0])
+    except ValueError:
+        lock_pid = None
+
+    if lock_pid is not None:
+        try:
+            os.kill(lock_pid, 0)
+            return
+        except ProcessLookupError:
+            pass
+        except OSError:
+            # The process exists but belongs to another user.
+            return
+    else:
+        # A lock without a PID is from a process that died before writing it, give it the interval to be sure.
+        try:
+            if time.time() - os.path.getmtime(lock_path) <= cleanup_interval:
+                return
+        except OSError:
+            return
+
+    # Only the lock that was read is removed, not one another process took since.
+    if _read_lock(lock_path) != lock_token:
+        return
+    try:
+        os.remove(lock_path)
+        module_logger.warning(f"<<Archive>> <<cleanup>> removed a stale lock {lock_path}")
+    except OSError:
+        pass
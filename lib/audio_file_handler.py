@@ -1,54 +1,101 @@
+import errno
 import json
 import logging
 import os
 import shutil
 import subprocess
+import time
+from contextlib import nullcontext
+from fractions import Fraction
+
+try:
+    import av
+except ImportError:
+    av = None
 
 module_logger = logging.getLogger('icad_tr_uploader.audio_file_handler')
 
+rendition_formats = {
+    ".m4a": {"codec": "aac", "container": "ipod"},
+    ".opus": {"codec": "libopus", "container": "ogg"},
+    ".mp3": {"codec": "libmp3lame", "container": "mp3"}
+}
 
-def save_temporary_json_file(tmp_path, json_file_path):
-    try:
-        # Ensure the directory exists
-        os.makedirs(tmp_path, exist_ok=True)
 
-        # Construct the target path for the WAV file
-        json_path = os.path.join(tmp_path, os.path.basename(json_file_path))
+def ingest_file(ingest_mode, source_file_path, tmp_path):
+    """
+    Makes a trunk-recorder file available to the uploader without copying it where possible.
+
+    auto hardlinks the file into tmp_path, move renames it there, copy always copies it and in_place leaves it where
+    it is. A hardlink or rename that fails because tmp_path is on another filesystem falls back to a copy.
+
+    :return: Path the uploader should read the file from.
+    """
+    if ingest_mode == "in_place":
+        if not os.path.isfile(source_file_path):
+            raise FileNotFoundError(f"{source_file_path} does not exist")
+        return source_file_path
+
+    # Ensure the directory exists
+    os.makedirs(tmp_path, exist_ok=True)
+
+    # Construct the target path for the file
+    target_file_path = os.path.join(tmp_path, os.path.basename(source_file_path))
+    if os.path.abspath(target_file_path) == os.path.abspath(source_file_path):
+        return source_file_path
 
-        # Copy the WAV file to the target path
-        shutil.copy(json_file_path, json_path)
+    if ingest_mode in ("auto", "move"):
+        # A leftover from an earlier run of the same call would make os.link fail.
+        if os.path.lexists(target_file_path):
+            os.remove(target_file_path)
+        try:
+            if ingest_mode == "move":
+                os.rename(source_file_path, target_file_path)
+            else:
+                os.link(source_file_path, target_file_path)
+            return target_file_path
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            module_logger.debug(f"Can not {ingest_mode} {source_file_path} into {tmp_path}, copying it: {e}")
 
-        module_logger.debug(f"<<JSON>> <<file>> saved successfully at {json_path}")
+    if ingest_mode == "move":
+        shutil.move(source_file_path, target_file_path)
+    else:
+        shutil.copy(source_file_path, target_file_path)
+    return target_file_path
+
+
+def save_temporary_json_file(tmp_path, json_file_path, ingest_mode="copy"):
+    try:
+        json_path = ingest_file(ingest_mode, json_file_path, tmp_path)
+        module_logger.debug(f"<<JSON>> <<file>> ready at {json_path}")
+        return json_path
     except Exception as e:
-        module_logger.error(f"Failed to save <<JSON>> <<file>> at {json_path}: {e}")
+        module_logger.error(f"Failed to save <<JSON>> <<file>> {json_file_path} to {tmp_path}: {e}")
         raise
 
 
 def save_call_data(json_file_path, call_data):
     try:
-        # Writing call data to JSON file
-        with open(json_file_path, "w") as json_file:
+        # Write a new file and swap it in, the JSON may be a hardlink to trunk-recorder's own file which must not be
+        # changed, and readers never see a half written file.
+        with open(json_file_path + ".tmp", "w") as json_file:
             json.dump(call_data, json_file, indent=4)
+        os.replace(json_file_path + ".tmp", json_file_path)
         module_logger.debug(f"JSON file saved successfully at {json_file_path}")
     except Exception as e:
         module_logger.error(f"Failed to save JSON file at {json_file_path}: {e}")
         raise  # Re-raise the exception to handle it in a higher-level function
 
 
-def save_temporary_wav_file(tmp_path, wav_file_path):
+def save_temporary_wav_file(tmp_path, wav_file_path, ingest_mode="copy"):
     try:
-        # Ensure the directory exists
-        os.makedirs(tmp_path, exist_ok=True)
-
-        # Construct the target path for the WAV file
-        wav_path = os.path.join(tmp_path, os.path.basename(wav_file_path))
-
-        # Copy the WAV file to the target path
-        shutil.copy(wav_file_path, wav_path)
-
-        module_logger.debug(f"<<WAV>> <<file>> saved successfully at {wav_path}")
+        wav_path = ingest_file(ingest_mode, wav_file_path, tmp_path)
+        module_logger.debug(f"<<WAV>> <<file>> ready at {wav_path}")
+        return wav_path
     except Exception as e:
-        module_logger.error(f"Failed to save <<WAV>> <<file>> at {wav_path}: {e}")
+        module_logger.error(f"Failed to save <<WAV>> <<file>> {wav_file_path} to {tmp_path}: {e}")
         raise
 
 
@@ -70,62 +117,214 @@ def load_call_json(json_file_path):
         return None
 
 
-def save_temporary_files(tmp_path, wav_file_path):
+def save_temporary_files(tmp_path, wav_file_path, ingest_mode="copy"):
+    """
+    Brings a call's WAV and JSON into tmp_path using ingest_mode, see ingest_file.
+
+    :return: Tuple of (WAV path, JSON path) to read the call from, None if the files could not be ingested.
+    """
     try:
-        save_temporary_wav_file(tmp_path, wav_file_path)
-        save_temporary_json_file(tmp_path, wav_file_path.replace(".wav", ".json"))
-        module_logger.info(f"<<Temporary>> <<Files>> Saved to {tmp_path}")
-        return True
+        wav_path = save_temporary_wav_file(tmp_path, wav_file_path, ingest_mode)
+        json_path = save_temporary_json_file(tmp_path, wav_file_path.replace(".wav", ".json"), ingest_mode)
+        module_logger.info(f"<<Temporary>> <<Files>> ingested to {tmp_path} with mode {ingest_mode}")
+        return wav_path, json_path
     except OSError as e:
         if e.errno == 28:
             module_logger.error(
                 f"<<Failed>> to write temp files to {tmp_path}. <<No>> <<space>> <<left>> on device to write files")
         else:
             module_logger.error(f"<<Failed>> to write files to {tmp_path}. <<OS>> <<error>> occurred: {e}")
-        return False
+        return None
     except Exception as e:
         module_logger.error(
             f"An <<unexpected>> <<error>> occurred while <<writing>> <<temporary>> <<files>> to {tmp_path}: {e}")
-        return False
+        return None
+
+
+def clean_temp_files(*file_paths):
+    for file_path in file_paths:
+        if os.path.isfile(file_path):
+            os.remove(file_path)
+
+
+def is_temporary_file(file_path, tmp_path):
+    """True if file_path lives in tmp_path, files anywhere else belong to trunk-recorder and are never removed."""
+    return os.path.dirname(os.path.abspath(file_path)) == os.path.abspath(tmp_path)
+
+
+def get_renditions(compression_config, wav_file_path, output_path=None):
+    """
+    Builds the list of renditions to encode for a call. The M4A is always first, any extra renditions configured
+    under renditions follow it.
 
+    Renditions are written to output_path, next to the WAV when it is None.
+    """
+    output_file_path = os.path.join(output_path or os.path.dirname(wav_file_path), os.path.basename(wav_file_path))
+    renditions = [{
+        "extension": ".m4a",
+        "codec": rendition_formats[".m4a"]["codec"],
+        "sample_rate": compression_config.get("sample_rate", 16000),
+        "bitrate": compression_config.get("bitrate", 96),
+        "path": output_file_path.replace(".wav", ".m4a")
+    }]
 
-def clean_temp_files(wav_file_path, m4a_file_path, json_file_path):
-    if os.path.isfile(wav_file_path):
-        os.remove(wav_file_path)
+    for rendition in compression_config.get("renditions", []):
+        extension = rendition.get("extension", "")
+        if extension not in rendition_formats or extension in [r["extension"] for r in renditions]:
+            module_logger.warning(f"Skipping unsupported or duplicate audio rendition {extension}")
+            continue
 
-    if os.path.isfile(m4a_file_path):
-        os.remove(m4a_file_path)
+        renditions.append({
+            "extension": extension,
+            "codec": rendition.get("codec") or rendition_formats[extension]["codec"],
+            "sample_rate": rendition.get("sample_rate", compression_config.get("sample_rate", 16000)),
+            "bitrate": rendition.get("bitrate", compression_config.get("bitrate", 96)),
+            "path": output_file_path.replace(".wav", extension)
+        })
 
-    if os.path.isfile(json_file_path):
-        os.remove(json_file_path)
+    return renditions
 
 
-def compress_wav(compression_config, wav_file_path):
+def transcode_wav(compression_config, wav_file_path, output_path=None, decoded_audio=None):
+    """
+    Encodes every configured rendition of a WAV file from a single decode of the source.
+
+    PyAV encodes in process when it is installed, so no encoder process is spawned per call. Without it a single
+    ffmpeg process writes all renditions from one decode pass.
+
+    :param output_path: Directory the renditions are written to, next to the WAV when None.
+    :param decoded_audio: The call's DecodedAudio. When given the encoders are fed its samples and the WAV is not
+        decoded again.
+    :return: Dict of extension to {"path", "size", "encode_time"} for each rendition that was written.
+    """
     # Check if the WAV file exists
     if not os.path.isfile(wav_file_path):
         module_logger.error(f"WAV file does not exist: {wav_file_path}")
-        return False
+        return {}
+
+    renditions = get_renditions(compression_config, wav_file_path, output_path)
+
+    rendition_names = ", ".join(f"{rendition['extension']} {rendition['sample_rate']}@{rendition['bitrate']}"
+                                for rendition in renditions)
+    module_logger.info(f'Converting WAV to {rendition_names}')
+
+    backend = compression_config.get("backend", "auto")
+    if backend == "pyav" or (backend == "auto" and av is not None):
+        if av is None:
+            module_logger.warning("PyAV is not installed, falling back to ffmpeg")
+        else:
+            try:
+                return _transcode_with_pyav(wav_file_path, renditions, decoded_audio)
+            except Exception as e:
+                module_logger.warning(f"PyAV transcode failed for {wav_file_path}, falling back to ffmpeg: {e}")
 
-    module_logger.info(
-        f'Converting WAV to M4A at {compression_config.get("sample_rate")}@{compression_config.get("bitrate", 96)}')
+    return _transcode_with_ffmpeg(wav_file_path, renditions, decoded_audio)
 
-    # Construct the ffmpeg command
-    m4a_file_path = wav_file_path.replace('.wav', '.m4a')
-    command = ["ffmpeg", "-y", "-i", wav_file_path, "-af", "aresample=resampler=soxr", "-ar",
-               f"{compression_config.get('sample_rate', 16000)}", "-c:a", "aac",
-               "-ac", "1", "-b:a", f"{compression_config.get('bitrate', 96)}k", m4a_file_path]
+
+def compress_wav(compression_config, wav_file_path, output_path=None):
+    return ".m4a" in transcode_wav(compression_config, wav_file_path, output_path)
+
+
+def _pcm_frames(decoded_audio, frame_size=4096):
+    for offset in range(0, len(decoded_audio.samples), frame_size):
+        frame = av.AudioFrame.from_ndarray(decoded_audio.samples[offset:offset + frame_size].reshape(1, -1),
+                                           format="s16", layout="mono")
+        frame.sample_rate = decoded_audio.sample_rate
+        frame.time_base = Fraction(1, decoded_audio.sample_rate)
+        frame.pts = offset
+        yield frame
+
+
+def _transcode_with_pyav(wav_file_path, renditions, decoded_audio=None):
+    encoders = []
+    encode_times = {}
+    try:
+        with nullcontext() if decoded_audio else av.open(wav_file_path) as input_container:
+            for rendition in renditions:
+                output_container = av.open(rendition["path"], "w",
+                                           format=rendition_formats[rendition["extension"]]["container"])
+                output_stream = output_container.add_stream(rendition["codec"], rate=rendition["sample_rate"],
+                                                            layout="mono")
+                output_stream.bit_rate = rendition["bitrate"] * 1000
+                resampler = av.AudioResampler(format=output_stream.codec_context.format.name, layout="mono",
+                                              rate=rendition["sample_rate"])
+                encoders.append((rendition, output_container, output_stream, resampler))
+                encode_times[rendition["extension"]] = 0.0
+
+            decode_start = time.perf_counter()
+            decode_time = 0.0
+            input_frames = _pcm_frames(decoded_audio) if decoded_audio else input_container.decode(audio=0)
+            for frame in input_frames:
+                decode_time += time.perf_counter() - decode_start
+                for rendition, output_container, output_stream, resampler in encoders:
+                    encode_start = time.perf_counter()
+                    for resampled_frame in resampler.resample(frame):
+                        for packet in output_stream.encode(resampled_frame):
+                            output_container.mux(packet)
+                    encode_times[rendition["extension"]] += time.perf_counter() - encode_start
+                decode_start = time.perf_counter()
+
+        results = {}
+        for rendition, output_container, output_stream, resampler in encoders:
+            encode_start = time.perf_counter()
+            for resampled_frame in resampler.resample(None):
+                for packet in output_stream.encode(resampled_frame):
+                    output_container.mux(packet)
+            for packet in output_stream.encode(None):
+                output_container.mux(packet)
+            output_container.close()
+            encode_times[rendition["extension"]] += time.perf_counter() - encode_start
+
+            results[rendition["extension"]] = {
+                "path": rendition["path"],
+                "size": os.path.getsize(rendition["path"]),
+                "encode_time": round(encode_times[rendition["extension"]], 4)
+            }
+    except Exception:
+        for rendition, output_container, output_stream, resampler in encoders:
+            try:
+                output_container.close()
+            except Exception:
+                pass
+        raise
+
+    module_logger.info(f"Successfully converted WAV in process for file: {wav_file_path}, decode {decode_time:.4f}s, "
+                       + ", ".join(f"{extension} {result['encode_time']}s" for extension, result in results.items()))
+    return results
+
+
+def _transcode_with_ffmpeg(wav_file_path, renditions, decoded_audio=None):
+    # Construct the ffmpeg command, one input decoded once feeding an output per rendition. Samples that are already
+    # decoded are piped in as raw PCM so ffmpeg does not decode the WAV again.
+    if decoded_audio:
+        command = ["ffmpeg", "-y", "-f", "s16le", "-ar", f"{decoded_audio.sample_rate}", "-ac", "1", "-i", "pipe:0"]
+        pcm_input = decoded_audio.samples.tobytes()
+    else:
+        command = ["ffmpeg", "-y", "-i", wav_file_path]
+        pcm_input = None
+    for rendition in renditions:
+        command += ["-af", "aresample=resampler=soxr", "-ar", f"{rendition['sample_rate']}", "-c:a", rendition["codec"],
+                    "-ac", "1", "-b:a", f"{rendition['bitrate']}k", rendition["path"]]
 
     try:
         # Execute the ffmpeg command
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
-        module_logger.debug(f"ffmpeg output: {result.stdout}")
-        module_logger.info(f"Successfully converted WAV to M4A for file: {wav_file_path}")
-        return True
+        encode_start = time.perf_counter()
+        result = subprocess.run(command, input=pcm_input, capture_output=True, check=True)
+        encode_time = round(time.perf_counter() - encode_start, 4)
+        module_logger.debug(f"ffmpeg output: {result.stdout.decode(errors='replace')}")
     except subprocess.CalledProcessError as e:
-        error_message = f"Failed to convert WAV to M4A for file {wav_file_path}. Error: {e}"
+        error_message = f"Failed to convert WAV for file {wav_file_path}. Error: {e}"
         module_logger.error(error_message)
-        return False
+        return {}
     except Exception as e:
         error_message = f"An unexpected error occurred during conversion of {wav_file_path}: {e}"
         module_logger.error(error_message)
-        return False
+        return {}
+
+    # One process encodes every rendition together, so each one reports the time of the shared pass.
+    results = {rendition["extension"]: {"path": rendition["path"], "size": os.path.getsize(rendition["path"]),
+                                        "encode_time": encode_time}
+               for rendition in renditions if os.path.isfile(rendition["path"])}
+
+    module_logger.info(f"Successfully converted WAV with ffmpeg for file: {wav_file_path} in {encode_time}s")
+    return results
@@ -1,11 +1,13 @@
 import base64
 import json
 import logging
-import os
 import time
 
 import requests
 
+from lib.http_session_handler import get_session, get_timeout
+from lib.upload_engine import aiohttp, build_form_data, get_client_session, get_client_timeout
+
 module_logger = logging.getLogger('icad_tr_uploader.broadcastify_calls')
 
 
@@ -15,7 +17,8 @@ def send_request(method, url, **kwargs):
     Handles exceptions and logs errors with more context.
     """
     try:
-        response = requests.request(method, url, **kwargs)
+        kwargs.setdefault("timeout", get_timeout())
+        response = get_session(url).request(method, url, **kwargs)
         if response.status_code != 200:
             module_logger.error(
                 f"Error in {method} request to {url}: Status {response.status_code}, Response: {response.text}")
@@ -26,10 +29,10 @@ def send_request(method, url, **kwargs):
         return None
 
 
-def upload_to_broadcastify_calls(broadcastify_config, m4a_file_path, call_data):
+def upload_to_broadcastify_calls(broadcastify_config, call_audio, call_data):
     module_logger.info("Uploading to Broadcastify Calls")
 
-    broadcastify_url = "https://api.broadcastify.com/call-upload"
+    broadcastify_url = broadcastify_config.get("api_url") or "https://api.broadcastify.com/call-upload"
 
     headers = {
         "User-Agent": "TrunkRecorder1.0"
@@ -40,43 +43,98 @@ def upload_to_broadcastify_calls(broadcastify_config, m4a_file_path, call_data):
         json_string = json.dumps(call_data)
         json_bytes = json_string.encode('utf-8')
 
-        with open(m4a_file_path, 'rb') as audio_file:
-            files = {
-                'metadata': (os.path.basename(m4a_file_path.replace("m4a", ".json")), json_bytes, 'application/json'),
-                'audio': (os.path.basename(m4a_file_path), audio_file, 'audio/aac'),
-                'callDuration': (None, str(call_data["call_length"])),
-                'systemId': (None, str(broadcastify_config["system_id"])),
-                'apiKey': (None, broadcastify_config["api_key"]),
-                'ts': (None, str(call_data["start_time"])),
-                'tg': (None, str(call_data["talkgroup"]))
-            }
-
-            response = requests.post(broadcastify_url, headers=headers, files=files)
-            if response.status_code != 200:
-                module_logger.error(
-                    f"Failed to upload to Broadcastify Calls: Status {response.status_code}, Response: {response.text}")
+        files = {
+            'metadata': (call_audio.name(".m4a").replace("m4a", ".json"), json_bytes, 'application/json'),
+            'audio': (call_audio.name(".m4a"), call_audio.reader(".m4a"), 'audio/aac'),
+            'callDuration': (None, str(call_data["call_length"])),
+            'systemId': (None, str(broadcastify_config["system_id"])),
+            'apiKey': (None, broadcastify_config["api_key"]),
+            'ts': (None, str(call_data["start_time"])),
+            'tg': (None, str(call_data["talkgroup"]))
+        }
+
+        response = get_session(broadcastify_url).post(broadcastify_url, headers=headers, files=files,
+                                                      timeout=get_timeout(broadcastify_config))
+        if response.status_code != 200:
+            module_logger.error(
+                f"Failed to upload to Broadcastify Calls: Status {response.status_code}, Response: {response.text}")
+            return False
+
+        try:
+            upload_url = response.text.split(" ")[1]
+            if not upload_url:
+                module_logger.error("Upload URL not found in the Broadcastify response.")
                 return False
+        except ValueError:
+            module_logger.error("Failed to parse response from Broadcastify as JSON.")
+            return False
+
+        # The PUT streams from the same mapping as the POST, the file is not read a second time.
+        upload_response = get_session(upload_url).put(upload_url, headers={'Content-Type': 'audio/aac'},
+                                                      data=call_audio.reader(".m4a"),
+                                                      timeout=get_timeout(broadcastify_config))
+        if upload_response.status_code != 200:
+            module_logger.error(f"Failed to post call to Broadcastify Calls AWS Failed: {upload_response.status_code}, Response: {response.text}")
+            return False
+
+        module_logger.info("Broadcastify Calls Audio Upload Complete")
+        return True
+    except IOError as e:
+        module_logger.error(f"File error: {e}")
+        return False
+
 
-            try:
-                upload_url = response.text.split(" ")[1]
-                if not upload_url:
-                    module_logger.error("Upload URL not found in the Broadcastify response.")
-                    return False
-            except ValueError:
-                module_logger.error("Failed to parse response from Broadcastify as JSON.")
+async def upload_to_broadcastify_calls_async(broadcastify_config, call_audio, call_data):
+    """upload_to_broadcastify_calls for the async upload engine, both requests stream the M4A from its shared buffer."""
+    module_logger.info("Uploading to Broadcastify Calls")
+
+    broadcastify_url = broadcastify_config.get("api_url") or "https://api.broadcastify.com/call-upload"
+    timeout = get_client_timeout(broadcastify_config)
+
+    try:
+        fields = {
+            'callDuration': str(call_data["call_length"]),
+            'systemId': str(broadcastify_config["system_id"]),
+            'apiKey': broadcastify_config["api_key"],
+            'ts': str(call_data["start_time"]),
+            'tg': str(call_data["talkgroup"])
+        }
+        files = {
+            'metadata': (call_audio.name(".m4a").replace("m4a", ".json"), json.dumps(call_data).encode('utf-8'),
+                         'application/json'),
+            'audio': (call_audio.name(".m4a"), call_audio.reader(".m4a"), 'audio/aac')
+        }
+
+        session = get_client_session()
+        async with session.post(broadcastify_url, data=build_form_data(fields, files),
+                                headers={"User-Agent": "TrunkRecorder1.0"}, timeout=timeout) as response:
+            response_text = await response.text()
+            if response.status != 200:
+                module_logger.error(
+                    f"Failed to upload to Broadcastify Calls: Status {response.status}, Response: {response_text}")
                 return False
 
-            audio_file.seek(0)
-            audio_data = audio_file.read()
+        upload_url = response_text.split(" ")[1] if " " in response_text else ""
+        if not upload_url:
+            module_logger.error("Upload URL not found in the Broadcastify response.")
+            return False
 
-            # Reuse the send_request function for the PUT request
-            upload_response = requests.put(upload_url,  headers={'Content-Type': 'audio/aac'}, data=audio_data)
-            if upload_response.status_code != 200:
-                module_logger.error(f"Failed to post call to Broadcastify Calls AWS Failed: {upload_response.status_code}, Response: {response.text}")
+        async with session.put(upload_url, data=call_audio.reader(".m4a"), headers={'Content-Type': 'audio/aac'},
+                               timeout=timeout) as upload_response:
+            if upload_response.status != 200:
+                module_logger.error(
+                    f"Failed to post call to Broadcastify Calls AWS Failed: {upload_response.status}, Response: {await upload_response.text()}")
                 return False
 
-            module_logger.info("Broadcastify Calls Audio Upload Complete")
-            return True
+        module_logger.info("Broadcastify Calls Audio Upload Complete")
+        return True
     except IOError as e:
         module_logger.error(f"File error: {e}")
         return False
+    except aiohttp.ClientError as e:
+        module_logger.error(f"Exception during Broadcastify Calls upload: {e}")
+        return False
+    except Exception as e:
+        module_logger.error(f"An unexpected error occurred while uploading to Broadcastify Calls: {e}")
+        return False
+
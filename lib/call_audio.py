@@ -0,0 +1,244 @@
+import hashlib
+import io
+import logging
+import mmap
+import os
+import threading
+import wave
+
+import numpy as np
+
+module_logger = logging.getLogger('icad_tr_uploader.call_audio')
+
+
+class AudioReader(io.RawIOBase):
+    """Read only file object over a shared buffer. Each reader keeps its own position, so uploads running at the
+    same time never share a file offset."""
+
+    def __init__(self, buffer):
+        super().__init__()
+        self._buffer = buffer
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        # Slice the buffer directly instead of going through readinto and an intermediate bytearray.
+        end = len(self._buffer) if size is None or size < 0 else min(len(self._buffer), self._position + size)
+        data = self._buffer[self._position:end]
+        self._position = max(self._position, end)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._buffer)
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def __len__(self):
+        return len(self._buffer)
+
+
+class DecodedAudio:
+    """16 bit mono PCM samples of a call with their sample rate, decoded once and shared by everything that analyses
+    or encodes the audio."""
+
+    def __init__(self, samples, sample_rate):
+        self.samples = samples
+        self.sample_rate = sample_rate
+        self._fingerprints = {}
+
+    @property
+    def duration(self):
+        return len(self.samples) / self.sample_rate if self.sample_rate else 0.0
+
+    def normalized(self):
+        """Samples as float32 between -1 and 1."""
+        return self.samples.astype(np.float32) / 32768.0
+
+    def fingerprint(self, silence_threshold_dbfs=-50):
+        """
+        Content hash of the samples with leading and trailing silence trimmed, so copies of one transmission that
+        were recorded with a different lead in or tail still match. Calls that are nothing but silence hash as empty.
+
+        :return: Hex digest, the same for every copy of the same audio.
+        """
+        if silence_threshold_dbfs not in self._fingerprints:
+            threshold = 32768 * 10 ** (silence_threshold_dbfs / 20)
+            audible = np.flatnonzero(np.abs(self.samples.astype(np.int32)) > threshold)
+            trimmed = self.samples[audible[0]:audible[-1] + 1] if len(audible) else self.samples[:0]
+
+            digest = hashlib.blake2b(digest_size=16)
+            digest.update(self.sample_rate.to_bytes(4, 'little'))
+            digest.update(np.ascontiguousarray(trimmed, dtype='<i2').tobytes())
+            self._fingerprints[silence_threshold_dbfs] = digest.hexdigest()
+        return self._fingerprints[silence_threshold_dbfs]
+
+    def levels(self, silence_threshold_dbfs=-50, frame_ms=20):
+        """
+        Measures the call's loudness.
+
+        :return: Dict of peak_dbfs, rms_dbfs and silence_ratio, the share of frame_ms frames quieter than
+            silence_threshold_dbfs.
+        """
+        if not len(self.samples):
+            return {"peak_dbfs": None, "rms_dbfs": None, "silence_ratio": 1.0}
+
+        samples = self.normalized()
+        frame_length = max(1, int(self.sample_rate * frame_ms / 1000))
+        frame_count = len(samples) // frame_length
+
+        silence_ratio = 0.0
+        if frame_count:
+            frames = samples[:frame_count * frame_length].reshape(frame_count, frame_length)
+            frame_rms = np.sqrt(np.mean(np.square(frames), axis=1))
+            silence_ratio = float(np.mean(frame_rms < 10 ** (silence_threshold_dbfs / 20)))
+
+        return {
+            "peak_dbfs": _to_dbfs(np.max(np.abs(samples))),
+            "rms_dbfs": _to_dbfs(np.sqrt(np.mean(np.square(samples)))),
+            "silence_ratio": round(silence_ratio, 3)
+        }
+
+
+class CallAudio:
+    """
+    The files of one call, keyed by extension.
+
+    Each file is memory mapped read only the first time something needs it and that mapping is shared by every
+    handler, which each stream from it through their own AudioReader. Size and checksum come from the same mapping.
+    """
+
+    def __init__(self, file_paths=None):
+        """
+        :param file_paths: Dict of extension to file path, e.g. {".wav": wav_file_path, ".m4a": m4a_file_path}.
+        """
+        self.file_paths = dict(file_paths or {})
+        self._buffers = {}
+        self._checksums = {}
+        self._decoded = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, extension, file_path):
+        self.file_paths[extension] = file_path
+
+    def has(self, extension):
+        return os.path.isfile(self.file_paths.get(extension) or "")
+
+    def path(self, extension):
+        return self.file_paths[extension]
+
+    def name(self, extension):
+        return os.path.basename(self.file_paths[extension])
+
+    def buffer(self, extension):
+        """Returns the shared read only buffer of a file, mapping it on first use."""
+        with self._lock:
+            if extension not in self._buffers:
+                self._buffers[extension] = self._map_file(self.file_paths[extension])
+            return self._buffers[extension]
+
+    def forget(self, extension):
+        """Drops the cached mapping of a file that was rewritten, the next use maps the new file. Readers already
+        handed out keep the old contents."""
+        with self._lock:
+            self._buffers.pop(extension, None)
+            self._checksums.pop(extension, None)
+            self._decoded.pop(extension, None)
+
+    def reader(self, extension):
+        return AudioReader(self.buffer(extension))
+
+    def size(self, extension):
+        return len(self.buffer(extension))
+
+    def checksum(self, extension):
+        """SHA-256 hex digest of a file, hashed once from its mapping."""
+        if extension not in self._checksums:
+            self._checksums[extension] = hashlib.sha256(self.buffer(extension)).hexdigest()
+        return self._checksums[extension]
+
+    def decode(self, extension=".wav"):
+        """
+        Decodes a PCM WAV from its mapping into a DecodedAudio, once per call.
+
+        :return: DecodedAudio, or None if the file is missing or is not a PCM WAV, callers then fall back to the path.
+        """
+        if extension not in self._decoded:
+            try:
+                self._decoded[extension] = decode_wav(self.buffer(extension))
+            except (OSError, KeyError, EOFError, wave.Error, ValueError) as e:
+                module_logger.warning(f"Could not decode {self.file_paths.get(extension)}, using the file instead: {e}")
+                self._decoded[extension] = None
+        return self._decoded[extension]
+
+    def close(self):
+        """Unmaps every file. Readers handed out must not be used afterwards."""
+        with self._lock:
+            for buffer in self._buffers.values():
+                if isinstance(buffer, mmap.mmap):
+                    buffer.close()
+            self._buffers.clear()
+            self._decoded.clear()
+
+    @staticmethod
+    def _map_file(file_path):
+        with open(file_path, 'rb') as audio_file:
+            if os.fstat(audio_file.fileno()).st_size == 0:
+                # mmap can not map an empty file.
+                return b""
+            # The mapping stays valid after the file is closed.
+            buffer = mmap.mmap(audio_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        module_logger.debug(f"Mapped {file_path}, {len(buffer)} bytes")
+        return buffer
+
+
+def decode_wav(buffer):
+    """Decodes a PCM WAV held in buffer to a DecodedAudio of 16 bit mono samples."""
+    with wave.open(AudioReader(buffer), 'rb') as wav_file:
+        channels = wav_file.getnchannels()
+        sample_width = wav_file.getsampwidth()
+        sample_rate = wav_file.getframerate()
+        frames = wav_file.readframes(wav_file.getnframes())
+
+    if sample_width == 1:
+        samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.int16) - 128) << 8
+    elif sample_width == 2:
+        samples = np.frombuffer(frames, dtype='<i2')
+    elif sample_width == 3:
+        # Keep the two most significant bytes of each little endian 24 bit sample.
+        samples = np.frombuffer(frames, dtype=np.uint8).reshape(-1, 3)[:, 1:].copy().view('<i2').ravel()
+    elif sample_width == 4:
+        samples = (np.frombuffer(frames, dtype='<i4') >> 16).astype(np.int16)
+    else:
+        raise ValueError(f"Unsupported WAV sample width {sample_width}")
+
+    if channels > 1:
+        samples = samples[:len(samples) - len(samples) % channels].reshape(-1, channels).mean(axis=1).astype(np.int16)
+
+    return DecodedAudio(samples, sample_rate)
+
+
+def _to_dbfs(amplitude):
+    return round(20 * float(np.log10(amplitude)), 2) if amplitude > 0 else None
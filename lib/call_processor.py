@@ -1,19 +1,93 @@
+import asyncio
+import copy
 import logging
 import os
+import time
+import uuid
+from functools import partial
 
-from lib.archive_handler import archive_files
-from lib.audio_file_handler import compress_wav, save_call_data, clean_temp_files
-from lib.broadcastify_calls_handler import upload_to_broadcastify_calls
-from lib.config_handler import get_talkgroup_config
-from lib.icad_player_handler import upload_to_icad_player
-from lib.icad_tone_detect_legacy_handler import upload_to_icad_legacy
-from lib.openmhz_handler import upload_to_openmhz
-from lib.rdio_handler import upload_to_rdio
+from lib.archive_handler import archive_files, clean_archive_if_due
+from lib.audio_file_handler import transcode_wav, save_call_data, clean_temp_files, save_temporary_files, \
+    load_call_json, is_temporary_file
+from lib.broadcastify_calls_handler import upload_to_broadcastify_calls, upload_to_broadcastify_calls_async
+from lib.call_audio import CallAudio
+from lib.circuit_breaker import configure_circuit_breakers, get_circuit_breaker, call_with_breaker, \
+    call_with_breaker_async
+from lib.http_session_handler import configure_http_sessions
+from lib.icad_player_handler import upload_to_icad_player, upload_to_icad_player_async, update_icad_player
+from lib.icad_tone_detect_legacy_handler import upload_to_icad_legacy, upload_to_icad_legacy_async
+from lib.logging_handler import call_log_context, update_call_log_context
+from lib.metrics_handler import configure_metrics, stage_span, timed_stage, count
+from lib.openmhz_handler import upload_to_openmhz, upload_to_openmhz_async
+from lib.rdio_handler import upload_to_rdio, upload_to_rdio_async
+from lib.result_cache import get_result_cache, cached_result
+from lib.routing_handler import get_system_routes
+from lib.retry_spool import get_retry_spool
+from lib.task_graph import run_task_graph
 from lib.tone_detect_handler import get_tones
-from lib.transcribe_handler import upload_to_transcribe
+from lib.transcribe_handler import transcribe_audio
+from lib.upload_engine import configure_upload_engine
 
 module_logger = logging.getLogger('icad_tr_uploader.call_processor')
 
+# Destination uploads that have a coroutine twin for the async upload engine.
+async_upload_functions = {
+    upload_to_broadcastify_calls: upload_to_broadcastify_calls_async,
+    upload_to_icad_legacy: upload_to_icad_legacy_async,
+    upload_to_icad_player: upload_to_icad_player_async,
+    upload_to_openmhz: upload_to_openmhz_async,
+    upload_to_rdio: upload_to_rdio_async,
+}
+
+
+def process_call_job(global_config_data, system_short_name, audio_wav_path, retry_spooled=True, clean_archive=True):
+    """
+    Ingests a trunk-recorder call into temp storage, loads its metadata and runs it through process_tr_call.
+
+    The ingest_mode setting decides whether the files are hardlinked, moved, copied or read where they are, see
+    ingest_file.
+
+    With retry_spooled set, a few spooled deliveries that are due are retried afterwards, and with clean_archive set
+    the system's archive retention sweep runs if it is due. The daemon turns both off and does them from its own
+    threads instead.
+    """
+    # Every line logged for this call, from any of its threads, carries these fields.
+    with call_log_context(call_id=uuid.uuid4().hex[:12], call_file=os.path.basename(audio_wav_path),
+                          system=system_short_name):
+        temp_file_path = global_config_data.get('temp_file_path', '/dev/shm')
+        configure_metrics(global_config_data.get("metrics", {}))
+        count("icad_tr_uploader_calls_total", system=system_short_name)
+
+        # link or copy files to tmp
+        ingested_files = timed_stage("ingest", save_temporary_files, temp_file_path, audio_wav_path,
+                                     global_config_data.get("ingest_mode", "auto"), system=system_short_name)
+        if not ingested_files:
+            return False
+        wav_file_path, json_file_path = ingested_files
+
+        # load call data
+        call_data = load_call_json(json_file_path)
+        if not call_data:
+            clean_temp_files(*[file_path for file_path in ingested_files if is_temporary_file(file_path, temp_file_path)])
+            return False
+        update_call_log_context(talkgroup=call_data.get("talkgroup", 0))
+
+        # start call processing
+        with stage_span("call", system_short_name, call_data.get("talkgroup", 0)):
+            process_tr_call(global_config_data, wav_file_path, call_data, system_short_name)
+
+    # Spooled deliveries and the archive sweep belong to other calls, so they run outside this call's log context.
+    retry_spool = get_retry_spool(global_config_data)
+    if retry_spooled and retry_spool:
+        retry_spool.retry_due(global_config_data, limit=global_config_data.get("retry_spool", {}).get(
+            "retries_per_call", 5))
+
+    if clean_archive:
+        clean_archive_if_due(global_config_data.get("systems", {}).get(system_short_name, {}).get("archive", {}),
+                             system_short_name, temp_file_path)
+
+    return True
+
 
 def process_tr_call(global_config_data, wav_file_path, call_data, system_short_name):
     m4a_exists = False
@@ -29,7 +103,11 @@ def process_tr_call(global_config_data, wav_file_path, call_data, system_short_n
         module_logger.error("<<System>> <<configuration>> not in config data. Cannot Process")
         return
 
-    talkgroup_config = get_talkgroup_config(system_config.get("talkgroup_config", {}), call_data)
+    # Which stages and destinations run for this talkgroup comes from the system's compiled routes.
+    system_routes = get_system_routes(short_name, system_config)
+    call_route = system_routes.route(talkgroup_decimal)
+
+    talkgroup_config = system_routes.talkgroup_config(talkgroup_decimal)
     if not talkgroup_config:
         module_logger.error("<<Talkgroup>> <<configuration>> not in config data. Cannot Process")
         return
@@ -37,122 +115,330 @@ def process_tr_call(global_config_data, wav_file_path, call_data, system_short_n
     call_data["tones"] = {}
     call_data["transcript"] = []
 
-    wav_file_path = os.path.join(global_config_data.get("temp_file_path", "/dev/shm"), os.path.basename(wav_file_path))
-    m4a_file_path = wav_file_path.replace(".wav", ".m4a")
-    json_file_path = wav_file_path.replace(".wav", ".json")
-
-    # Convert WAV to M4A in tmp /dev/shm
-    if system_config.get("audio_compression", {}).get("enabled", 0) == 1:
-        m4a_exists = compress_wav(system_config.get("audio_compression", {}), wav_file_path)
-
-    # Legacy Tone Detection
-    for icad_detect in system_config.get("icad_tone_detect_legacy", []):
-        if icad_detect.get("enabled", 0) == 1:
-            try:
-                icad_result = upload_to_icad_legacy(icad_detect, wav_file_path, call_data)
-                if icad_result:
-                    module_logger.info(
-                        f"<<Successfully>> uploaded to <<iCAD>> <<Tone>> <<Detect>> Legacy server: {icad_detect.get('icad_url')}")
-                else:
-                    raise Exception()
-
-
-            except Exception as e:
-                module_logger.error(
-                    f"<<Failed>> to upload to <<iCAD>> <<Tone>> <<Detect>> Legacy server: {icad_detect.get('icad_url')}. Error: {str(e)}",
-                    exc_info=True)
+    configure_http_sessions(global_config_data.get("http", {}))
+    upload_engine = configure_upload_engine(global_config_data.get("http", {}))
+    configure_circuit_breakers(global_config_data.get("circuit_breaker", {}))
+    retry_spool = get_retry_spool(global_config_data)
+    # Copies of a transmission recorded on several talkgroups or systems reuse the first copy's tones and transcript.
+    result_cache = get_result_cache(global_config_data)
+
+    # The WAV may be read in place, everything derived from it is written to temp storage.
+    temp_file_path = global_config_data.get("temp_file_path", "/dev/shm")
+    m4a_file_path = os.path.join(temp_file_path, os.path.basename(wav_file_path).replace(".wav", ".m4a"))
+    json_file_path = m4a_file_path.replace(".m4a", ".json")
+
+    # Each file is mapped once and every handler streams from that shared buffer instead of opening it again. The
+    # WAV is decoded once on first use and the encoders, tone detection and level analysis share the samples.
+    with CallAudio({".wav": wav_file_path, ".json": json_file_path}) as call_audio:
+        # Convert WAV to M4A and any extra renditions in tmp /dev/shm
+        audio_renditions = {}
+        if "audio_compression" in call_route:
+            audio_renditions = timed_stage("transcode", transcode_wav, system_config.get("audio_compression", {}),
+                                           wav_file_path, temp_file_path, call_audio.decode(), system=system_short_name,
+                                           talkgroup=talkgroup_decimal)
+            m4a_exists = ".m4a" in audio_renditions
+        for extension, rendition in audio_renditions.items():
+            call_audio.add(extension, rendition["path"])
+
+        # Legacy Tone Detection
+        for icad_detect in system_config.get("icad_tone_detect_legacy", []):
+            if icad_detect.get("enabled", 0) == 1:
+                try:
+                    icad_result = upload_task(upload_engine, retry_spool, system_short_name, "icad_tone_detect_legacy",
+                                              icad_detect.get("icad_url"), {".wav": wav_file_path}, call_data,
+                                              upload_to_icad_legacy, icad_detect, call_audio, call_data, wait=True)()
+                    if icad_result:
+                        module_logger.info(
+                            f"<<Successfully>> uploaded to <<iCAD>> <<Tone>> <<Detect>> Legacy server: {icad_detect.get('icad_url')}")
+                    else:
+                        raise Exception()
+
+
+                except Exception as e:
+                    module_logger.error(
+                        f"<<Failed>> to upload to <<iCAD>> <<Tone>> <<Detect>> Legacy server: {icad_detect.get('icad_url')}. Error: {str(e)}",
+                        exc_info=True)
+                    continue
+            else:
+                module_logger.warning(f"<<iCAD>> <<Tone>> <<Detect>> Legacy is disabled: {icad_detect.get('icad_url')}")
+                continue
+
+        # Level and Silence Analysis
+        if "audio_analysis" in call_route:
+            decoded_audio = call_audio.decode()
+            if decoded_audio:
+                call_data["audio_levels"] = decoded_audio.levels(
+                    system_config.get("audio_analysis", {}).get("silence_threshold_dbfs", -50))
+                module_logger.debug(f"<<Audio>> <<Levels>> {call_data['audio_levels']}")
+
+        # Tone Detection
+        if system_routes.is_enabled("tone_detection"):
+            if "tone_detection" not in call_route:
+                module_logger.debug(
+                    f"<<Tone>> <<Detection>> Disabled for Talkgroup {call_data.get('talkgroup_tag') or call_data.get('talkgroup')}")
+            else:
+                with stage_span("tone_detect", system_short_name, talkgroup_decimal):
+                    tone_detect_result = cached_result(result_cache, call_audio, "tones",
+                                                       system_config.get("tone_detection", {}),
+                                                       partial(get_tones, system_config.get("tone_detection", {}),
+                                                               call_audio))
+                call_data["tones"] = tone_detect_result
+                module_logger.info(f"<<Tone>> <<Detection>> Complete")
+                module_logger.debug(call_data.get("tones"))
+
+        # Transcribe Audio
+        transcribe_async = False
+        if system_routes.is_enabled("transcribe"):
+            if "transcribe" not in call_route:
+                module_logger.debug(
+                    f"<<iCAD>> <<Transcribe>> <<Disabled>> for Talkgroup {call_data.get('talkgroup_tag') or call_data.get('talkgroup')}")
+            elif system_config.get("transcribe", {}).get("async", 0) == 1:
+                # Transcribed next to the uploads below, the transcript follows the audio as an update.
+                transcribe_async = True
+            else:
+                transcribe_result = timed_stage("transcribe", cached_result, result_cache, call_audio, "transcript",
+                                                system_config.get("transcribe", {}),
+                                                partial(transcribe_audio, system_config.get("transcribe", {}),
+                                                        call_audio, call_data, talkgroup_config=None),
+                                                system=system_short_name, talkgroup=talkgroup_decimal)
+                call_data["transcript"] = transcribe_result
+                module_logger.debug(call_data.get("transcript"))
+
+        # Resave JSON with new Transcript and Tone Data.
+        try:
+            save_call_data(json_file_path, call_data)
+        except Exception as e:
+            module_logger.warning(
+                f"<<Unexpected>> <<error>> occurred saving new call data to <<temporary>> <<file>> "
+                f"{json_file_path}. {e}")
+
+        # Send to Archive and Players. OpenMHZ, Broadcastify Calls and RDIO only need the M4A so they start right away,
+        # iCAD Player waits for the archive URLs.
+        destination_call_data = copy.deepcopy(call_data)
+        destination_tasks = {}
+
+        # Archive Files
+        if "archive" in call_route:
+            destination_tasks["archive"] = (
+                partial(archive_call, system_config.get("archive", {}), call_audio, call_data, system_short_name), [])
+
+        # Upload to OpenMHZ
+        if "openmhz" in call_route:
+            if m4a_exists:
+                destination_tasks["openmhz"] = (
+                    upload_task(upload_engine, retry_spool, system_short_name, "openmhz", "", {".m4a": m4a_file_path},
+                                destination_call_data, upload_to_openmhz, system_config.get("openmhz", {}), call_audio,
+                                destination_call_data), [])
+            else:
+                module_logger.warning(f"No M4A file can't send to OpenMHZ")
+
+        # Upload to BCFY Calls
+        if "broadcastify_calls" in call_route:
+            if m4a_exists:
+                destination_tasks["broadcastify_calls"] = (
+                    upload_task(upload_engine, retry_spool, system_short_name, "broadcastify_calls", "",
+                                {".m4a": m4a_file_path}, destination_call_data, upload_to_broadcastify_calls,
+                                system_config.get("broadcastify_calls", {}), call_audio, destination_call_data), [])
+            else:
+                module_logger.warning(f"No M4A file can't send to Broadcastify Calls")
+
+        # Upload to iCAD Player
+        if system_routes.is_enabled("icad_player"):
+            if "icad_player" not in call_route:
+                module_logger.warning(
+                    f"iCAD Player Disabled for Talkgroup {call_data.get('talkgroup_tag') or call_data.get('talkgroup_decimal')}")
+            else:
+                destination_tasks["icad_player"] = (
+                    partial(send_to_icad_player, system_config.get("icad_player", {}), call_data, retry_spool,
+                            system_short_name, upload_engine),
+                    ["archive"] if "archive" in destination_tasks else [])
+
+        # Upload to RDIO systems
+        for index, rdio in enumerate(system_config.get("rdio_systems", [])):
+            if rdio.get("enabled", 0) == 1:
+                if not m4a_exists:
+                    module_logger.warning(f"No M4A file can't send to RDIO")
+                    continue
+                destination_tasks[f"rdio_{index}"] = (
+                    upload_task(upload_engine, retry_spool, system_short_name, "rdio_systems", rdio.get("rdio_url"),
+                                {".m4a": m4a_file_path}, destination_call_data, upload_to_rdio, rdio, call_audio,
+                                destination_call_data), [])
+            else:
+                module_logger.warning(f"RDIO system is disabled: {rdio.get('rdio_url')}")
                 continue
-        else:
-            module_logger.warning(f"<<iCAD>> <<Tone>> <<Detect>> Legacy is disabled: {icad_detect.get('icad_url')}")
-            continue
-
-    # Tone Detection
-    if system_config.get("tone_detection", {}).get("enabled", 0) == 1:
-        if talkgroup_decimal not in system_config.get("tone_detection", {}).get("allowed_talkgroups",
-                                                                                []) and "*" not in system_config.get(
-                "tone_detection", {}).get("allowed_talkgroups", []):
-            module_logger.debug(
-                f"<<Tone>> <<Detection>> Disabled for Talkgroup {call_data.get('talkgroup_tag') or call_data.get('talkgroup')}")
-        else:
-            tone_detect_result = get_tones(system_config.get("tone_detection", {}), wav_file_path)
-            call_data["tones"] = tone_detect_result
-            module_logger.info(f"<<Tone>> <<Detection>> Complete")
-            module_logger.debug(call_data.get("tones"))
-
-    # Transcribe Audio
-    if system_config.get("transcribe", {}).get("enabled", 0) == 1:
-        if talkgroup_decimal not in system_config.get("transcribe", {}).get("allowed_talkgroups",
-                                                                            []) and "*" not in system_config.get(
-            "transcribe", {}).get("allowed_talkgroups", []):
-            module_logger.debug(
-                f"<<iCAD>> <<Transcribe>> <<Disabled>> for Talkgroup {call_data.get('talkgroup_tag') or call_data.get('talkgroup')}")
-        else:
-            transcribe_result = upload_to_transcribe(system_config.get("transcribe", {}), wav_file_path, call_data,
-                                                     talkgroup_config=None)
-            call_data["transcript"] = transcribe_result
-            module_logger.debug(call_data.get("transcript"))
-
-    # Resave JSON with new Transcript and Tone Data.
+
+        # Transcribe alongside the uploads, then update the archived JSON and iCAD Player once the audio is delivered.
+        if transcribe_async:
+            transcription = {}
+            destination_tasks["transcribe"] = (
+                partial(transcribe_call, system_config.get("transcribe", {}), call_audio, destination_call_data,
+                        transcription, result_cache, system_short_name), [])
+            destination_tasks["transcript_update"] = (
+                partial(timed_stage, "transcript_update", send_transcript_update, system_config, call_route, call_audio,
+                        call_data, json_file_path, transcription, retry_spool, system_short_name,
+                        system=system_short_name, talkgroup=talkgroup_decimal),
+                ["transcribe"] + [task for task in ("archive", "icad_player") if task in destination_tasks])
+
+        run_task_graph(destination_tasks, global_config_data.get("destination_workers", 8), upload_engine)
+
+    # Cleanup Temp Files, a WAV read in place is trunk-recorder's and stays where it is.
+    with stage_span("cleanup", system_short_name, talkgroup_decimal):
+        temp_files = [m4a_file_path, json_file_path, *[rendition["path"] for rendition in audio_renditions.values()]]
+        if is_temporary_file(wav_file_path, temp_file_path):
+            temp_files.append(wav_file_path)
+        clean_temp_files(*temp_files)
+
+
+def archive_call(archive_config, call_audio, call_data, system_short_name):
+    with stage_span("archive", system_short_name, call_data.get("talkgroup", 0),
+                    archive_config.get("archive_type", "")) as span:
+        url_paths = archive_files(archive_config, call_audio, call_data, system_short_name)
+        span.failed = not url_paths or not all(url_paths.values())
+    count("icad_tr_uploader_bytes_sent_total", sum(call_audio.size(extension) for extension, url_path in
+                                                   url_paths.items() if url_path),
+          destination=archive_config.get("archive_type", ""))
+
+    # Audio renditions get an audio_<extension>_url, e.g. audio_m4a_url. The JSON URL is not stored in itself.
+    for extension, url_path in url_paths.items():
+        if url_path and extension != ".json":
+            call_data[f"audio_{extension.lstrip('.')}_url"] = url_path
+
+    module_logger.info(f"<<Archive>> <<Complete>>")
+    if module_logger.isEnabledFor(logging.DEBUG):
+        module_logger.debug(f"Url Paths:\n" + "\n".join(str(url_path) for url_path in url_paths.values()))
+    return url_paths
+
+
+def transcribe_call(transcribe_config, call_audio, call_data, transcription, result_cache=None, system_short_name=""):
+    """Transcribes a call into the transcription dict, with the time it started and finished."""
+    transcription["started"] = time.time()
+    transcription["transcript"] = timed_stage("transcribe", cached_result, result_cache, call_audio, "transcript",
+                                              transcribe_config,
+                                              partial(transcribe_audio, transcribe_config, call_audio, call_data,
+                                                      talkgroup_config=None),
+                                              system=system_short_name,
+                                              talkgroup=call_data.get("talkgroup", 0))
+    transcription["finished"] = time.time()
+    return transcription["transcript"]
+
+
+def send_transcript_update(system_config, call_route, call_audio, call_data, json_file_path, transcription,
+                           retry_spool=None, system_short_name=None):
+    """
+    Adds a transcript that arrived after the audio was delivered to the call. The call JSON is saved and archived
+    again and iCAD Player gets the call as an update.
+    """
+    if not transcription.get("transcript"):
+        module_logger.warning("No transcript, nothing to update")
+        return False
+
+    update_start = time.time()
+    call_data["transcript"] = transcription["transcript"]
+
     try:
         save_call_data(json_file_path, call_data)
     except Exception as e:
-        module_logger.warning(
-            f"<<Unexpected>> <<error>> occurred saving new call data to <<temporary>> <<file>> {json_file_path}. {e}")
-
-    # Archive Files
-    if system_config.get("archive", {}).get("enabled", 0) == 1 and system_config.get("archive", {}).get("archive_days",
-                                                                                                        0) >= 1:
-        wav_url, m4a_url, json_url = archive_files(system_config.get("archive", {}),
-                                                   global_config_data.get("temp_file_path", "/dev/shm"), os.path.basename(wav_file_path), call_data,
-                                                   system_short_name)
-        if wav_url:
-            call_data["audio_wav_url"] = wav_url
-        if m4a_url:
-            call_data["audio_m4a_url"] = m4a_url
-
-        module_logger.info(f"<<Archive>> <<Complete>>")
-        module_logger.debug(f"Url Paths:\n{call_data['audio_wav_url']}\n{call_data['audio_m4a_url']}")
-
-    # Send to Players
-
-    # Upload to OpenMHZ
-    if system_config.get("openmhz", {}).get("enabled", 0) == 1:
-        if m4a_exists:
-            openmhz_result = upload_to_openmhz(system_config.get("openmhz", {}),
-                                               m4a_file_path, call_data)
-        else:
-            module_logger.warning(f"No M4A file can't send to OpenMHZ")
-
-    # Upload to BCFY Calls
-    if system_config.get("broadcastify_calls", {}).get("enabled", 0) == 1:
-        if m4a_exists:
-            bcfy_calls_result = upload_to_broadcastify_calls(system_config.get("broadcastify_calls", {}), m4a_file_path, call_data)
-        else:
-            module_logger.warning(f"No M4A file can't send to Broadcastify Calls")
-
-    # Upload to iCAD Player
-    if call_data.get("audio_m4a_url", "") and system_config.get("icad_player", {}).get("enabled", 0) == 1:
-        if talkgroup_decimal not in system_config.get("icad_player", {}).get("allowed_talkgroups", []) and "*" not in system_config.get("icad_player", {}).get("allowed_talkgroups", []):
-            module_logger.warning(
-                f"iCAD Player Disabled for Talkgroup {call_data.get('talkgroup_tag') or call_data.get('talkgroup_decimal')}")
-        else:
-            icad_player_result = upload_to_icad_player(system_config.get("icad_player", {}), call_data)
-            if icad_player_result:
-                module_logger.info(f"Upload to iCAD Player Complete")
-
-    # Upload to RDIO systems
-    for rdio in system_config.get("rdio_systems", []):
-        if rdio.get("enabled", 0) == 1:
-            if not m4a_exists:
-                module_logger.warning(f"No M4A file can't send to RDIO")
-                continue
-            try:
-                upload_to_rdio(rdio, global_config_data.get("temp_file_path", "/dev/shm"), call_data)
-            except Exception as e:
-                continue
-        else:
-            module_logger.warning(f"RDIO system is disabled: {rdio.get('rdio_url')}")
-            continue
+        module_logger.warning(f"<<Unexpected>> <<error>> saving the transcript to {json_file_path}. {e}")
+        return False
+
+    updated = True
+    if "archive" in call_route:
+        call_audio.forget(".json")
+        url_paths = archive_files(system_config.get("archive", {}), call_audio, call_data, system_short_name, extensions=[".json"])
+        updated = all(url_paths.values())
+
+    player_config = system_config.get("icad_player", {})
+    if "icad_player" in call_route and call_data.get("audio_m4a_url") and player_config.get("update_api_url"):
+        updated = upload_or_spool(retry_spool, system_short_name, "icad_player_update", "", {}, call_data,
+                                  update_icad_player, player_config, call_data) and updated
+
+    update_end = time.time()
+    module_logger.info(
+        f"<<Transcript>> <<Update>> sent {update_end - transcription['started']:.2f}s after the uploads "
+        f"started, transcription {transcription['finished'] - transcription['started']:.2f}s, update "
+        f"{update_end - update_start:.2f}s")
+    return updated
+
+
+def send_to_icad_player(player_config, call_data, retry_spool=None, system_short_name=None, upload_engine=None):
+    if not call_data.get("audio_m4a_url", ""):
+        module_logger.warning(f"No archived M4A URL can't send to iCAD Player")
+        return False
+
+    icad_player_result = upload_task(upload_engine, retry_spool, system_short_name, "icad_player", "", {}, call_data,
+                                     upload_to_icad_player, player_config, call_data, wait=True)()
+    if icad_player_result:
+        module_logger.info(f"Upload to iCAD Player Complete")
+    return icad_player_result
+
+
+def upload_or_spool(retry_spool, system_short_name, destination, destination_id, audio_files, call_data,
+                    upload_function, *upload_args):
+    """
+    Runs a destination upload through the destination's circuit breaker and hands the delivery to the retry spool if
+    it fails or the breaker turns it away.
+    """
+    with stage_span("upload", system_short_name, call_data.get("talkgroup", 0), destination) as span:
+        try:
+            result = call_with_breaker(get_circuit_breaker(destination, destination_id), upload_function,
+                                       *upload_args)
+        except Exception as e:
+            module_logger.error(f"<<Unexpected>> <<error>> uploading to {destination} {destination_id}: {e}",
+                                exc_info=True)
+            result = False
+        span.failed = not result
+
+    return finish_upload(result, retry_spool, system_short_name, destination, destination_id, audio_files, call_data)
+
+
+async def upload_or_spool_async(retry_spool, system_short_name, destination, destination_id, audio_files, call_data,
+                                upload_function, *upload_args):
+    """upload_or_spool for a coroutine upload on the async upload engine."""
+    with stage_span("upload", system_short_name, call_data.get("talkgroup", 0), destination) as span:
+        try:
+            result = await call_with_breaker_async(get_circuit_breaker(destination, destination_id), upload_function,
+                                                   *upload_args)
+        except Exception as e:
+            module_logger.error(f"<<Unexpected>> <<error>> uploading to {destination} {destination_id}: {e}",
+                                exc_info=True)
+            result = False
+        span.failed = not result
+
+    # Spooling writes to disk, so it runs off the engine's loop.
+    return await asyncio.to_thread(finish_upload, result, retry_spool, system_short_name, destination, destination_id,
+                                   audio_files, call_data)
+
+
+def upload_task(upload_engine, retry_spool, system_short_name, destination, destination_id, audio_files, call_data,
+                upload_function, *upload_args, wait=False):
+    """
+    Builds the task for a destination upload, a coroutine function for the async upload engine when it is running and
+    the upload has a coroutine twin, otherwise an upload_or_spool partial.
+
+    :param wait: Return a plain callable that runs the upload on the engine and waits for it, for uploads made outside
+        the task graph.
+    """
+    async_upload_function = async_upload_functions.get(upload_function)
+    if not upload_engine or not async_upload_function:
+        return partial(upload_or_spool, retry_spool, system_short_name, destination, destination_id, audio_files,
+                       call_data, upload_function, *upload_args)
+
+    task = partial(upload_or_spool_async, retry_spool, system_short_name, destination, destination_id, audio_files,
+                   call_data, async_upload_function, *upload_args)
+    if wait:
+        return lambda: upload_engine.run(task())
+    return task
+
+
+def finish_upload(result, retry_spool, system_short_name, destination, destination_id, audio_files, call_data):
+    """Counts the bytes a delivered upload sent, or hands a failed one to the retry spool."""
+    if result and audio_files:
+        count("icad_tr_uploader_bytes_sent_total", sum(os.path.getsize(file_path) for file_path in
+                                                       audio_files.values() if os.path.isfile(file_path)),
+              destination=destination)
+
+    if not result and retry_spool:
+        if retry_spool.add(destination, system_short_name, destination_id, call_data, audio_files):
+            count("icad_tr_uploader_spooled_total", destination=destination)
 
-    # Cleanup Temp Files
-    clean_temp_files(wav_file_path, m4a_file_path, json_file_path)
\ No newline at end of file
+    return result
@@ -0,0 +1,126 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+module_logger = logging.getLogger('icad_tr_uploader.call_scheduler')
+
+
+class CallScheduler:
+    """
+    Bounded worker pool for call jobs.
+
+    Jobs are queued per system and handed to workers round robin across systems, so a burst on one system can not
+    starve the others. A system never has more than its concurrency limit running at once, and submit blocks while
+    the queue is full so producers feel backpressure instead of growing the queue without limit.
+    """
+
+    def __init__(self, process_job, max_workers=4, max_queue_size=100, system_limit=None):
+        """
+        :param process_job: Callable run by a worker with the arguments passed to submit.
+        :param max_workers: Calls processed at once across every system.
+        :param max_queue_size: Calls waiting for a worker before submit blocks.
+        :param system_limit: Callable returning the concurrency limit for a system short name, 0 for no limit.
+        """
+        self.process_job = process_job
+        self.max_workers = max(1, max_workers)
+        self.max_queue_size = max(1, max_queue_size)
+        self.system_limit = system_limit or (lambda system_short_name: 0)
+
+        self._condition = threading.Condition()
+        self._pending = OrderedDict()
+        self._running = {}
+        self._queued = 0
+        self._stopping = False
+        self._workers = []
+
+    def start(self):
+        for index in range(self.max_workers):
+            worker = threading.Thread(target=self._worker, name=f"call-worker-{index}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+        module_logger.info(f"<<Call>> <<Scheduler>> started with {self.max_workers} workers")
+
+    def submit(self, system_short_name, *job_args, timeout=None):
+        """
+        Queues a job for a system, waiting up to timeout seconds for queue space.
+
+        :return: True if queued, False if the queue stayed full or the scheduler is stopping.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._condition:
+            while self._queued >= self.max_queue_size and not self._stopping:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+
+            if self._stopping:
+                return False
+
+            self._pending.setdefault(system_short_name, deque()).append(job_args)
+            self._queued += 1
+            self._condition.notify_all()
+
+        return True
+
+    def shutdown(self):
+        """Stops accepting jobs and waits for every queued and running job to finish."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def stats(self):
+        with self._condition:
+            return {
+                "queued": self._queued,
+                "running": sum(self._running.values()),
+                "systems": {system: len(jobs) for system, jobs in self._pending.items()}
+            }
+
+    def _next_job(self):
+        for system_short_name, jobs in self._pending.items():
+            limit = self.system_limit(system_short_name)
+            if limit and self._running.get(system_short_name, 0) >= limit:
+                continue
+
+            job_args = jobs.popleft()
+            if jobs:
+                # Rotate so the next worker looks at the other systems first.
+                self._pending.move_to_end(system_short_name)
+            else:
+                del self._pending[system_short_name]
+
+            self._queued -= 1
+            self._running[system_short_name] = self._running.get(system_short_name, 0) + 1
+            self._condition.notify_all()
+            return system_short_name, job_args
+
+        return None
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                next_job = self._next_job()
+                while next_job is None:
+                    if self._stopping and self._queued == 0:
+                        return
+                    self._condition.wait()
+                    next_job = self._next_job()
+
+            system_short_name, job_args = next_job
+            try:
+                self.process_job(system_short_name, *job_args)
+            except Exception as e:
+                module_logger.error(f"<<Unexpected>> <<error>> processing call for {system_short_name}: {e}",
+                                    exc_info=True)
+            finally:
+                with self._condition:
+                    self._running[system_short_name] -= 1
+                    self._condition.notify_all()
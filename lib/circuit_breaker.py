@@ -0,0 +1,295 @@
+import asyncio
+import collections
+import json
+import logging
+import threading
+import time
+
+from lib.http_session_handler import clear_response_status, last_response_status
+from lib.metrics_handler import count
+
+module_logger = logging.getLogger('icad_tr_uploader.circuit_breaker')
+
+default_breaker_config = {
+    "enabled": 0,
+    "failure_threshold": 5,
+    "latency_threshold": 30,
+    "open_seconds": 30,
+    "half_open_probes": 1,
+    "adaptive_concurrency": 1,
+    "min_concurrency": 1,
+    "max_concurrency": 16,
+    "queue_timeout": 30
+}
+
+_breaker_config = None
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def configure_circuit_breakers(breaker_config):
+    """Sets the breaker settings. The breakers start over closed if the settings change."""
+    global _breaker_config
+
+    new_config = dict(default_breaker_config)
+    new_config.update(breaker_config or {})
+
+    with _circuit_breakers_lock:
+        if new_config == _breaker_config:
+            return
+
+        _breaker_config = new_config
+        _circuit_breakers.clear()
+
+    module_logger.debug(f"Circuit breakers configured: {json.dumps(new_config)}")
+
+
+def get_circuit_breaker(destination, destination_id=""):
+    """
+    Returns the shared CircuitBreaker for a destination, or None if circuit breakers are disabled.
+
+    :param destination: Config section of the destination, e.g. openmhz or rdio_systems.
+    :param destination_id: Identifies the destination inside its section, the URL for list sections.
+    """
+    if not _breaker_config or _breaker_config.get("enabled", 0) != 1:
+        return None
+
+    breaker_key = (destination, destination_id or "")
+    with _circuit_breakers_lock:
+        breaker = _circuit_breakers.get(breaker_key)
+        if breaker is None:
+            breaker = CircuitBreaker(destination, destination_id, _breaker_config)
+            _circuit_breakers[breaker_key] = breaker
+        return breaker
+
+
+def get_circuit_breaker_stats():
+    with _circuit_breakers_lock:
+        return {breaker.name: breaker.stats() for breaker in _circuit_breakers.values()}
+
+
+def call_with_breaker(breaker, function, *args, **kwargs):
+    """
+    Runs function through breaker when there is one, otherwise just runs it.
+
+    :return: What function returned, None if the breaker turned the call away.
+    """
+    if breaker is None:
+        return function(*args, **kwargs)
+
+    permit = breaker.acquire()
+    if permit is None:
+        return None
+
+    result = None
+    clear_response_status()
+    try:
+        result = function(*args, **kwargs)
+        return result
+    finally:
+        breaker.release(permit, bool(result), last_response_status())
+
+
+async def call_with_breaker_async(breaker, function, *args, **kwargs):
+    """call_with_breaker for a coroutine function on the async upload engine."""
+    if breaker is None:
+        return await function(*args, **kwargs)
+
+    permit = await breaker.acquire_async()
+    if permit is None:
+        return None
+
+    result = None
+    clear_response_status()
+    try:
+        result = await function(*args, **kwargs)
+        return result
+    finally:
+        breaker.release(permit, bool(result), last_response_status())
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker and adaptive concurrency limit for one destination.
+
+    Connection errors, 429 and 5xx responses and calls slower than latency_threshold count as the destination
+    struggling. After failure_threshold of them in a row the breaker opens and calls are turned away without being
+    tried, so they go straight to the retry spool. After open_seconds it lets half_open_probes calls through, the
+    breaker closes again if they succeed and stays open for another open_seconds if they fail. Any other response,
+    including a 4xx, means the destination is up and resets the count.
+
+    With adaptive_concurrency the number of calls in flight to the destination is limited with AIMD. The limit starts
+    at max_concurrency, grows by one for every limit calls that succeed and halves when the destination struggles, at
+    most once per round trip. Calls over the limit wait up to queue_timeout seconds for a slot and are turned away
+    after that.
+    """
+
+    def __init__(self, destination, destination_id, breaker_config):
+        self.name = f"{destination} {destination_id}" if destination_id else destination
+        self.destination = destination
+        self.failure_threshold = max(1, breaker_config.get("failure_threshold", 5))
+        self.latency_threshold = breaker_config.get("latency_threshold", 30)
+        self.open_seconds = breaker_config.get("open_seconds", 30)
+        self.half_open_probes = max(1, breaker_config.get("half_open_probes", 1))
+        self.adaptive_concurrency = breaker_config.get("adaptive_concurrency", 1) == 1
+        self.min_concurrency = max(1, breaker_config.get("min_concurrency", 1))
+        self.max_concurrency = max(self.min_concurrency, breaker_config.get("max_concurrency", 16))
+        self.queue_timeout = breaker_config.get("queue_timeout", 30)
+
+        self.state = "closed"
+        self.limit = float(self.max_concurrency)
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._waiters = collections.deque()
+        self._lock = threading.Lock()
+        self._stats = {"rejected": 0, "opened": 0, "decreases": 0}
+
+    def is_open(self):
+        """True while the breaker turns every call away, without taking a half open probe."""
+        with self._lock:
+            return self.state == "open" and time.monotonic() - self._opened_at < self.open_seconds
+
+    def acquire(self):
+        """
+        Waits for a slot to call the destination.
+
+        :return: Permit to pass to release once the call is done, None if the call was turned away.
+        """
+        probe = self._admit()
+        if probe is None:
+            return None
+
+        event = threading.Event()
+        with self._lock:
+            if self._take_slot():
+                return time.monotonic(), probe
+            self._waiters.append(event.set)
+
+        if not event.wait(self.queue_timeout):
+            with self._lock:
+                # A slot handed over right as the wait ran out is still ours.
+                if not event.is_set():
+                    self._waiters.remove(event.set)
+                    return self._reject_queued(probe)
+        return time.monotonic(), probe
+
+    async def acquire_async(self):
+        """acquire for the async upload engine, waits for a slot without blocking the event loop."""
+        probe = self._admit()
+        if probe is None:
+            return None
+
+        loop = asyncio.get_running_loop()
+        slot = loop.create_future()
+        wake = lambda: loop.call_soon_threadsafe(_set_future, slot)
+        with self._lock:
+            if self._take_slot():
+                return time.monotonic(), probe
+            self._waiters.append(wake)
+
+        try:
+            await asyncio.wait_for(asyncio.shield(slot), self.queue_timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                if wake in self._waiters:
+                    self._waiters.remove(wake)
+                    return self._reject_queued(probe)
+        return time.monotonic(), probe
+
+    def release(self, permit, success, status=None):
+        """
+        Records how a call went and frees its slot.
+
+        :param permit: What acquire returned for the call.
+        :param success: Whether the call delivered.
+        :param status: HTTP status of the destination's last response, None if it never answered.
+        """
+        started, probe = permit
+        seconds = time.monotonic() - started
+        slow = bool(self.latency_threshold) and seconds > self.latency_threshold
+        struggling = slow or (status is None and not success) or (status is not None and (status == 429 or
+                                                                                          status >= 500))
+
+        with self._lock:
+            if probe:
+                self._probes -= 1
+
+            if struggling:
+                self._failures += 1
+                if self.state == "half_open" or (self.state == "closed" and self._failures >= self.failure_threshold):
+                    self._open(f"{self._failures} failed or slow calls, last took {seconds:.2f}s with status {status}")
+            else:
+                self._failures = 0
+                if self.state == "half_open":
+                    self.state = "closed"
+                    module_logger.warning(f"<<Circuit>> <<closed>> for {self.name}")
+
+            if self.adaptive_concurrency:
+                # Calls started before the last decrease saw the old limit, so they do not halve it again.
+                if struggling and started >= self._last_decrease:
+                    self.limit = max(float(self.min_concurrency), self.limit / 2)
+                    self._last_decrease = time.monotonic()
+                    self._stats["decreases"] += 1
+                    module_logger.debug(f"<<Concurrency>> for {self.name} lowered to {int(self.limit)}")
+                elif success and not struggling:
+                    self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+
+            self._in_flight -= 1
+            while self._waiters and self._take_slot():
+                self._waiters.popleft()()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, state=self.state, limit=int(self.limit), in_flight=self._in_flight,
+                        waiting=len(self._waiters))
+
+    def _admit(self):
+        """Checks the breaker state. Returns whether the call is a half open probe, None if it is turned away."""
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    return self._reject("circuit open")
+                self.state = "half_open"
+                self._probes = 0
+                module_logger.info(f"<<Circuit>> <<half>> <<open>> for {self.name}, probing")
+
+            if self.state == "half_open":
+                if self._probes >= self.half_open_probes:
+                    return self._reject("circuit half open, probe already running")
+                self._probes += 1
+                return True
+
+            return False
+
+    def _take_slot(self):
+        limit = int(self.limit) if self.adaptive_concurrency else self.max_concurrency
+        if self._in_flight < limit:
+            self._in_flight += 1
+            return True
+        return False
+
+    def _open(self, reason):
+        self.state = "open"
+        self._opened_at = time.monotonic()
+        self._stats["opened"] += 1
+        count("icad_tr_uploader_circuit_opened_total", destination=self.destination)
+        module_logger.warning(f"<<Circuit>> <<open>> for {self.name} for {self.open_seconds}s: {reason}")
+
+    def _reject(self, reason):
+        self._stats["rejected"] += 1
+        count("icad_tr_uploader_circuit_rejected_total", destination=self.destination)
+        module_logger.warning(f"<<Skipping>> {self.name}, {reason}")
+        return None
+
+    def _reject_queued(self, probe):
+        if probe:
+            self._probes -= 1
+        return self._reject(f"no free slot within {self.queue_timeout}s, concurrency limit {int(self.limit)}")
+
+
+def _set_future(future):
+    if not future.done():
+        future.set_result(None)
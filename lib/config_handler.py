@@ -1,29 +1,105 @@
 import json
 import logging
+import os
+import threading
 
 module_logger = logging.getLogger('icad_tr_uploader.config')
 
 default_config = {
     "log_level": 1,
+    "logging": {
+        "max_size_mb": 10,
+        "backup_count": 5,
+        "json_log_path": ""
+    },
     "temp_file_path": "/dev/shm",
+    "ingest_mode": "auto",
+    "destination_workers": 8,
+    "http": {
+        "pool_connections": 10,
+        "pool_maxsize": 10,
+        "connect_timeout": 5,
+        "read_timeout": 30,
+        "tcp_keepalive": 1,
+        "async_engine": 0,
+        "async_max_connections": 512
+    },
+    "daemon": {
+        "enabled": 0,
+        "socket_path": "/tmp/icad_tr_uploader.sock",
+        "socket_mode": "660",
+        "submit_timeout": 2,
+        "fallback_local": 1,
+        "max_workers": 4,
+        "max_queue_size": 100,
+        "queue_timeout": 1,
+        "system_concurrency": 2,
+        "config_check_interval": 5
+    },
+    "tone_detect_pool": {
+        "enabled": 0,
+        "max_workers": 2,
+        "max_queue_size": 8,
+        "timeout": 30
+    },
+    "result_cache": {
+        "enabled": 0,
+        "max_entries": 1024,
+        "ttl_seconds": 600,
+        "silence_threshold_dbfs": -50
+    },
+    "metrics": {
+        "enabled": 0,
+        "listen_address": "127.0.0.1",
+        "port": 9464,
+        "textfile_path": "",
+        "talkgroup_labels": 0
+    },
+    "retry_spool": {
+        "enabled": 0,
+        "spool_path": "spool",
+        "max_attempts": 10,
+        "base_delay": 30,
+        "max_delay": 3600,
+        "max_age_hours": 24,
+        "max_size_mb": 512,
+        "retry_interval": 30,
+        "retries_per_call": 5
+    },
+    "circuit_breaker": {
+        "enabled": 0,
+        "failure_threshold": 5,
+        "latency_threshold": 30,
+        "open_seconds": 30,
+        "half_open_probes": 1,
+        "adaptive_concurrency": 1,
+        "min_concurrency": 1,
+        "max_concurrency": 16,
+        "queue_timeout": 30
+    },
     "systems": {
         "example-system": {
+            "max_concurrent_calls": 0,
             "archive": {
                 "enabled": 0,
                 "archive_type": "scp",
                 "archive_path": "",
                 "archive_days": 0,
+                "cleanup_interval": 3600,
                 "archive_extensions": [".wav", ".m4a", ".json"],
                 "google_cloud": {
                     "project_id": "",
                     "bucket_name": "",
-                    "credentials_file": ""
+                    "credentials_file": "",
+                    "cache_control": ""
                 },
                 "aws_s3": {
                     "access_key_id": "",
                     "secret_access_key": "",
                     "bucket_name": "",
-                    "region": ""
+                    "region": "",
+                    "endpoint_url": "",
+                    "cache_control": ""
                 },
                 "scp": {
                     "host": "",
@@ -31,6 +107,8 @@ default_config = {
                     "user": "",
                     "password": "",
                     "private_key_path": "",
+                    "max_connections": 4,
+                    "idle_timeout": 300,
                     "base_url": "https://example.com/audio"
                 },
                 "local": {
@@ -40,7 +118,13 @@ default_config = {
             "audio_compression": {
                 "enabled": 0,
                 "sample_rate": 16000,
-                "bitrate": 96
+                "bitrate": 96,
+                "backend": "auto",
+                "renditions": []
+            },
+            "audio_analysis": {
+                "enabled": 0,
+                "silence_threshold_dbfs": -50
             },
             "icad_tone_detect_legacy": [
                 {
@@ -59,29 +143,49 @@ default_config = {
                 "tone_b_min_length": 2.8,
                 "long_tone_min_length": 2.0,
                 "hi_low_interval": 0.2,
-                "hi_low_min_alternations": 3
+                "hi_low_min_alternations": 3,
+                "prefilter": {
+                    "enabled": 0,
+                    "min_tone_length": 0,
+                    "energy_floor_dbfs": -45,
+                    "tonality": 0.6,
+                    "band_low": 250,
+                    "band_high": 3000,
+                    "audit_rate": 0.0
+                }
             },
             "transcribe": {
                 "enabled": 0,
                 "allowed_talkgroups": ["*"],
                 "api_url": "",
-                "api_key": ""
+                "api_key": "",
+                "async": 0,
+                "batch": {
+                    "enabled": 0,
+                    "batch_api_url": "",
+                    "max_batch_size": 8,
+                    "max_wait_ms": 500,
+                    "idle_ms": 100
+                }
             },
             "openmhz": {
                 "enabled": 0,
                 "short_name": "example",
-                "api_key": "example-api-key"
+                "api_key": "example-api-key",
+                "api_url": "https://api.openmhz.com"
             },
             "broadcastify_calls": {
                 "enabled": 0,
                 "calls_slot": -1,
                 "system_id": 0,
-                "api_key": ""
+                "api_key": "",
+                "api_url": "https://api.broadcastify.com/call-upload"
             },
             "icad_player": {
                 "enabled": 0,
                 "allowed_talkgroups": ["*"],
                 "api_url": "https://player.example.com/upload-audio",
+                "update_api_url": "",
                 "api_key": ""
             },
             "rdio_systems": [
@@ -173,13 +277,264 @@ def save_config_file(file_path, default_data):
         return None
 
 
-def get_talkgroup_config(talkgroup_config, call_data):
-    talkgroup_dec = call_data.get("talkgroup", 0)
-    talkgroup_config_data = {}  # Initialize as an empty dict
+class FrozenDict(dict):
+    """Read only dict, a config snapshot can be shared by every thread without anyone changing it underneath them."""
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Config snapshots are read only")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = __ior__ = _read_only
+
+    def __reduce__(self):
+        # Pickled for the tone detection workers, rebuilt without going through __setitem__.
+        return self.__class__, (dict(self),)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def freeze_config(config_data):
+    """Returns a read only copy of config_data, dicts become FrozenDicts and lists become tuples."""
+    if isinstance(config_data, dict):
+        return FrozenDict((key, freeze_config(value)) for key, value in config_data.items())
+    if isinstance(config_data, (list, tuple)):
+        return tuple(freeze_config(value) for value in config_data)
+    return config_data
+
+
+# Keys whose type can not be read off their default value in default_config.
+schema_overrides = {
+    "allowed_talkgroups": ("list", ("talkgroup", None)),
+    "talkgroups": ("list", ("talkgroup", None)),
+    "socket_mode": ("any", None),
+    "renditions": ("list", ("section", {"extension": ("string", None), "codec": ("string", None),
+                                        "bitrate": ("number", None), "sample_rate": ("number", None)})),
+}
+# Sections keyed by a name of the user's choosing, their default holds one example entry.
+named_sections = ("systems", "talkgroup_config")
+
+# Fields an enabled section can not work without.
+required_fields = {
+    "rdio_systems": ("rdio_url", "rdio_api_key", "system_id"),
+    "openmhz": ("short_name", "api_key"),
+    "broadcastify_calls": ("api_key", "system_id"),
+    "icad_player": ("api_url",),
+    "transcribe": ("api_url",),
+    "icad_tone_detect_legacy": ("icad_url",),
+}
+archive_required_fields = {
+    "google_cloud": ("project_id", "bucket_name", "credentials_file"),
+    "aws_s3": ("access_key_id", "secret_access_key", "bucket_name"),
+    "scp": ("host",),
+    "local": (),
+}
+choice_fields = {
+    "ingest_mode": ("auto", "move", "copy", "in_place"),
+    "backend": ("auto", "pyav", "ffmpeg"),
+    "archive_type": tuple(archive_required_fields),
+}
+
+
+def compile_config_schema(template=None, key=None):
+    """
+    Compiles the validation schema from default_config, so every section it has is checked.
+
+    Each node is a tuple of (kind, detail): ("section", {key: node}) for sections with fixed keys, ("named", node) for
+    sections keyed by name such as systems, ("list", node), and ("number", None), ("flag", None), ("string", None),
+    ("boolean", None), ("talkgroup", None) or ("any", None) for values.
+    """
+    if template is None and key is None:
+        template = default_config
+
+    if key in schema_overrides:
+        return schema_overrides[key]
+    if isinstance(template, dict) and key in named_sections:
+        return "named", compile_config_schema(next(iter(template.values()), None))
+    if isinstance(template, dict):
+        return "section", {child_key: compile_config_schema(value, child_key) for child_key, value in template.items()}
+    if isinstance(template, list):
+        return "list", compile_config_schema(template[0]) if template else ("any", None)
+    if isinstance(template, bool):
+        return "boolean", None
+    if key == "enabled" or key == "async":
+        return "flag", None
+    if isinstance(template, (int, float)):
+        return "number", None
+    if isinstance(template, str):
+        return "string", None
+    return "any", None
+
+
+config_schema = compile_config_schema()
+
+
+def validate_config(config_data, schema=None):
+    """
+    Checks a loaded config against the schema compiled from default_config, then checks that enabled sections have
+    the fields they need. Missing keys are fine, their defaults are used.
+
+    :return: List of error messages, empty if the config is valid.
+    """
+    if not isinstance(config_data, dict):
+        return ["config is not a JSON object"]
+
+    errors = []
+    _validate_value(config_data, schema or config_schema, "config", errors)
+
+    if config_data.get("log_level", 1) not in (1, 2, 3, 4, 5):
+        errors.append(f"config.log_level: must be 1 to 5, got {config_data.get('log_level')!r}")
+    _check_choice(config_data, "ingest_mode", "config", errors)
+
+    for system_short_name, system_config in (config_data.get("systems") or {}).items():
+        if isinstance(system_config, dict):
+            _validate_system(system_config, f"config.systems.{system_short_name}", errors)
+
+    return errors
+
+
+def _validate_system(system_config, path, errors):
+    for section, fields in required_fields.items():
+        entries = system_config.get(section)
+        for index, entry in enumerate(entries if isinstance(entries, list) else [entries]):
+            entry_path = f"{path}.{section}[{index}]" if isinstance(entries, list) else f"{path}.{section}"
+            if isinstance(entry, dict) and entry.get("enabled", 0) == 1:
+                errors.extend(f"{entry_path}.{field}: required when enabled" for field in fields if
+                              entry.get(field) in (None, ""))
+
+    compression_config = system_config.get("audio_compression")
+    if isinstance(compression_config, dict):
+        _check_choice(compression_config, "backend", f"{path}.audio_compression", errors)
+
+    archive_config = system_config.get("archive")
+    if isinstance(archive_config, dict) and archive_config.get("enabled", 0) == 1:
+        archive_type = archive_config.get("archive_type", "")
+        if archive_type not in archive_required_fields:
+            errors.append(f"{path}.archive.archive_type: must be one of {', '.join(archive_required_fields)}, got "
+                          f"{archive_type!r}")
+            return
+        if archive_type not in ("google_cloud", "aws_s3") and not archive_config.get("archive_path"):
+            errors.append(f"{path}.archive.archive_path: required for {archive_type} archives")
+        storage_config = archive_config.get(archive_type)
+        if not isinstance(storage_config, dict):
+            errors.append(f"{path}.archive.{archive_type}: section required for {archive_type} archives")
+            return
+        errors.extend(f"{path}.archive.{archive_type}.{field}: required for {archive_type} archives" for field in
+                      archive_required_fields[archive_type] if storage_config.get(field) in (None, ""))
+
+
+def _check_choice(section_config, key, path, errors):
+    if key in section_config and section_config[key] not in choice_fields[key]:
+        errors.append(f"{path}.{key}: must be one of {', '.join(choice_fields[key])}, got {section_config[key]!r}")
+
+
+def _validate_value(value, schema, path, errors):
+    kind, detail = schema
+    if kind == "any":
+        return
+
+    if kind == "section":
+        if not isinstance(value, dict):
+            errors.append(f"{path}: expected a JSON object, got {type(value).__name__}")
+            return
+        for key, child_schema in detail.items():
+            if key in value:
+                _validate_value(value[key], child_schema, f"{path}.{key}", errors)
+    elif kind == "named":
+        if not isinstance(value, dict):
+            errors.append(f"{path}: expected a JSON object, got {type(value).__name__}")
+            return
+        for key, child in value.items():
+            _validate_value(child, detail, f"{path}.{key}", errors)
+    elif kind == "list":
+        if not isinstance(value, (list, tuple)):
+            errors.append(f"{path}: expected a list, got {type(value).__name__}")
+            return
+        for index, child in enumerate(value):
+            _validate_value(child, detail, f"{path}[{index}]", errors)
+    elif kind == "flag":
+        if value not in (0, 1):
+            errors.append(f"{path}: expected 0 or 1, got {value!r}")
+    elif kind == "number":
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            errors.append(f"{path}: expected a number, got {type(value).__name__}")
+    elif kind == "string":
+        if not isinstance(value, str):
+            errors.append(f"{path}: expected a string, got {type(value).__name__}")
+    elif kind == "boolean":
+        if not isinstance(value, bool):
+            errors.append(f"{path}: expected true or false, got {type(value).__name__}")
+    elif kind == "talkgroup":
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            errors.append(f"{path}: expected a talkgroup number or pattern, got {type(value).__name__}")
+
+
+class ConfigManager:
+    """
+    Holds the current config snapshot, validated and frozen.
+
+    reload swaps in a new snapshot only once the file has loaded and validated, otherwise the errors are logged and
+    the old snapshot stays. Callers take current once per call and keep using that snapshot, so a reload never
+    changes the config underneath a call that is in flight.
+    """
+
+    def __init__(self, file_path, on_reload=None):
+        """
+        :param on_reload: Callable run with the new snapshot after every successful reload.
+        """
+        self.file_path = file_path
+        self.on_reload = on_reload
+        self.current = None
+        self._file_state = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        Loads, validates and freezes the config file.
+
+        :return: True if the new snapshot is in place, False if it failed to load or validate.
+        """
+        with self._lock:
+            file_state = self._stat()
+            config_data = load_config_file(self.file_path)
+            if config_data is None:
+                return False
+
+            errors = validate_config(config_data)
+            if errors:
+                for error in errors:
+                    module_logger.error(f"<<Config>> <<error>> {error}")
+                module_logger.error(f"<<Config>> {self.file_path} has {len(errors)} errors, not loaded")
+                # Remembered so the same broken file is not reported again until it changes.
+                self._file_state = file_state
+                return False
+
+            self.current = freeze_config(config_data)
+            self._file_state = file_state
+        return True
+
+    def reload(self):
+        """Loads the config file again, the old snapshot stays in place if the new one is invalid."""
+        # load_config_file would write a default config in place of a missing file.
+        if not os.path.isfile(self.file_path) or not self.load():
+            module_logger.warning("<<Config>> <<reload>> <<failed>> - keeping the running config")
+            return False
+
+        module_logger.info(f"<<Config>> <<reloaded>> from {self.file_path}")
+        if self.on_reload:
+            self.on_reload(self.current)
+        return True
+
+    def changed(self):
+        """True if the config file changed since it was last loaded."""
+        return self._stat() != self._file_state
 
-    # Determine the appropriate talkgroup configuration
-    if talkgroup_dec > 0 and talkgroup_config:
-        talkgroup_dec_str = str(talkgroup_dec)
-        talkgroup_config_data = talkgroup_config.get(talkgroup_dec_str) or talkgroup_config.get("*", {})
+    def _stat(self):
+        try:
+            file_stat = os.stat(self.file_path)
+        except OSError:
+            return None
+        return file_stat.st_mtime_ns, file_stat.st_size
 
-    return talkgroup_config_data
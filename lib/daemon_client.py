@@ -0,0 +1,50 @@
+import json
+import logging
+import socket
+
+module_logger = logging.getLogger('icad_tr_uploader.daemon_client')
+
+
+def submit_call(socket_path, system_short_name, audio_wav_path, timeout=2):
+    """
+    Submits a call to a running uploader daemon over its Unix domain socket.
+
+    Kept free of any heavy imports so the per-call client started by trunk-recorder exits quickly.
+
+    :return: True if the daemon accepted the call, False if it is unreachable or rejected it.
+    """
+    job = {
+        "system_short_name": system_short_name,
+        "audio_wav_path": audio_wav_path
+    }
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(timeout)
+            client.connect(socket_path)
+            client.sendall(json.dumps(job).encode('utf-8') + b"\n")
+
+            with client.makefile('rb') as reader:
+                response_line = reader.readline()
+    except (FileNotFoundError, ConnectionRefusedError):
+        module_logger.warning(f"<<Daemon>> not running at {socket_path}")
+        return False
+    except socket.timeout:
+        module_logger.error(f"<<Daemon>> <<timed>> <<out>> accepting call at {socket_path}")
+        return False
+    except OSError as e:
+        module_logger.error(f"<<Daemon>> <<socket>> <<error>> at {socket_path}: {e}")
+        return False
+
+    try:
+        response = json.loads(response_line)
+    except json.JSONDecodeError:
+        module_logger.error(f"<<Daemon>> returned an invalid response: {response_line!r}")
+        return False
+
+    if response.get("status") != "queued":
+        module_logger.error(f"<<Daemon>> <<rejected>> call {audio_wav_path}: {response.get('message', '')}")
+        return False
+
+    module_logger.info(f"<<Call>> <<submitted>> to daemon: {audio_wav_path}")
+    return True
@@ -0,0 +1,241 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import threading
+
+from lib.archive_handler import clean_archive_if_due
+from lib.call_processor import process_call_job
+from lib.call_scheduler import CallScheduler
+from lib.circuit_breaker import configure_circuit_breakers, get_circuit_breaker_stats
+from lib.http_session_handler import configure_http_sessions
+from lib.metrics_handler import start_metrics_server, stop_metrics_server
+from lib.remote_storage_handler import clear_archive_class_cache, prune_archive_classes
+from lib.result_cache import get_result_cache
+from lib.retry_spool import get_retry_spool
+from lib.routing_handler import compile_routing_tables
+from lib.tone_detect_handler import start_tone_detect_pool, stop_tone_detect_pool
+from lib.transcribe_handler import stop_transcribe_batchers
+from lib.upload_engine import configure_upload_engine, stop_upload_engine
+
+module_logger = logging.getLogger('icad_tr_uploader.daemon')
+
+
+class _SubmitHandler(socketserver.StreamRequestHandler):
+    """Reads one JSON encoded job per connection and replies with a one line JSON status."""
+
+    def handle(self):
+        try:
+            job = json.loads(self.rfile.readline())
+            system_short_name = job["system_short_name"]
+            audio_wav_path = job["audio_wav_path"]
+        except (json.JSONDecodeError, KeyError, TypeError) as e:
+            self._reply({"status": "error", "message": f"Invalid job: {e}"})
+            return
+
+        if not system_short_name or not audio_wav_path:
+            self._reply({"status": "error", "message": "System short name and WAV path are required."})
+            return
+
+        if self.server.uploader_daemon.submit(system_short_name, audio_wav_path):
+            self._reply({"status": "queued"})
+        else:
+            self._reply({"status": "error", "message": "Call queue is full."})
+
+    def _reply(self, response):
+        try:
+            self.wfile.write(json.dumps(response).encode('utf-8') + b"\n")
+        except OSError as e:
+            module_logger.warning(f"<<Daemon>> could not reply to client: {e}")
+
+
+class _UnixSubmitServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, uploader_daemon):
+        self.uploader_daemon = uploader_daemon
+        super().__init__(socket_path, _SubmitHandler)
+
+
+class UploaderDaemon:
+    """
+    Resident uploader. Config, loggers and storage clients are loaded once and every call submitted over the
+    Unix domain socket is handed to process_call_job on the call scheduler's worker pool.
+
+    The config is reloaded when its file changes or on request_reload. Each call keeps the snapshot it started with.
+    The socket, worker pool, queue and tone detection pool are set up once and need a restart to change.
+    """
+
+    def __init__(self, config_manager):
+        self.config_manager = config_manager
+        config_data = config_manager.current
+        daemon_config = config_data.get("daemon", {})
+        self.socket_path = daemon_config.get("socket_path", "/tmp/icad_tr_uploader.sock")
+        self.socket_mode = int(str(daemon_config.get("socket_mode", "660")), 8)
+        self.queue_timeout = daemon_config.get("queue_timeout", 1)
+        self.scheduler = CallScheduler(self._process_job,
+                                       max_workers=daemon_config.get("max_workers", 4),
+                                       max_queue_size=daemon_config.get("max_queue_size", 100),
+                                       system_limit=self._system_limit)
+        self._server = None
+        self._server_thread = None
+        self._retry_thread = None
+        self._sweep_thread = None
+        self._config_thread = None
+        self._stop_event = threading.Event()
+        self._reload_event = threading.Event()
+
+    @property
+    def config_data(self):
+        return self.config_manager.current
+
+    def start(self):
+        self._remove_stale_socket()
+        configure_http_sessions(self.config_data.get("http", {}))
+        configure_upload_engine(self.config_data.get("http", {}))
+        configure_circuit_breakers(self.config_data.get("circuit_breaker", {}))
+        compile_routing_tables(self.config_data)
+
+        self._server = _UnixSubmitServer(self.socket_path, self)
+        os.chmod(self.socket_path, self.socket_mode)
+
+        if self.config_data.get("tone_detect_pool", {}).get("enabled", 0) == 1:
+            start_tone_detect_pool(self.config_data.get("tone_detect_pool", {}))
+
+        if self.config_data.get("metrics", {}).get("enabled", 0) == 1:
+            start_metrics_server(self.config_data.get("metrics", {}))
+
+        self.scheduler.start()
+
+        self._sweep_thread = threading.Thread(target=self._sweep_loop, name="archive-sweeper", daemon=True)
+        self._sweep_thread.start()
+
+        self._config_thread = threading.Thread(target=self._config_loop, name="config-watcher", daemon=True)
+        self._config_thread.start()
+
+        if get_retry_spool(self.config_data):
+            self._retry_thread = threading.Thread(target=self._retry_loop, name="retry-spool", daemon=True)
+            self._retry_thread.start()
+
+        self._server_thread = threading.Thread(target=self._server.serve_forever, name="submit-server", daemon=True)
+        self._server_thread.start()
+
+        module_logger.info(f"<<Daemon>> <<listening>> on {self.socket_path}")
+
+    def submit(self, system_short_name, audio_wav_path):
+        # Blocks the submitting client while the queue is full, which is the backpressure trunk-recorder sees.
+        if not self.scheduler.submit(system_short_name, audio_wav_path, timeout=self.queue_timeout):
+            module_logger.error(f"<<Call>> <<queue>> <<full>>, rejecting {audio_wav_path}")
+            return False
+
+        module_logger.debug(f"Queued call {audio_wav_path} for {system_short_name}")
+        return True
+
+    def request_reload(self):
+        """Asks the config watcher to reload the config, safe to call from a signal handler."""
+        self._reload_event.set()
+
+    def shutdown(self):
+        """Stops accepting calls, then waits for every queued call to finish processing."""
+        module_logger.info("<<Daemon>> <<shutting>> <<down>>")
+
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        self.scheduler.shutdown()
+        stop_tone_detect_pool()
+        stop_transcribe_batchers()
+        if get_result_cache(self.config_data):
+            module_logger.info(f"<<Result>> <<Cache>> {get_result_cache(self.config_data).stats()}")
+
+        stop_upload_engine()
+        if get_circuit_breaker_stats():
+            module_logger.info(f"<<Circuit>> <<Breakers>> {get_circuit_breaker_stats()}")
+        stop_metrics_server()
+
+        self._stop_event.set()
+        self._reload_event.set()
+        if self._config_thread:
+            self._config_thread.join()
+            self._config_thread = None
+        if self._retry_thread:
+            self._retry_thread.join()
+            self._retry_thread = None
+        if self._sweep_thread:
+            self._sweep_thread.join()
+            self._sweep_thread = None
+        clear_archive_class_cache()
+
+        module_logger.info("<<Daemon>> <<stopped>>")
+
+    def _process_job(self, system_short_name, audio_wav_path):
+        # The call runs on the snapshot current when it started, even if the config is reloaded meanwhile.
+        process_call_job(self.config_data, system_short_name, audio_wav_path, retry_spooled=False,
+                         clean_archive=False)
+
+    def _retry_loop(self):
+        retry_interval = self.config_data.get("retry_spool", {}).get("retry_interval", 30)
+        while not self._stop_event.wait(retry_interval):
+            retry_spool = get_retry_spool(self.config_data)
+            if not retry_spool:
+                continue
+            try:
+                retry_spool.retry_due(self.config_data)
+                retry_spool.enforce_limits()
+            except Exception as e:
+                module_logger.error(f"<<Retry>> <<Spool>> <<error>>: {e}", exc_info=True)
+
+    def _config_loop(self):
+        while not self._stop_event.is_set():
+            check_interval = self.config_data.get("daemon", {}).get("config_check_interval", 5)
+            requested = self._reload_event.wait(check_interval if check_interval > 0 else None)
+            self._reload_event.clear()
+            if self._stop_event.is_set():
+                return
+            if requested or (check_interval > 0 and self.config_manager.changed()):
+                if self.config_manager.reload():
+                    compile_routing_tables(self.config_data)
+                    prune_archive_classes([system_config.get("archive", {}) for system_config
+                                           in self.config_data.get("systems", {}).values()])
+
+    def _sweep_loop(self):
+        # Wakes up often, clean_archive_if_due only sweeps a system once its cleanup_interval has passed.
+        while not self._stop_event.wait(60):
+            for system_short_name, system_config in self.config_data.get("systems", {}).items():
+                if self._stop_event.is_set():
+                    return
+                try:
+                    clean_archive_if_due(system_config.get("archive", {}), system_short_name,
+                                         self.config_data.get("temp_file_path", "/dev/shm"))
+                except Exception as e:
+                    module_logger.error(f"<<Archive>> <<cleanup>> <<error>> for {system_short_name}: {e}",
+                                        exc_info=True)
+
+    def _system_limit(self, system_short_name):
+        system_config = self.config_data.get("systems", {}).get(system_short_name, {})
+        return system_config.get("max_concurrent_calls", 0) or self.config_data.get("daemon", {}).get(
+            "system_concurrency", 0)
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.socket_path):
+            return
+
+        if not stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+            raise RuntimeError(f"Socket path {self.socket_path} exists and is not a socket.")
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(self.socket_path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.remove(self.socket_path)
+                module_logger.debug(f"Removed stale daemon socket {self.socket_path}")
+                return
+
+        raise RuntimeError(f"Another daemon is already listening on {self.socket_path}.")
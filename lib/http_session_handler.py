@@ -0,0 +1,106 @@
+import contextvars
+import logging
+import socket
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+module_logger = logging.getLogger('icad_tr_uploader.http_session')
+
+default_http_config = {
+    "pool_connections": 10,
+    "pool_maxsize": 10,
+    "connect_timeout": 5,
+    "read_timeout": 30,
+    "tcp_keepalive": 1
+}
+
+_http_config = dict(default_http_config)
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# Status of the last response the current upload got, lets a circuit breaker tell a struggling server from a 4xx.
+_response_status = contextvars.ContextVar("icad_tr_uploader_response_status", default=None)
+
+
+class KeepAliveHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that turns on TCP keep-alive so idle pooled connections survive NAT and firewall timeouts."""
+
+    def __init__(self, tcp_keepalive=True, **kwargs):
+        self.tcp_keepalive = tcp_keepalive
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.tcp_keepalive:
+            kwargs["socket_options"] = HTTPConnection.default_socket_options + [
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        super().init_poolmanager(*args, **kwargs)
+
+
+def configure_http_sessions(http_config):
+    """Sets the pool and timeout defaults. Existing sessions are closed if the pool settings change."""
+    global _http_config
+
+    new_config = dict(default_http_config)
+    new_config.update(http_config or {})
+
+    with _sessions_lock:
+        if new_config == _http_config:
+            return
+
+        _http_config = new_config
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+    module_logger.debug(f"HTTP session pools configured: {new_config}")
+
+
+def get_session(url):
+    """Returns the shared keep-alive session for the scheme and host of url."""
+    url_parts = urlsplit(url)
+    session_key = f"{url_parts.scheme}://{url_parts.netloc}"
+
+    with _sessions_lock:
+        session = _sessions.get(session_key)
+        if session is None:
+            adapter = KeepAliveHTTPAdapter(tcp_keepalive=_http_config.get("tcp_keepalive", 1) == 1,
+                                           pool_connections=_http_config.get("pool_connections", 10),
+                                           pool_maxsize=_http_config.get("pool_maxsize", 10),
+                                           max_retries=0)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.hooks["response"].append(record_response_status)
+            _sessions[session_key] = session
+            module_logger.debug(f"Created HTTP session for {session_key}")
+
+    return session
+
+
+def record_response_status(response, *args, **kwargs):
+    """requests response hook, also used by the async upload engine with the status of an aiohttp response."""
+    _response_status.set(getattr(response, "status_code", None) or getattr(response, "status", None))
+
+
+def clear_response_status():
+    _response_status.set(None)
+
+
+def last_response_status():
+    return _response_status.get()
+
+
+def get_timeout(destination_config=None, connect_timeout=None, read_timeout=None):
+    """
+    Returns the (connect, read) timeout tuple for a destination.
+
+    Timeouts set in the destination's own config win, then the handler's defaults passed in here, then the global
+    http section.
+    """
+    destination_config = destination_config or {}
+    return (destination_config.get("connect_timeout") or connect_timeout or _http_config.get("connect_timeout", 5),
+            destination_config.get("read_timeout") or read_timeout or _http_config.get("read_timeout", 30))
@@ -1,6 +1,9 @@
 import requests
 import logging
 
+from lib.http_session_handler import get_session, get_timeout
+from lib.upload_engine import aiohttp, get_client_session, get_client_timeout
+
 module_logger = logging.getLogger('icad_tr_uploader.icad_player')
 
 
@@ -9,7 +12,7 @@ def upload_to_icad_player(player_config, call_data):
     module_logger.info(f'Uploading To iCAD Player: {url}')
 
     try:
-        response = requests.post(url, json=call_data)
+        response = get_session(url).post(url, json=call_data, timeout=get_timeout(player_config))
 
         response.raise_for_status()
         module_logger.info(
@@ -23,3 +26,45 @@ def upload_to_icad_player(player_config, call_data):
         module_logger.error(f'An unexpected error occurred while upload to iCAD Player {url}: {e}')
 
     return False
+
+
+async def upload_to_icad_player_async(player_config, call_data):
+    """upload_to_icad_player for the async upload engine."""
+    url = player_config['api_url']
+    module_logger.info(f'Uploading To iCAD Player: {url}')
+
+    try:
+        async with get_client_session().post(url, json=call_data,
+                                             timeout=get_client_timeout(player_config)) as response:
+            response.raise_for_status()
+        module_logger.info(f"Successfully uploaded to iCAD Player: {url}")
+        return True
+    except aiohttp.ClientError as e:
+        module_logger.error(f'Failed Uploading To iCAD Player: {e}')
+    except Exception as e:
+        module_logger.error(f'An unexpected error occurred while upload to iCAD Player {url}: {e}')
+
+    return False
+
+
+def update_icad_player(player_config, call_data):
+    """Sends call data that changed after the upload, like a transcript that arrived later, to the update URL."""
+    url = player_config.get('update_api_url', '')
+    if not url:
+        module_logger.warning('No iCAD Player update_api_url set, can not send call update')
+        return False
+
+    module_logger.info(f'Updating iCAD Player call: {url}')
+
+    try:
+        response = get_session(url).patch(url, json=call_data, timeout=get_timeout(player_config))
+
+        response.raise_for_status()
+        module_logger.info(f"Successfully updated iCAD Player call: {url}")
+        return True
+    except requests.exceptions.RequestException as e:
+        module_logger.error(f'Failed Updating iCAD Player call: {e}')
+    except Exception as e:
+        module_logger.error(f'An unexpected error occurred while updating iCAD Player call {url}: {e}')
+
+    return False
@@ -4,22 +4,26 @@ import os
 import requests
 import logging
 
+from lib.http_session_handler import get_session, get_timeout
+from lib.upload_engine import aiohttp, build_form_data, get_client_session, get_client_timeout
+
 module_logger = logging.getLogger('icad_tr_uploader.icad_uploader')
 
 
-def upload_to_icad_legacy(icad_data, wav_file_path, call_data):
+def upload_to_icad_legacy(icad_data, call_audio, call_data):
     module_logger.info(f'Uploading to <<iCAD>> <<Tone>> <<Detect>> Legacy: {icad_data["icad_url"]}')
 
     if not call_data:
         module_logger.error('<<Failed>> uploading to <<iCAD>> <<Tone>> <<Detect>> Legacy: Empty call_data JSON')
         return False
 
+    wav_file_path = call_audio.path(".wav")
     try:
-        with open(wav_file_path, 'rb') as audio_file:
-            files = {'file': (wav_file_path, audio_file, 'audio/x-wav')}
-            response = requests.post(icad_data['icad_url'], files=files, data=call_data)
-            response.raise_for_status()  # This will raise an error for 4xx and 5xx responses
-            return True
+        files = {'file': (wav_file_path, call_audio.reader(".wav"), 'audio/x-wav')}
+        response = get_session(icad_data['icad_url']).post(icad_data['icad_url'], files=files, data=call_data,
+                                                           timeout=get_timeout(icad_data))
+        response.raise_for_status()  # This will raise an error for 4xx and 5xx responses
+        return True
 
     except FileNotFoundError:
         module_logger.error(f'<<iCAD>> <<Tone>> <<Detect>> Legacy - File not found : {wav_file_path}')
@@ -36,3 +40,34 @@ def upload_to_icad_legacy(icad_data, wav_file_path, call_data):
         module_logger.error(f'<<Unexpected>> <<Error>> while uploading to <<iCAD>> <<Tone>> <<Detect>> Legacy: {wav_file_path}, {e}')
 
     return False
+
+
+async def upload_to_icad_legacy_async(icad_data, call_audio, call_data):
+    """upload_to_icad_legacy for the async upload engine, the WAV is streamed from the call's shared buffer."""
+    module_logger.info(f'Uploading to <<iCAD>> <<Tone>> <<Detect>> Legacy: {icad_data["icad_url"]}')
+
+    if not call_data:
+        module_logger.error('<<Failed>> uploading to <<iCAD>> <<Tone>> <<Detect>> Legacy: Empty call_data JSON')
+        return False
+
+    wav_file_path = call_audio.path(".wav")
+    try:
+        files = {'file': (wav_file_path, call_audio.reader(".wav"), 'audio/x-wav')}
+        async with get_client_session().post(icad_data['icad_url'], data=build_form_data(call_data, files),
+                                             timeout=get_client_timeout(icad_data)) as response:
+            if response.status >= 400:
+                module_logger.error(
+                    f'<<HTTP>> <<error>> uploading to <<iCAD>> <<Tone>> <<Detect>> Legacy: {response.status}, {await response.text()}')
+                return False
+        return True
+
+    except FileNotFoundError:
+        module_logger.error(f'<<iCAD>> <<Tone>> <<Detect>> Legacy - File not found : {wav_file_path}')
+    except aiohttp.ClientError as e:
+        module_logger.error(f'<<Error>> <<uploading>> to <<iCAD>> <<Tone>> <<Detect>> Legacy: {e}')
+    except IOError as e:
+        module_logger.error(f'<<IO>> <<error>> with file: {wav_file_path}, {e}')
+    except Exception as e:
+        module_logger.error(f'<<Unexpected>> <<Error>> while uploading to <<iCAD>> <<Tone>> <<Detect>> Legacy: {wav_file_path}, {e}')
+
+    return False
@@ -1,56 +1,118 @@
+import atexit
+import contextvars
+import json
 import logging
+import logging.handlers
+import queue
+import re
+from contextlib import contextmanager
+
 from colorama import Fore, Style
-import datetime
+
+# <<word>> marks a word to highlight on the console, the file and JSON sinks drop the markers.
+highlight_pattern = re.compile(r"<<(\S+?)>>")
+
+log_levels = {1: logging.DEBUG, 2: logging.INFO, 3: logging.WARNING, 4: logging.ERROR, 5: logging.CRITICAL}
+
+# Fields of the call being processed by the current thread, added to every record so one call's lines can be found.
+_call_context = contextvars.ContextVar("icad_tr_uploader_call_context", default=None)
+
+
+@contextmanager
+def call_log_context(**fields):
+    """Tags every record logged inside the block, and in threads started with its context, with fields."""
+    token = _call_context.set({**(_call_context.get() or {}), **fields})
+    try:
+        yield
+    finally:
+        _call_context.reset(token)
+
+
+def update_call_log_context(**fields):
+    """Adds fields to the current call's context, e.g. the talkgroup once the call's metadata is loaded."""
+    context = _call_context.get()
+    if context is not None:
+        context.update(fields)
+
+
+def strip_highlights(message):
+    return highlight_pattern.sub(r"\1", message)
+
+
+class CallContextFilter(logging.Filter):
+    """Copies the current call's context onto the record, runs in the logging thread before the record is queued."""
+
+    def filter(self, record):
+        record.call_context = dict(_call_context.get() or {})
+        return True
 
 
 class ColoredFormatter(logging.Formatter):
-    COLOR_CODES = {
-        logging.DEBUG: Fore.CYAN,
-        logging.INFO: Fore.GREEN,
-        logging.WARNING: Fore.YELLOW,
-        logging.ERROR: Fore.RED,
-        logging.CRITICAL: Fore.MAGENTA,
+    # Level name, icon and color of each level.
+    level_styles = {
+        logging.DEBUG: ('DEBUG', '^', Fore.CYAN),
+        logging.INFO: ('INFO', '+', Fore.GREEN),
+        logging.WARNING: ('WARNING', '!', Fore.YELLOW),
+        logging.ERROR: ('ERROR', '#', Fore.RED),
+        logging.CRITICAL: ('CRITICAL', '*', Fore.MAGENTA),
     }
 
-    def format(self, record):
-        level_color = self.COLOR_CODES.get(record.levelno, '')
-        time = datetime.datetime.fromtimestamp(record.created).strftime('%Y-%m-%d %H:%M:%S')
+    def __init__(self, fmt='%(message)s'):
+        super().__init__(fmt, datefmt='%Y-%m-%d %H:%M:%S')
         reset = Style.RESET_ALL
-        if record.levelno == logging.DEBUG:
-            level_icon = f'[{Style.BRIGHT}{Fore.CYAN}^{reset}]'
-            level_name = 'DEBUG'
-            highlight_color = f'{Style.BRIGHT}{Fore.CYAN}'
-        elif record.levelno == logging.INFO:
-            level_icon = f'[{Style.BRIGHT}{Fore.GREEN}+{reset}]'
-            level_name = 'INFO'
-            highlight_color = f'{Style.BRIGHT}{Fore.GREEN}'
-        elif record.levelno == logging.WARNING:
-            level_icon = f'[{Style.BRIGHT}{Fore.YELLOW}!{reset}]'
-            level_name = 'WARNING'
-            highlight_color = f'{Style.BRIGHT}{Fore.YELLOW}'
-        elif record.levelno == logging.ERROR:
-            level_icon = f'[{Style.BRIGHT}{Fore.RED}#{reset}]'
-            level_name = 'ERROR'
-            highlight_color = f'{Style.BRIGHT}{Fore.RED}'
-        elif record.levelno == logging.CRITICAL:
-            level_icon = f'[{Style.BRIGHT}{Fore.MAGENTA}*{reset}]'
-            level_name = 'CRITICAL'
-            highlight_color = f'{Style.BRIGHT}{Fore.MAGENTA}'
-        else:
-            level_icon = ''
-            level_name = ''
-            highlight_color = ''
+        # The prefix and highlight of each level are built once instead of for every record.
+        self._prefixes = {level: f'{color}{name}:{reset} [{Style.BRIGHT}{color}{icon}{reset}]' for
+                          level, (name, icon, color) in self.level_styles.items()}
+        self._highlights = {level: f'{Style.BRIGHT}{color}\\1{reset}' for level, (name, icon, color) in
+                            self.level_styles.items()}
+
+    def format(self, record):
         message = super().format(record)
-        for word in message.split():
-            if word.startswith('<<') and word.endswith('>>'):
-                message = message.replace(word, f'{highlight_color}{word[2:-2]}{reset}')
-        return f'{time} {level_color}{level_name}:{reset} {level_icon} {message.replace(level_name + ": ", "")}'
+        if '<<' in message:
+            message = highlight_pattern.sub(self._highlights.get(record.levelno, r'\1'), message)
+        return f'{self.formatTime(record, self.datefmt)} {self._prefixes.get(record.levelno, "")} {message}'
+
+
+class PlainFormatter(logging.Formatter):
+    """Log file format, the highlight markers are dropped."""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s: %(message)s')
+
+    def format(self, record):
+        return strip_highlights(super().format(record))
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the call's context, for log shippers."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f'.{int(record.msecs):03d}',
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": strip_highlights(record.getMessage()),
+        }
+        entry.update(getattr(record, "call_context", None) or {})
+        return json.dumps(entry, default=str)
 
 
 class CustomLogger:
+    """
+    Sets up the application logger.
+
+    Records are put on a queue by the thread that logs them and written to the console, the log file and the optional
+    JSON log file by a background listener, so a slow disk or terminal never holds up a call. The queue is drained
+    when the process exits.
+
+    Only the daemon rotates the log files. In per call mode many uploader processes append to the same files at once
+    and a RotatingFileHandler in one of them would leave the others writing to the renamed file, so each process
+    reopens the files when they are moved away and rotation is left to logrotate.
+    """
     _loggers = {}
 
-    def __new__(cls, log_level, logger_name, log_path):
+    def __new__(cls, log_level, logger_name, log_path, logging_config=None):
         if logger_name not in cls._loggers:
             new_logger = super(CustomLogger, cls).__new__(cls)
             cls._loggers[logger_name] = new_logger
@@ -58,32 +120,80 @@ class CustomLogger:
         else:
             return cls._loggers[logger_name]
 
-    def __init__(self, log_level, logger_name, log_path):
+    def __init__(self, log_level, logger_name, log_path, logging_config=None):
         if hasattr(self, 'is_initialized'):
             # Logger already initialized, just update the log level
             self.set_log_level(log_level)
             return
 
+        self.log_path = log_path
         self.logger = logging.getLogger(logger_name)
-        self.logger.setLevel(
-            {1: logging.DEBUG, 2: logging.INFO, 3: logging.WARNING, 4: logging.ERROR, 5: logging.CRITICAL}.get(
-                log_level, logging.INFO))
-
-        console_handler = logging.StreamHandler()
-        file_handler = logging.FileHandler(log_path)
+        self.logger.setLevel(log_levels.get(log_level, logging.INFO))
 
-        formatter = ColoredFormatter('%(message)s')
-        console_handler.setFormatter(formatter)
-        file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+        self._queue = queue.SimpleQueue()
+        self._queue_handler = logging.handlers.QueueHandler(self._queue)
+        self._queue_handler.addFilter(CallContextFilter())
+        self.logger.addHandler(self._queue_handler)
 
-        self.logger.addHandler(console_handler)
-        self.logger.addHandler(file_handler)
+        self._handlers = []
+        self._listener = None
+        self._settings = None
+        self._rotate = False
+        self.configure(logging_config or {})
+        atexit.register(self.stop)
 
         self.is_initialized = True
 
+    def configure(self, logging_config, rotate=None):
+        """
+        Applies the logging section, the sinks are only rebuilt when their settings changed.
+
+        :param rotate: Rotate the log files at max_size_mb, only safe for the one process that owns them. None keeps
+            the current setting.
+        """
+        if rotate is not None:
+            self._rotate = rotate
+        settings = (logging_config.get("max_size_mb", 10), logging_config.get("backup_count", 5),
+                    logging_config.get("json_log_path", ""), self._rotate)
+        if settings == self._settings:
+            return
+
+        max_size_mb, backup_count, json_log_path, rotate = settings
+        handlers = [logging.StreamHandler()]
+        handlers[0].setFormatter(ColoredFormatter())
+
+        handlers.append(self._file_handler(self.log_path, max_size_mb, backup_count, rotate))
+        handlers[1].setFormatter(PlainFormatter())
+
+        if json_log_path:
+            handlers.append(self._file_handler(json_log_path, max_size_mb, backup_count, rotate))
+            handlers[2].setFormatter(JsonFormatter())
+
+        # Records logged while the listener is swapped wait on the queue for the new one.
+        self.stop()
+        self._handlers = handlers
+        self._settings = settings
+        self._listener = logging.handlers.QueueListener(self._queue, *self._handlers, respect_handler_level=True)
+        self._listener.start()
+        self.set_log_level(self.logger.level)
+
+    @staticmethod
+    def _file_handler(file_path, max_size_mb, backup_count, rotate):
+        if rotate:
+            return logging.handlers.RotatingFileHandler(file_path, maxBytes=int(max_size_mb * 1024 * 1024),
+                                                        backupCount=backup_count)
+        return logging.handlers.WatchedFileHandler(file_path)
+
+    def stop(self):
+        """Writes out every queued record and closes the sinks."""
+        if self._listener:
+            self._listener.stop()
+            self._listener = None
+        for handler in self._handlers:
+            handler.close()
+
     def set_log_level(self, log_level):
-        level = {1: logging.DEBUG, 2: logging.INFO, 3: logging.WARNING, 4: logging.ERROR, 5: logging.CRITICAL}.get(
-            log_level, logging.INFO)
+        level = log_levels.get(log_level, log_level if log_level in log_levels.values() else logging.INFO)
         self.logger.setLevel(level)
-        for handler in self.logger.handlers:
+        for handler in [self._queue_handler, *self._handlers]:
             handler.setLevel(level)
@@ -0,0 +1,252 @@
+import fcntl
+import http.server
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+module_logger = logging.getLogger('icad_tr_uploader.metrics')
+
+metric_families = {
+    "icad_tr_uploader_stage_seconds": ("histogram", "Time spent in each call processing stage."),
+    "icad_tr_uploader_stage_failures_total": ("counter", "Stages that failed."),
+    "icad_tr_uploader_calls_total": ("counter", "Calls processed."),
+    "icad_tr_uploader_bytes_sent_total": ("counter", "Bytes delivered to each destination."),
+    "icad_tr_uploader_spooled_total": ("counter", "Failed deliveries handed to the retry spool."),
+    "icad_tr_uploader_retries_total": ("counter", "Spooled deliveries retried, by outcome."),
+    "icad_tr_uploader_tone_prefilter_total": ("counter", "Calls screened by the tone prefilter, by outcome."),
+    "icad_tr_uploader_tone_prefilter_audits_total": ("counter",
+                                                     "Skipped calls detected anyway, false_skip if they had tones."),
+    "icad_tr_uploader_transcribe_batch_seconds": ("histogram", "Time to send a transcribe batch and get its answer."),
+    "icad_tr_uploader_transcribe_batch_wait_seconds": ("histogram", "Time a batch's first call waited for it to fill."),
+    "icad_tr_uploader_transcribe_batched_calls_total": ("counter", "Calls transcribed as part of a batch."),
+    "icad_tr_uploader_transcribe_single_calls_total": ("counter",
+                                                       "Batched calls sent alone, by reason: alone or fallback."),
+    "icad_tr_uploader_circuit_opened_total": ("counter", "Times a destination's circuit breaker opened."),
+    "icad_tr_uploader_circuit_rejected_total": ("counter", "Calls a destination's circuit breaker turned away."),
+}
+
+stage_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Samples keyed by their exposition line without the value, e.g. 'icad_tr_uploader_calls_total{system="x"}'. Every
+# sample is a count or a sum, so samples from another process can be merged by adding them up.
+_samples = {}
+_samples_lock = threading.Lock()
+_talkgroup_labels = False
+_metrics_server = None
+_stage_listeners = []
+
+
+def configure_metrics(metrics_config):
+    """Sets whether stage timings are labelled with the talkgroup, off by default to keep the series count down."""
+    global _talkgroup_labels
+    _talkgroup_labels = metrics_config.get("talkgroup_labels", 0) == 1
+
+
+def add_stage_listener(listener):
+    """Registers a callable run with the labels, seconds and failed flag of every stage span as it finishes."""
+    _stage_listeners.append(listener)
+
+
+def remove_stage_listener(listener):
+    if listener in _stage_listeners:
+        _stage_listeners.remove(listener)
+
+
+def count(name, amount=1, **labels):
+    key = _sample_key(name, labels)
+    with _samples_lock:
+        _samples[key] = _samples.get(key, 0) + amount
+
+
+def observe(name, value, buckets=stage_buckets, **labels):
+    bucket_keys = [_sample_key(f"{name}_bucket", dict(labels, le=_format_value(bucket))) for bucket in buckets]
+    bucket_keys.append(_sample_key(f"{name}_bucket", dict(labels, le="+Inf")))
+    with _samples_lock:
+        # Every bucket is added on first use so they are exposed in order, buckets are cumulative.
+        for bucket, bucket_key in zip(buckets + (float("inf"),), bucket_keys):
+            _samples[bucket_key] = _samples.get(bucket_key, 0) + (1 if value <= bucket else 0)
+        sum_key = _sample_key(f"{name}_sum", labels)
+        count_key = _sample_key(f"{name}_count", labels)
+        _samples[sum_key] = _samples.get(sum_key, 0) + value
+        _samples[count_key] = _samples.get(count_key, 0) + 1
+
+
+class StageSpan:
+    """Outcome of a timed stage, set failed when the stage did not do its job without raising."""
+
+    def __init__(self):
+        self.failed = False
+
+
+@contextmanager
+def stage_span(stage, system="", talkgroup="", destination=""):
+    """
+    Times a stage into icad_tr_uploader_stage_seconds and counts it as failed if it raised or the span was marked
+    failed.
+    """
+    labels = {"stage": stage, "system": system, "destination": destination}
+    if _talkgroup_labels:
+        labels["talkgroup"] = str(talkgroup)
+
+    span = StageSpan()
+    start = time.perf_counter()
+    try:
+        yield span
+    except Exception:
+        span.failed = True
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        observe("icad_tr_uploader_stage_seconds", seconds, **labels)
+        if span.failed:
+            count("icad_tr_uploader_stage_failures_total", **labels)
+        for listener in _stage_listeners:
+            listener(labels, seconds, span.failed)
+
+
+def timed_stage(stage, function, *args, system="", talkgroup="", destination="", **kwargs):
+    """Runs function inside a stage span, a falsy result counts as a failure. Returns the function's result."""
+    with stage_span(stage, system, talkgroup, destination) as span:
+        result = function(*args, **kwargs)
+        span.failed = not result
+        return result
+
+
+def render_metrics(samples=None):
+    """Returns the samples in the Prometheus text exposition format."""
+    if samples is None:
+        with _samples_lock:
+            samples = dict(_samples)
+
+    families = {}
+    for key, value in samples.items():
+        families.setdefault(_family_name(key), []).append((key, value))
+
+    lines = []
+    for family, family_samples in families.items():
+        metric_type, metric_help = metric_families.get(family, ("untyped", ""))
+        lines.append(f"# HELP {family} {metric_help}")
+        lines.append(f"# TYPE {family} {metric_type}")
+        lines.extend(f"{key} {_format_value(value)}" for key, value in family_samples)
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics_textfile(textfile_path):
+    """
+    Adds this process's samples to a node_exporter textfile collector file.
+
+    Every per call process adds to the same file, under a lock so concurrent calls do not lose each other's counts,
+    and the file is replaced atomically so the collector never reads half of it.
+    """
+    with _samples_lock:
+        samples = dict(_samples)
+    if not samples:
+        return True
+
+    try:
+        with open(textfile_path + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            merged = _read_textfile(textfile_path)
+            for key, value in samples.items():
+                merged[key] = merged.get(key, 0) + value
+
+            with open(textfile_path + ".tmp", "w") as textfile:
+                textfile.write(render_metrics(merged))
+            os.replace(textfile_path + ".tmp", textfile_path)
+    except OSError as e:
+        module_logger.error(f"<<Failed>> to write <<metrics>> to {textfile_path}: {e}")
+        return False
+
+    return True
+
+
+def start_metrics_server(metrics_config):
+    """Serves /metrics over HTTP from a background thread, for daemon mode."""
+    global _metrics_server
+    if _metrics_server is not None:
+        return _metrics_server
+
+    address = (metrics_config.get("listen_address", "127.0.0.1"), metrics_config.get("port", 9464))
+    try:
+        _metrics_server = http.server.ThreadingHTTPServer(address, _MetricsHandler)
+    except OSError as e:
+        module_logger.error(f"<<Failed>> to start <<metrics>> endpoint on {address[0]}:{address[1]}: {e}")
+        return None
+
+    _metrics_server.daemon_threads = True
+    threading.Thread(target=_metrics_server.serve_forever, name="metrics-server", daemon=True).start()
+    module_logger.info(f"<<Metrics>> served on http://{address[0]}:{address[1]}/metrics")
+    return _metrics_server
+
+
+def stop_metrics_server():
+    global _metrics_server
+    if _metrics_server is not None:
+        _metrics_server.shutdown()
+        _metrics_server.server_close()
+        _metrics_server = None
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        module_logger.debug(f"Metrics request {self.address_string()} {format % args}")
+
+
+def _read_textfile(textfile_path):
+    samples = {}
+    try:
+        with open(textfile_path, "r") as textfile:
+            for line in textfile:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                key, _, value = line.rpartition(" ")
+                try:
+                    samples[key] = float(value)
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return samples
+
+
+def _sample_key(name, labels):
+    if not labels:
+        return name
+    label_text = ",".join(f'{label}="{_escape(value)}"' for label, value in labels.items())
+    return f"{name}{{{label_text}}}"
+
+
+def _family_name(key):
+    name = key.split("{", 1)[0]
+    for suffix in ("_bucket", "_sum", "_count"):
+        if name.endswith(suffix) and name[:-len(suffix)] in metric_families:
+            return name[:-len(suffix)]
+    return name
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
@@ -1,15 +1,16 @@
-import os
-
 import requests
 import logging
 import json
 
 from requests_toolbelt.multipart.encoder import MultipartEncoder
 
+from lib.http_session_handler import get_session, get_timeout
+from lib.upload_engine import aiohttp, build_form_data, get_client_session, get_client_timeout
+
 module_logger = logging.getLogger('icad_tr_uploader.openmhz_uploader')
 
 
-def upload_to_openmhz(openmhz, m4a_file_path, call_data):
+def upload_to_openmhz(openmhz, call_audio, call_data):
     try:
         module_logger.info("Sending to OpenMHZ")
         api_key = openmhz.get('api_key')
@@ -26,7 +27,7 @@ def upload_to_openmhz(openmhz, m4a_file_path, call_data):
 
         multipart_data = MultipartEncoder(
             fields={
-                'call': (os.path.basename(m4a_file_path), open(m4a_file_path, 'rb'), 'application/octet-stream'),
+                'call': (call_audio.name(".m4a"), call_audio.reader(".m4a"), 'application/octet-stream'),
                 'freq': str(call_data['freq']),
                 'error_count': str(0),
                 'spike_count': str(0),
@@ -40,11 +41,12 @@ def upload_to_openmhz(openmhz, m4a_file_path, call_data):
             }
         )
 
-        session = requests.Session()
-        response = session.post(
-            url=f"https://api.openmhz.com/{short_name}/upload",
+        openmhz_url = f"{openmhz.get('api_url') or 'https://api.openmhz.com'}/{short_name}/upload"
+        response = get_session(openmhz_url).post(
+            url=openmhz_url,
             data=multipart_data,
-            headers={'User-Agent': 'TrunkRecorder1.0', 'Content-Type': multipart_data.content_type}
+            headers={'User-Agent': 'TrunkRecorder1.0', 'Content-Type': multipart_data.content_type},
+            timeout=get_timeout(openmhz)
         )
 
         if response.status_code == 200:
@@ -59,3 +61,48 @@ def upload_to_openmhz(openmhz, m4a_file_path, call_data):
     except Exception as e:
         module_logger.error(f"An unexpected <<error>> occurred while uploading to <<OpenMHZ>>: {e}")
         return False
+
+
+async def upload_to_openmhz_async(openmhz, call_audio, call_data):
+    """upload_to_openmhz for the async upload engine, the M4A is streamed from the call's shared buffer."""
+    try:
+        module_logger.info("Sending to OpenMHZ")
+        api_key = openmhz.get('api_key')
+        short_name = openmhz.get('short_name')
+
+        if not api_key or not short_name:
+            module_logger.error("Upload to <<OpenMHZ>> <<failed>> API Key or Short Name not provided in the <<OpenMHZ>> configuration.")
+            return False
+
+        source_list = [{"pos": source['pos'], "src": source['src']} for source in call_data.get('srcList') or []]
+
+        fields = {
+            'freq': str(call_data['freq']),
+            'error_count': str(0),
+            'spike_count': str(0),
+            'start_time': str(call_data['start_time']),
+            'stop_time': str(call_data['start_time'] + call_data["call_length"]),
+            'call_length': str(call_data["call_length"]),
+            'talkgroup_num': str(call_data["talkgroup"]),
+            'emergency': str(0),
+            'api_key': api_key,
+            'source_list': json.dumps(source_list)
+        }
+        files = {'call': (call_audio.name(".m4a"), call_audio.reader(".m4a"), 'application/octet-stream')}
+
+        openmhz_url = f"{openmhz.get('api_url') or 'https://api.openmhz.com'}/{short_name}/upload"
+        async with get_client_session().post(openmhz_url, data=build_form_data(fields, files),
+                                             headers={'User-Agent': 'TrunkRecorder1.0'},
+                                             timeout=get_client_timeout(openmhz)) as response:
+            if response.status == 200:
+                module_logger.info('Upload to <<OpenMHZ>> <<successful>>.')
+                return True
+            module_logger.error(f'Upload to <<OpenMHZ>> <<failed>> with status code {response.status}: {await response.text()}')
+            return False
+    except aiohttp.ClientError as e:
+        module_logger.error(f"Upload to <<OpenMHZ>> <<failed>>: {e}")
+        return False
+    except Exception as e:
+        module_logger.error(f"An unexpected <<error>> occurred while uploading to <<OpenMHZ>>: {e}")
+        return False
+
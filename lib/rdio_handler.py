@@ -1,50 +1,27 @@
 import json
-import os
 import time
 from datetime import datetime
 
 import requests
 import logging
 
+from lib.http_session_handler import get_session, get_timeout
+from lib.upload_engine import aiohttp, build_form_data, get_client_session, get_client_timeout
+
 module_logger = logging.getLogger('icad_tr_uploader.rdio_uploader')
 
 
-def upload_to_rdio(rdio_data, wav_file_path, call_data):
+def upload_to_rdio(rdio_data, call_audio, call_data):
     module_logger.info(f'Uploading To RDIO: {rdio_data["rdio_url"]}')
 
-    # Use context managers to automatically handle file opening and closing
     try:
+        files, data = _rdio_form(rdio_data, call_audio, call_data)
 
-        utc_time = datetime.utcfromtimestamp(call_data.get('start_time', time.time()))
-        formatted_time = utc_time.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-
-        with open(wav_file_path, 'rb') as audio_file:
-            files = {
-                'audio': (call_data['filename'], audio_file, 'audio/x-wav')
-            }
-
-            # Prepare additional data for the post request
-            data = {
-                "audioName": call_data['filename'],
-                "audioType": "audio/x-wav",
-                "dateTime": formatted_time,
-                "frequencies": json.dumps(call_data.get('freqList', [])),
-                "frequency": call_data['freq'],
-                "key": rdio_data['rdio_api_key'],
-                "patches": json.dumps(call_data.get('patches', [])),
-                "sources": json.dumps(call_data.get('srcList', [])),
-                "system": rdio_data['system_id'],
-                "systemLabel": call_data['short_name'],
-                "talkgroup": call_data['talkgroup'],
-                "talkgroupGroup": call_data['talkgroup_group'],
-                "talkgroupLabel": call_data['talkgroup_description'],
-                "talkgroupTag": call_data['talkgroup_tag']
-            }
-
-            response = requests.post(rdio_data['rdio_url'], files=files, data=data)
-            response.raise_for_status()  # This will raise an error for 4xx and 5xx responses
-            module_logger.info(f'Successfully uploaded to RDIO: {response.status_code}, {response.text}')
-            return True
+        response = get_session(rdio_data['rdio_url']).post(rdio_data['rdio_url'], files=files, data=data,
+                                                           timeout=get_timeout(rdio_data))
+        response.raise_for_status()  # This will raise an error for 4xx and 5xx responses
+        module_logger.info(f'Successfully uploaded to RDIO: {response.status_code}, {response.text}')
+        return True
     except FileNotFoundError as e:
         module_logger.error(f'RDIO {rdio_data["rdio_url"]} - File not found: {e}')
     except requests.exceptions.RequestException as e:
@@ -56,3 +33,53 @@ def upload_to_rdio(rdio_data, wav_file_path, call_data):
 
     return False
 
+
+
+async def upload_to_rdio_async(rdio_data, call_audio, call_data):
+    """upload_to_rdio for the async upload engine, the M4A is streamed from the call's shared buffer."""
+    module_logger.info(f'Uploading To RDIO: {rdio_data["rdio_url"]}')
+
+    try:
+        files, data = _rdio_form(rdio_data, call_audio, call_data)
+        async with get_client_session().post(rdio_data['rdio_url'], data=build_form_data(data, files),
+                                             timeout=get_client_timeout(rdio_data)) as response:
+            response_text = await response.text()
+            response.raise_for_status()
+        module_logger.info(f'Successfully uploaded to RDIO: {response.status}, {response_text}')
+        return True
+    except FileNotFoundError as e:
+        module_logger.error(f'RDIO {rdio_data["rdio_url"]} - File not found: {e}')
+    except aiohttp.ClientError as e:
+        module_logger.error(f'Failed Uploading To RDIO {rdio_data["rdio_url"]}: {e}')
+    except Exception as e:
+        module_logger.error(f'An unexpected error occurred while upload to RDIO {rdio_data["rdio_url"]}: {e}')
+
+    return False
+
+
+def _rdio_form(rdio_data, call_audio, call_data):
+    utc_time = datetime.utcfromtimestamp(call_data.get('start_time', time.time()))
+    formatted_time = utc_time.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+    files = {
+        'audio': (call_audio.name(".m4a"), call_audio.reader(".m4a"), 'audio/mp4')
+    }
+
+    # Prepare additional data for the post request
+    data = {
+        "audioName": call_audio.name(".m4a"),
+        "audioType": "audio/mp4",
+        "dateTime": formatted_time,
+        "frequencies": json.dumps(call_data.get('freqList', [])),
+        "frequency": call_data['freq'],
+        "key": rdio_data['rdio_api_key'],
+        "patches": json.dumps(call_data.get('patches', [])),
+        "sources": json.dumps(call_data.get('srcList', [])),
+        "system": rdio_data['system_id'],
+        "systemLabel": call_data['short_name'],
+        "talkgroup": call_data['talkgroup'],
+        "talkgroupGroup": call_data['talkgroup_group'],
+        "talkgroupLabel": call_data['talkgroup_description'],
+        "talkgroupTag": call_data['talkgroup_tag']
+    }
+    return files, data
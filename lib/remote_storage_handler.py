@@ -1,17 +1,21 @@
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
+import json
 import logging
 import mimetypes
 import os
 import shutil
+import threading
 import time
 import traceback
 from stat import S_ISDIR
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
 from google.cloud import storage
 from google.cloud.exceptions import GoogleCloudError
 from urllib.parse import urljoin, quote
 
 import boto3
+from botocore.config import Config as BotoConfig
 from botocore.exceptions import ClientError, NoCredentialsError, ParamValidationError
 
 from paramiko import SSHClient, AutoAddPolicy, RSAKey, SSHException
@@ -19,37 +23,159 @@ from paramiko import SSHClient, AutoAddPolicy, RSAKey, SSHException
 module_logger = logging.getLogger('icad_tr_uploader.file_storage')
 
 
-def get_archive_class(archive_config):
-    if archive_config.get("archive_type") == 'scp':
-        return SCPStorage(archive_config.get('scp'))
-    elif archive_config.get("archive_type") == 'google_cloud':
-        return GoogleCloudStorage(archive_config.get('google_cloud'))
-    elif archive_config.get("archive_type") == 'aws_s3':
-        return AWSS3Storage(archive_config.get('aws_s3'))
-    elif archive_config.get("archive_type") == 'local':
-        return LocalStorage(archive_config.get('local'))
-    else:
-        module_logger.error('Invalid remote storage type.')
-        return None
+_archive_classes = OrderedDict()
+_archive_classes_lock = threading.Lock()
+_archive_classes_max = 32
+
+
+@contextmanager
+def archive_class_for(archive_config):
+    """
+    Yields the archive backend for archive_config, shared by every call and worker using the same settings, or None
+    if it could not be started.
+
+    Backends are cached by archive type and the contents of that type's config, so a changed config builds a new
+    backend while an unchanged one keeps its clients, buckets and connections. Backends that failed to start are
+    not cached so the next call tries again. A backend that is evicted from the cache, or was never cached, closes
+    its clients once the last block using it has finished.
+    """
+    archive_type = archive_config.get("archive_type")
+    cache_key = _archive_class_key(archive_config)
+    evicted = []
+
+    with _archive_classes_lock:
+        archive_class = _archive_classes.get(cache_key)
+        if archive_class:
+            _archive_classes.move_to_end(cache_key)
+        else:
+            if archive_type == 'scp':
+                archive_class = SCPStorage(archive_config.get('scp'))
+            elif archive_type == 'google_cloud':
+                archive_class = GoogleCloudStorage(archive_config.get('google_cloud'))
+            elif archive_type == 'aws_s3':
+                archive_class = AWSS3Storage(archive_config.get('aws_s3'))
+            elif archive_type == 'local':
+                archive_class = LocalStorage(archive_config.get('local'))
+            else:
+                module_logger.error('Invalid remote storage type.')
+
+            if archive_class and archive_class.ready:
+                _archive_classes[cache_key] = archive_class
+                while len(_archive_classes) > _archive_classes_max:
+                    evicted.append(_archive_classes.popitem(last=False)[1])
+            elif archive_class:
+                archive_class.retired = True
+
+        if archive_class:
+            archive_class.users += 1
+        evicted = [evicted_class for evicted_class in evicted if _retire(evicted_class)]
+
+    _close_archive_classes(evicted)
+    try:
+        yield archive_class
+    finally:
+        if archive_class:
+            with _archive_classes_lock:
+                archive_class.users -= 1
+                idle_retired = archive_class.retired and archive_class.users == 0
+            if idle_retired:
+                _close_archive_classes([archive_class])
+
+
+def prune_archive_classes(archive_configs):
+    """Retires the cached backends none of archive_configs use any more, e.g. after the config was reloaded."""
+    keep_keys = {_archive_class_key(archive_config) for archive_config in archive_configs}
+    with _archive_classes_lock:
+        stale_keys = [cache_key for cache_key in _archive_classes if cache_key not in keep_keys]
+        retired = [_archive_classes.pop(cache_key) for cache_key in stale_keys]
+        idle = [archive_class for archive_class in retired if _retire(archive_class)]
+    _close_archive_classes(idle)
+
+
+def clear_archive_class_cache():
+    """Retires every cached backend, idle ones are closed right away."""
+    prune_archive_classes([])
+
+
+def _archive_class_key(archive_config):
+    archive_type = archive_config.get("archive_type")
+    return archive_type, json.dumps(archive_config.get(archive_type), sort_keys=True, default=str)
+
+
+def _retire(archive_class):
+    # Called holding _archive_classes_lock, True if nothing is using the backend so it can be closed now.
+    archive_class.retired = True
+    return archive_class.users == 0
+
+
+def _close_archive_classes(archive_classes):
+    for archive_class in archive_classes:
+        try:
+            archive_class.close()
+        except Exception as e:
+            module_logger.debug(f"Error closing archive backend: {e}")
+
+
+def find_expired_partitions(list_children, archive_path, archive_days):
+    """
+    Finds the date partitions (YYYY/M/D) under a system's archive path that are entirely older than archive_days.
+
+    Only the year and month folders that can hold expired days are listed, a whole year or month is returned as a
+    single partition when all of it has expired, and days newer than the cutoff are never visited.
+
+    :param list_children: Callable returning the child names of a path.
+    :return: List of partition paths to remove.
+    """
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=archive_days)).date()
+    expired = []
+
+    def numeric_children(path):
+        try:
+            return sorted(int(name) for name in list_children(path) if str(name).isdigit())
+        except (FileNotFoundError, IOError):
+            return []
+
+    for year in numeric_children(archive_path):
+        year_path = f"{archive_path}/{year}"
+        if year < cutoff.year:
+            expired.append(year_path)
+        elif year == cutoff.year:
+            for month in numeric_children(year_path):
+                month_path = f"{year_path}/{month}"
+                if month < cutoff.month:
+                    expired.append(month_path)
+                elif month == cutoff.month:
+                    expired.extend(f"{month_path}/{day}" for day in numeric_children(month_path) if day < cutoff.day)
+
+    return expired
 
 
 class GoogleCloudStorage:
+    users = 0
+    retired = False
 
     def __init__(self, storage_config):
+        self.storage_client = None
+        self.bucket_name = storage_config.get('bucket_name', "")
+        self.bucket = None
+        self.cache_control = storage_config.get("cache_control", "")
+        self.ready = False
         try:
             self.storage_client = storage.Client.from_service_account_json(
                 storage_config['credentials_file'], project=storage_config['project_id'])
             self.bucket_name = storage_config['bucket_name']
             self.bucket = self.storage_client.get_bucket(self.bucket_name)
+            self.ready = True
         except KeyError as e:
             module_logger.error(f"Google Cloud Missing required configuration data: {e}")
         except GoogleCloudError as e:
             module_logger.error(f"Google Cloud Storage error: {e}")
 
-    def upload_file(self, source_file_path, destination_file_path, destination_generated_path, max_attempts=3):
+    def upload_file(self, source_file_path, destination_file_path, destination_generated_path, max_attempts=3,
+                    source_reader=None):
         try:
             if not os.path.exists(source_file_path) or not os.path.isfile(source_file_path):
-                logging.error(f'Source file {source_file_path} does not exist or is not a file.')
+                module_logger.error(f'Source file {source_file_path} does not exist or is not a file.')
                 return False
 
             mime_type, _ = mimetypes.guess_type(source_file_path)
@@ -58,11 +184,13 @@ class GoogleCloudStorage:
 
             if self.bucket:
                 blob = self.bucket.blob(destination_file_path)
+                if self.cache_control:
+                    blob.cache_control = self.cache_control
 
-                with open(source_file_path, 'rb') as file:
-                    blob.upload_from_file(file, content_type=mime_type)
-
-                blob.make_public()
+                # The public ACL and headers ride along with the upload instead of a separate make_public request.
+                # A reader over the call's shared buffer is streamed instead of opening the file again.
+                with nullcontext(source_reader) if source_reader is not None else open(source_file_path, 'rb') as file:
+                    blob.upload_from_file(file, content_type=mime_type, predefined_acl='publicRead')
 
                 return blob.public_url
             else:
@@ -73,29 +201,46 @@ class GoogleCloudStorage:
             return None
 
     def clean_files(self, archive_path, archive_days):
+        """Deletes the date partitions under archive_path that are older than archive_days, 100 blobs per batch."""
         delete_count = 0
         try:
-            now = datetime.now(timezone.utc)
-
-            blobs = self.bucket.list_blobs(prefix=archive_path)
-
-            for blob in blobs:
-                age_days = (now - blob.time_created).total_seconds() / 86400  # Convert seconds to days
-                if age_days > archive_days:
-                    blob.delete()
-                    delete_count += 1
-
-            module_logger.info(f"Deleted {delete_count} files from bucket {self.bucket}/{archive_path}")
+            for partition_prefix in find_expired_partitions(self._list_partitions, archive_path, archive_days):
+                blobs = list(self.bucket.list_blobs(prefix=partition_prefix + "/"))
+                for batch_start in range(0, len(blobs), 100):
+                    with self.storage_client.batch():
+                        for blob in blobs[batch_start:batch_start + 100]:
+                            blob.delete()
+                delete_count += len(blobs)
+
+            module_logger.info(f"Deleted {delete_count} files from bucket {self.bucket_name}/{archive_path}")
             return delete_count
 
         except GoogleCloudError as e:
             module_logger.error(f"Failed to clean Google Cloud Storage: {e}")
             return None
 
+    def close(self):
+        if self.storage_client:
+            self.storage_client.close()
+
+    def _list_partitions(self, prefix):
+        blobs = self.bucket.list_blobs(prefix=prefix.rstrip("/") + "/", delimiter="/")
+        # Prefixes are only filled in once the pages have been consumed.
+        for _ in blobs.pages:
+            pass
+        return [os.path.basename(child_prefix.rstrip("/")) for child_prefix in blobs.prefixes]
+
 
 class AWSS3Storage:
+    users = 0
+    retired = False
 
     def __init__(self, storage_config):
+        self.s3_client = None
+        self.bucket_name = storage_config.get('bucket_name', "")
+        self.cache_control = storage_config.get("cache_control", "")
+        self.endpoint_url = storage_config.get("endpoint_url", "").rstrip("/")
+        self.ready = False
         try:
 
             if not storage_config.get("access_key_id", "") or not storage_config.get("secret_access_key",
@@ -104,37 +249,54 @@ class AWSS3Storage:
                 module_logger.error(f"AWS S3 Missing required configuration data.")
                 return
 
-            self.s3 = boto3.resource(
-                's3',
+            # Low level clients are thread safe, unlike boto3 resources, so one client serves every worker.
+            session = boto3.session.Session(
                 aws_access_key_id=storage_config.get("access_key_id", ""),
-                aws_secret_access_key=storage_config.get("secret_access_key", "")
+                aws_secret_access_key=storage_config.get("secret_access_key", ""),
+                region_name=storage_config.get("region") or None
             )
-            self.bucket_name = storage_config.get('bucket_name', "")
-            self.bucket = self.s3.Bucket(self.bucket_name)
+            if self.endpoint_url:
+                # S3 compatible stores such as MinIO are addressed by path, the bucket is not a subdomain.
+                self.s3_client = session.client('s3', endpoint_url=self.endpoint_url,
+                                                config=BotoConfig(s3={'addressing_style': 'path'}))
+            else:
+                self.s3_client = session.client('s3')
+            self.ready = True
 
         except KeyError as e:
             module_logger.error(f"AWS S3 Missing required configuration data: {e}")
         except NoCredentialsError as e:
             module_logger.error(f"Credentials not available for AWS S3: {e}")
 
-    def upload_file(self, source_file_path, destination_file_path, destination_generated_path, max_attempts=3):\
+    def upload_file(self, source_file_path, destination_file_path, destination_generated_path, max_attempts=3,
+                    source_reader=None):
 
         if not os.path.exists(source_file_path) or not os.path.isfile(source_file_path):
-            logging.error(f'Source file {source_file_path} does not exist or is not a file.')
+            module_logger.error(f'Source file {source_file_path} does not exist or is not a file.')
             return None
 
-        try:
-            with open(source_file_path, 'rb') as file:
-                self.bucket.put_object(Key=destination_file_path, Body=file)
+        mime_type, _ = mimetypes.guess_type(source_file_path)
+        put_object_kwargs = {
+            "Bucket": self.bucket_name,
+            "Key": destination_file_path,
+            "ACL": "public-read",
+            "ContentType": mime_type or 'application/octet-stream'
+        }
+        if self.cache_control:
+            put_object_kwargs["CacheControl"] = self.cache_control
 
-            self.s3.ObjectAcl(self.bucket_name, destination_file_path).put(ACL='public-read')
+        try:
+            # ACL, content type and cache headers are all set by the single PutObject request.
+            with nullcontext(source_reader) if source_reader is not None else open(source_file_path, 'rb') as file:
+                self.s3_client.put_object(Body=file, **put_object_kwargs)
 
             # Encode the basename of the local_audio_path to ensure it's URL-safe
             encoded_file_name = quote(os.path.basename(destination_file_path))
 
             # First, join the base URL with the current_date
-            url_with_date = urljoin(f'https://{self.bucket_name}.s3.amazonaws.com/',
-                                    os.path.dirname(destination_file_path) + '/')
+            bucket_url = f'{self.endpoint_url}/{self.bucket_name}/' if self.endpoint_url else \
+                f'https://{self.bucket_name}.s3.amazonaws.com/'
+            url_with_date = urljoin(bucket_url, os.path.dirname(destination_file_path) + '/')
 
             # Then, join the result with the encoded file name
             return urljoin(url_with_date, encoded_file_name)
@@ -147,25 +309,28 @@ class AWSS3Storage:
             return None
 
     def clean_files(self, archive_path, archive_days):
+        """Deletes the date partitions under archive_path that are older than archive_days, 1000 keys per request."""
 
-        s3_client = self.s3.meta.client
+        s3_client = self.s3_client
         bucket_name = self.bucket_name  # Your S3 bucket name
 
         delete_count = 0
 
         try:
-            # List all objects within the bucket under the specific prefix
             paginator = s3_client.get_paginator('list_objects_v2')
-            page_iterator = paginator.paginate(Bucket=bucket_name, Prefix=archive_path)
 
-            current_time = datetime.now(timezone.utc)
-            for page in page_iterator:
-                if "Contents" in page:
-                    for obj in page['Contents']:
-                        last_modified = obj['LastModified']
-                        if current_time - last_modified > timedelta(days=archive_days):
-                            s3_client.delete_object(Bucket=bucket_name, Key=obj['Key'])
-                            delete_count += 1
+            for partition_prefix in find_expired_partitions(self._list_partitions, archive_path, archive_days):
+                keys = []
+                for page in paginator.paginate(Bucket=bucket_name, Prefix=partition_prefix + "/"):
+                    keys.extend({"Key": obj["Key"]} for obj in page.get("Contents", []))
+
+                for batch_start in range(0, len(keys), 1000):
+                    response = s3_client.delete_objects(Bucket=bucket_name,
+                                                        Delete={"Objects": keys[batch_start:batch_start + 1000],
+                                                                "Quiet": True})
+                    for error in response.get("Errors", []):
+                        module_logger.warning(f"Failed to delete S3 object {error.get('Key')}: {error.get('Message')}")
+                    delete_count += len(keys[batch_start:batch_start + 1000]) - len(response.get("Errors", []))
 
             module_logger.info(f"Deleted {delete_count} files from bucket {bucket_name}/{archive_path}")
 
@@ -178,8 +343,124 @@ class AWSS3Storage:
             module_logger.error(f"Unexpected Error Cleaning S3 Files: {e}")
             return None
 
+    def close(self):
+        if self.s3_client:
+            self.s3_client.close()
+
+    def _list_partitions(self, prefix):
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        children = []
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix.rstrip("/") + "/", Delimiter="/"):
+            children.extend(os.path.basename(common_prefix["Prefix"].rstrip("/"))
+                            for common_prefix in page.get("CommonPrefixes", []))
+        return children
+
+
+class SFTPConnectionPool:
+    """
+    Pool of open SSH/SFTP connections to one host.
+
+    Connections are health checked when they are checked out, closed once they sit idle past idle_timeout, and
+    replaced transparently when they have died. The pool also remembers which remote directories are known to exist
+    so uploads do not stat every path component again.
+    """
+
+    def __init__(self, connect, max_connections=4, idle_timeout=300):
+        self.connect = connect
+        self.idle_timeout = idle_timeout
+        self._known_directories = set()
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(1, max_connections))
+
+    @contextmanager
+    def connection(self):
+        """Yields a healthy (ssh_client, sftp) pair, discarding it instead of returning it to the pool on error."""
+        self._slots.acquire()
+        ssh_client, sftp = None, None
+        try:
+            ssh_client, sftp = self._checkout()
+            yield ssh_client, sftp
+        except Exception:
+            self._close(ssh_client, sftp)
+            ssh_client, sftp = None, None
+            raise
+        finally:
+            if ssh_client:
+                with self._lock:
+                    self._idle.append((ssh_client, sftp, time.monotonic()))
+            self._slots.release()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for ssh_client, sftp, _ in idle:
+            self._close(ssh_client, sftp)
+
+    def knows_directory(self, remote_path):
+        with self._lock:
+            return remote_path in self._known_directories
+
+    def remember_directory(self, remote_path):
+        with self._lock:
+            self._known_directories.add(remote_path)
+
+    def forget_directories(self, remote_path):
+        """Drops a remote directory and everything below it from the known directory cache."""
+        with self._lock:
+            self._known_directories = {directory for directory in self._known_directories
+                                       if directory != remote_path and not directory.startswith(remote_path + "/")}
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                # Most recently used first, it is the least likely to have been dropped by the server.
+                ssh_client, sftp, last_used = self._idle.pop()
+
+            if time.monotonic() - last_used > self.idle_timeout or not self._is_healthy(ssh_client):
+                module_logger.debug("Discarding idle or dead SFTP connection")
+                self._close(ssh_client, sftp)
+                continue
+
+            return ssh_client, sftp
+
+        return self.connect()
+
+    @staticmethod
+    def _is_healthy(ssh_client):
+        transport = ssh_client.get_transport()
+        if not transport or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+            return True
+        except (SSHException, OSError, EOFError):
+            return False
+
+    @staticmethod
+    def _close(ssh_client, sftp):
+        try:
+            if sftp:
+                sftp.close()
+            if ssh_client:
+                ssh_client.close()
+        except Exception as e:
+            module_logger.debug(f"Error closing SFTP connection: {e}")
+
+
+_sftp_pools = {}
+_sftp_pool_users = {}
+_sftp_pools_lock = threading.Lock()
+
 
 class SCPStorage:
+    users = 0
+    retired = False
+    # The scp settings a pooled connection depends on, base_url and the like do not need a pool of their own.
+    pool_settings = ("host", "port", "user", "password", "private_key_path", "max_connections", "idle_timeout")
+
     def __init__(self, storage_config):
         self.host = storage_config.get("host")
         self.port = storage_config.get("port", 22)
@@ -187,15 +468,49 @@ class SCPStorage:
         self.password = storage_config.get("password", "")
         self.private_key_path = storage_config.get('private_key_path', "")
         self.base_url = storage_config.get('base_url', "")
+        self.ready = True
+
+        # Pools are shared by every SCPStorage with the same connection settings so connections outlive a single
+        # call. A reload that changes the credentials or limits gets a pool of its own instead of the stale one, and
+        # the stale one is closed once the last SCPStorage using it is.
+        self.pool_key = json.dumps({key: storage_config.get(key) for key in self.pool_settings}, sort_keys=True)
+        with _sftp_pools_lock:
+            if self.pool_key not in _sftp_pools:
+                _sftp_pools[self.pool_key] = SFTPConnectionPool(self._connect,
+                                                                storage_config.get("max_connections", 4),
+                                                                storage_config.get("idle_timeout", 300))
+            _sftp_pool_users[self.pool_key] = _sftp_pool_users.get(self.pool_key, 0) + 1
+            self.pool = _sftp_pools[self.pool_key]
+
+    def close(self):
+        """Lets go of the shared pool, closing its connections if nothing else uses it."""
+        with _sftp_pools_lock:
+            if self.pool_key is None:
+                return
+            _sftp_pool_users[self.pool_key] -= 1
+            if _sftp_pool_users[self.pool_key] > 0:
+                pool = None
+            else:
+                del _sftp_pool_users[self.pool_key]
+                pool = _sftp_pools.pop(self.pool_key)
+            self.pool_key = None
+
+        if pool:
+            pool.close_all()
 
     def ensure_destination_directory_exists(self, sftp, destination_directory):
         """Ensure the remote directory structure exists."""
+        if self.pool.knows_directory(destination_directory):
+            return
+
         parts = destination_directory.split("/")
         current_path = ""
 
         for part in parts[1:]:
 
             current_path = f'{current_path}/{part}'.replace("\\", "/")
+            if self.pool.knows_directory(current_path):
+                continue
 
             try:
                 sftp.stat(current_path)
@@ -205,9 +520,13 @@ class SCPStorage:
             except Exception as e:
                 traceback.print_exc()
                 module_logger.error(f"SCP Unhandled Exception: {e}")
+                continue
 
-    def upload_file(self, source_file_path, destination_file_path, destination_generated_path, max_attempts=3):
-        """Uploads a file to the SCP storage."""
+            self.pool.remember_directory(current_path)
+
+    def upload_file(self, source_file_path, destination_file_path, destination_generated_path, max_attempts=3,
+                    source_reader=None):
+        """Uploads a file to the SCP storage, streaming from source_reader when one is given."""
 
         if not os.path.exists(source_file_path) or not os.path.isfile(source_file_path):
             module_logger.error(f'Source file {source_file_path} does not exist or is not a file.')
@@ -218,7 +537,11 @@ class SCPStorage:
                 with self._create_sftp_session() as (ssh_client, sftp):
                     self.ensure_destination_directory_exists(sftp, os.path.dirname(destination_file_path))
 
-                    sftp.put(source_file_path, destination_file_path)
+                    if source_reader is not None:
+                        source_reader.seek(0)
+                        sftp.putfo(source_reader, destination_file_path, file_size=len(source_reader))
+                    else:
+                        sftp.put(source_file_path, destination_file_path)
 
                     # Encode the basename of the local_audio_path to ensure it's URL-safe
                     encoded_file_name = quote(os.path.basename(destination_file_path))
@@ -232,6 +555,8 @@ class SCPStorage:
             except Exception as error:  # Preferably catch more specific exceptions
                 traceback.print_exc()
                 module_logger.warning(f'Attempt {attempt} failed: {error}')
+                # The directory may have been removed remotely, check it again on the next attempt.
+                self.pool.forget_directories(os.path.dirname(destination_file_path))
                 if attempt < max_attempts:
                     time.sleep(5)
 
@@ -239,47 +564,60 @@ class SCPStorage:
         return False
 
     def clean_files(self, archive_path, archive_days):
-        """Removes files older than a specified number of days within the remote archive path."""
+        """Removes the date partitions within the remote archive path that are older than archive_days."""
 
-        def clean_directory(sftp, path, archive_seconds):
-            """Recursive function to traverse and clean directories."""
+        def remove_tree(sftp, path):
+            """Recursive function to remove a partition and everything in it."""
             nonlocal count
             for entry in sftp.listdir_attr(path):
-                remote_path = os.path.join(path, entry.filename)
-                if S_ISDIR(entry.st_mode):  # If entry is a directory, recurse into it
-                    clean_directory(sftp, remote_path, archive_seconds)
-                    # Try to remove the directory if it's empty
-                    try:
-                        sftp.rmdir(remote_path)
-                    except IOError:
-                        pass  # Directory not empty
+                remote_path = f"{path}/{entry.filename}"
+                if S_ISDIR(entry.st_mode):
+                    remove_tree(sftp, remote_path)
                 else:
-                    if time.time() - entry.st_mtime >= archive_seconds:
-                        sftp.remove(remote_path)
-                        count += 1
-                        module_logger.debug(f"Successfully cleaned remote folder: {remote_path}")
+                    sftp.remove(remote_path)
+                    count += 1
+            sftp.rmdir(path)
+            self.pool.forget_directories(path)
+            module_logger.debug(f"Successfully cleaned remote folder: {path}")
 
         try:
             with self._create_sftp_session() as (ssh_client, sftp):
                 count = 0
-                clean_directory(sftp, archive_path, archive_days * 24 * 3600)
+                expired_partitions = find_expired_partitions(sftp.listdir, archive_path, archive_days)
+                for partition_path in expired_partitions:
+                    remove_tree(sftp, partition_path)
+
+                # Month and year folders left empty by the removed days.
+                for parent_path in sorted({os.path.dirname(path) for path in expired_partitions} - {archive_path},
+                                          reverse=True):
+                    for empty_path in (parent_path, os.path.dirname(parent_path)):
+                        if empty_path == archive_path:
+                            break
+                        try:
+                            sftp.rmdir(empty_path)
+                            self.pool.forget_directories(empty_path)
+                        except IOError:
+                            break  # Directory not empty
+
                 module_logger.info(f"Cleaned {count} files remotely.")
         except Exception as e:
             module_logger.error(f"Error during remote cleanup: {e}")
             raise  # Consider re-raising the exception if the caller can handle it
 
-    @contextmanager
     def _create_sftp_session(self):
-        """Creates and manages an SFTP session using context management.
+        """Checks out a pooled SFTP session using context management.
 
-        :return: Yields a tuple of SSH client and SFTP session.
+        :return: Context manager yielding a tuple of SSH client and SFTP session.
         :raises: FileNotFoundError if private key file doesn't exist.
                   SSHException for other SSH connection errors.
         """
+        return self.pool.connection()
+
+    def _connect(self):
+        """Opens a new SSH connection and SFTP session to the configured host."""
         ssh_client = SSHClient()
         ssh_client.load_system_host_keys()
         ssh_client.set_missing_host_key_policy(AutoAddPolicy())
-        sftp = None
 
         try:
 
@@ -309,29 +647,39 @@ class SCPStorage:
             ssh_client.connect(self.host, **ssh_connect_kwargs)
 
             sftp = ssh_client.open_sftp()
-            yield ssh_client, sftp
+            module_logger.debug(f"Opened SFTP connection to {self.host}:{self.port}")
+            return ssh_client, sftp
         except SSHException as e:
             module_logger.error(f'SSH connection error: {e}')
+            ssh_client.close()
             raise
-        finally:
-            if sftp:
-                sftp.close()
+        except Exception:
             ssh_client.close()
+            raise
 
 
 class LocalStorage:
+    users = 0
+    retired = False
+
     def __init__(self, storage_config):
         self.base_url = storage_config.get("base_url", "")
+        self.ready = True
 
     def ensure_destination_directory_exists(self, destination_directory):
         """Ensure the local directory structure exists."""
         if not os.path.exists(destination_directory):
             os.makedirs(destination_directory)
 
-    def upload_file(self, source_file_path, destination_file_path, destination_generated_path, max_attempts=None):
-        """Copies a file to the local storage with a date-based directory structure."""
+    def upload_file(self, source_file_path, destination_file_path, destination_generated_path, max_attempts=None,
+                    source_reader=None):
+        """
+        Copies a file to the local storage with a date-based directory structure.
+
+        source_reader is not used, copying by path lets the kernel copy the data without it passing through Python.
+        """
         if not os.path.exists(source_file_path) or not os.path.isfile(source_file_path):
-            logging.error(f'Source file {source_file_path} does not exist or is not a file.')
+            module_logger.error(f'Source file {source_file_path} does not exist or is not a file.')
             return False
 
         try:
@@ -349,24 +697,27 @@ class LocalStorage:
             return urljoin(url_with_date, encoded_file_name)
 
         except Exception as error:  # Preferably catch more specific exceptions
-            logging.warning(f'Local Archive Failed: {error}')
+            module_logger.warning(f'Local Archive Failed: {error}')
             return False
 
     def clean_files(self, archive_path, archive_days):
-        """Removes files older than a specified number of days within the local archive path."""
-        archive_seconds = archive_days * 24 * 3600
-        current_time = time.time()
-
-        for root, dirs, files in os.walk(archive_path, topdown=False):
-            for name in files:
-                file_path = os.path.join(root, name)
-                if current_time - os.path.getmtime(file_path) >= archive_seconds:
-                    os.remove(file_path)
-                    logging.debug(f"Successfully cleaned local file: {file_path}")
-
-            for name in dirs:
-                dir_path = os.path.join(root, name)
+        """Removes the date partitions within the local archive path that are older than archive_days."""
+        expired_partitions = find_expired_partitions(os.listdir, archive_path, archive_days)
+
+        for partition_path in expired_partitions:
+            shutil.rmtree(partition_path, ignore_errors=True)
+            module_logger.debug(f"Successfully cleaned local folder: {partition_path}")
+
+        # Month and year folders left empty by the removed days.
+        for parent_path in sorted({os.path.dirname(path) for path in expired_partitions} - {archive_path},
+                                  reverse=True):
+            for empty_path in (parent_path, os.path.dirname(parent_path)):
+                if empty_path == archive_path:
+                    break
                 try:
-                    os.rmdir(dir_path)  # Try to remove the directory if it's empty
+                    os.rmdir(empty_path)
                 except OSError:
-                    pass  # Directory not empty or other error
+                    break  # Directory not empty or other error
+
+    def close(self):
+        pass
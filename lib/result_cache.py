@@ -0,0 +1,122 @@
+import copy
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+module_logger = logging.getLogger('icad_tr_uploader.result_cache')
+
+_result_caches = {}
+_result_caches_lock = threading.Lock()
+
+
+def get_result_cache(global_config_data):
+    """Returns the shared ResultCache for the configured limits, or None if the cache is disabled."""
+    cache_config = global_config_data.get("result_cache", {})
+    if cache_config.get("enabled", 0) != 1:
+        return None
+
+    cache_key = json.dumps(cache_config, sort_keys=True)
+    with _result_caches_lock:
+        if cache_key not in _result_caches:
+            _result_caches[cache_key] = ResultCache(cache_config)
+        return _result_caches[cache_key]
+
+
+def cached_result(result_cache, call_audio, kind, producer_config, produce):
+    """Runs produce through result_cache when there is one, otherwise just runs it."""
+    if result_cache is None:
+        return produce()
+    return result_cache.get_or_produce(call_audio, kind, producer_config, produce)
+
+
+class ResultCache:
+    """
+    Transcript and tone results keyed by the fingerprint of the call's decoded audio.
+
+    Simulcast and patched talkgroups record the same transmission more than once, each copy after the first gets the
+    result of the first without being transcribed or detected again. A copy that arrives while the first is still
+    being worked on waits for that result instead of starting its own. Entries expire ttl_seconds after they were
+    stored and the least recently used entry is dropped once the cache holds max_entries. The cache lives in the
+    uploader process, so in daemon mode every worker shares it.
+    """
+
+    # Settings that decide whether a call is handled at all, not what the result is, so they are not part of the key.
+    ignored_config_keys = ("enabled", "allowed_talkgroups")
+
+    def __init__(self, cache_config):
+        self.max_entries = max(1, cache_config.get("max_entries", 1024))
+        self.ttl = cache_config.get("ttl_seconds", 600)
+        self.silence_threshold_dbfs = cache_config.get("silence_threshold_dbfs", -50)
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "shared": 0, "evictions": 0}
+
+    def get_or_produce(self, call_audio, kind, producer_config, produce):
+        """
+        Returns the cached result for the call's audio, or runs produce and caches what it returns.
+
+        :param kind: Kind of result, e.g. tones or transcript.
+        :param producer_config: Config of whatever produces the result, calls only share results made the same way.
+        :param produce: Callable returning the result, None results are not cached.
+        """
+        decoded_audio = call_audio.decode()
+        if decoded_audio is None:
+            return produce()
+
+        key = (kind, decoded_audio.fingerprint(self.silence_threshold_dbfs), json.dumps(
+            {name: value for name, value in (producer_config or {}).items() if name not in self.ignored_config_keys},
+            sort_keys=True))
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                module_logger.debug(f"<<Result>> <<Cache>> hit for {kind}")
+                return copy.deepcopy(entry[1])
+            elif entry:
+                del self._entries[key]
+
+            future = self._in_flight.get(key)
+            producing = future is None
+            if producing:
+                future = self._in_flight[key] = Future()
+                self._stats["misses"] += 1
+            else:
+                self._stats["shared"] += 1
+
+        if not producing:
+            module_logger.debug(f"<<Result>> <<Cache>> waiting on a copy of this call for {kind}")
+            result = future.result()
+            # The copy being worked on failed, this call gets its own attempt.
+            return copy.deepcopy(result) if result is not None else produce()
+
+        result = None
+        try:
+            result = produce()
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+                if result is not None:
+                    self._store(key, copy.deepcopy(result))
+            future.set_result(result)
+
+        return result
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        return stats
+
+    def _store(self, key, result):
+        # Called holding the lock.
+        self._entries[key] = (time.monotonic() + self.ttl, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
@@ -0,0 +1,370 @@
+import json
+import logging
+import os
+import random
+import shutil
+import threading
+import time
+import uuid
+
+from lib.broadcastify_calls_handler import upload_to_broadcastify_calls
+from lib.call_audio import CallAudio
+from lib.circuit_breaker import get_circuit_breaker, call_with_breaker
+from lib.icad_player_handler import upload_to_icad_player, update_icad_player
+from lib.icad_tone_detect_legacy_handler import upload_to_icad_legacy
+from lib.metrics_handler import count
+from lib.openmhz_handler import upload_to_openmhz
+from lib.rdio_handler import upload_to_rdio
+
+module_logger = logging.getLogger('icad_tr_uploader.retry_spool')
+
+_retry_spools = {}
+_retry_spools_lock = threading.Lock()
+
+
+def get_retry_spool(global_config_data):
+    """Returns the shared RetrySpool for the configured spool path, or None if the spool is disabled."""
+    spool_config = global_config_data.get("retry_spool", {})
+    if spool_config.get("enabled", 0) != 1:
+        return None
+
+    spool_key = json.dumps(spool_config, sort_keys=True)
+    with _retry_spools_lock:
+        if spool_key not in _retry_spools:
+            _retry_spools[spool_key] = RetrySpool(spool_config)
+        return _retry_spools[spool_key]
+
+
+def find_destination_config(system_config, destination, destination_id):
+    """Looks up the current, enabled config for a spooled destination so retries use up to date keys and URLs."""
+    if destination == "rdio_systems":
+        candidates = [(rdio, rdio.get("rdio_url")) for rdio in system_config.get("rdio_systems", [])]
+    elif destination == "icad_tone_detect_legacy":
+        candidates = [(icad, icad.get("icad_url")) for icad in system_config.get("icad_tone_detect_legacy", [])]
+    elif destination == "icad_player_update":
+        candidates = [(system_config.get("icad_player", {}), destination_id)]
+    else:
+        candidates = [(system_config.get(destination, {}), destination_id)]
+
+    for destination_config, candidate_id in candidates:
+        if candidate_id == destination_id and destination_config.get("enabled", 0) == 1:
+            return destination_config
+
+    return None
+
+
+def resend_to_destination(destination, destination_config, audio_files, call_data):
+    with CallAudio(audio_files) as call_audio:
+        if destination == "rdio_systems":
+            return upload_to_rdio(destination_config, call_audio, call_data)
+        elif destination == "openmhz":
+            return upload_to_openmhz(destination_config, call_audio, call_data)
+        elif destination == "broadcastify_calls":
+            return upload_to_broadcastify_calls(destination_config, call_audio, call_data)
+        elif destination == "icad_player":
+            return upload_to_icad_player(destination_config, call_data)
+        elif destination == "icad_player_update":
+            return update_icad_player(destination_config, call_data)
+        elif destination == "icad_tone_detect_legacy":
+            return upload_to_icad_legacy(destination_config, call_audio, call_data)
+
+    module_logger.error(f"<<Retry>> <<Spool>> unknown destination {destination}")
+    return False
+
+
+class RetrySpool:
+    """
+    Durable spool of failed deliveries.
+
+    Each failed delivery is a directory holding entry.json and the audio files the destination needs, so the call
+    survives the temp files being cleaned. Entries are retried with exponential backoff and jitter, and dropped once
+    they run out of attempts, get too old, or the spool grows past its size cap.
+
+    Checking the limits walks the whole spool, so adding an entry only does it once the running size total crosses
+    the cap, or once limits_check_interval has passed since any process last did it.
+    """
+
+    entry_file_name = "entry.json"
+    claimed_suffix = ".retrying"
+    limits_stamp_name = ".limits_checked"
+    limits_check_interval = 60
+
+    def __init__(self, spool_config):
+        self.spool_path = os.path.abspath(spool_config.get("spool_path", "spool"))
+        self.max_attempts = spool_config.get("max_attempts", 10)
+        self.base_delay = spool_config.get("base_delay", 30)
+        self.max_delay = spool_config.get("max_delay", 3600)
+        self.max_age_seconds = spool_config.get("max_age_hours", 24) * 3600
+        self.max_size_bytes = spool_config.get("max_size_mb", 512) * 1024 * 1024
+        self._lock = threading.Lock()
+        # Bytes in the spool as of the last limits check plus what this process added since, None before a check.
+        self._size_bytes = None
+
+        os.makedirs(self.spool_path, exist_ok=True)
+
+    def add(self, destination, system_short_name, destination_id, call_data, audio_files=None):
+        """
+        Spools a failed delivery.
+
+        :param destination: Config section of the destination, e.g. openmhz or rdio_systems.
+        :param destination_id: Identifies the destination inside its section, the URL for list sections.
+        :param audio_files: Dict of extension to the temp file path the destination uploads.
+        :return: True if the delivery was spooled.
+        """
+        entry_id = f"{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}"
+        entry_path = os.path.join(self.spool_path, destination, entry_id)
+        entry_files = {}
+        entry_size = 0
+
+        try:
+            os.makedirs(entry_path)
+
+            for extension, source_path in (audio_files or {}).items():
+                file_name = os.path.basename(source_path)
+                self._link_or_copy(source_path, os.path.join(entry_path, file_name))
+                entry_files[extension] = file_name
+                entry_size += os.path.getsize(os.path.join(entry_path, file_name))
+
+            entry = {
+                "destination": destination,
+                "destination_id": destination_id,
+                "system_short_name": system_short_name,
+                "created": time.time(),
+                "attempts": 0,
+                "next_attempt": time.time() + self._backoff(0),
+                "files": entry_files,
+                "size": entry_size,
+                "call_data": call_data
+            }
+            self._write_entry(entry_path, entry)
+        except (OSError, TypeError, ValueError) as e:
+            module_logger.error(f"<<Failed>> to <<spool>> {destination} delivery: {e}")
+            shutil.rmtree(entry_path, ignore_errors=True)
+            return False
+
+        module_logger.warning(f"<<Spooled>> failed {destination} delivery {destination_id} for retry")
+        with self._lock:
+            if self._size_bytes is not None:
+                self._size_bytes += entry_size
+            over_cap = self._size_bytes is not None and self._size_bytes > self.max_size_bytes
+        if over_cap or self._limits_check_due():
+            self.enforce_limits()
+        return True
+
+    def retry_due(self, global_config_data, limit=None):
+        """
+        Retries spooled deliveries whose backoff has expired.
+
+        :param limit: Maximum number of deliveries to attempt, None for all that are due.
+        :return: Tuple of (delivered count, failed count).
+        """
+        delivered = 0
+        failed = 0
+
+        for entry_path in self._entry_paths():
+            if limit is not None and delivered + failed >= limit:
+                break
+
+            entry = self._read_entry(entry_path)
+            if not entry or entry.get("next_attempt", 0) > time.time():
+                continue
+
+            # Left spooled without using up an attempt while the destination's circuit is open.
+            breaker = get_circuit_breaker(entry["destination"], entry["destination_id"])
+            if breaker and breaker.is_open():
+                continue
+
+            claimed_path = self._claim(entry_path)
+            if not claimed_path:
+                continue
+
+            if self._retry_entry(claimed_path, entry, global_config_data):
+                shutil.rmtree(claimed_path, ignore_errors=True)
+                self._forget_size(entry)
+                count("icad_tr_uploader_retries_total", destination=entry["destination"], outcome="delivered")
+                delivered += 1
+                continue
+
+            failed += 1
+            entry["attempts"] += 1
+            count("icad_tr_uploader_retries_total", destination=entry["destination"],
+                  outcome="dropped" if entry["attempts"] >= self.max_attempts else "failed")
+            if entry["attempts"] >= self.max_attempts:
+                module_logger.error(
+                    f"<<Dropping>> spooled {entry['destination']} delivery {entry['destination_id']} after {entry['attempts']} attempts")
+                shutil.rmtree(claimed_path, ignore_errors=True)
+                self._forget_size(entry)
+                continue
+
+            entry["next_attempt"] = time.time() + self._backoff(entry["attempts"])
+            try:
+                self._write_entry(claimed_path, entry)
+                os.rename(claimed_path, entry_path)
+            except OSError as e:
+                module_logger.error(
+                    f"<<Failed>> to return spooled {entry['destination']} delivery {entry['destination_id']} to the spool: {e}")
+
+        if delivered or failed:
+            module_logger.info(f"<<Retry>> <<Spool>> delivered {delivered}, failed {failed}")
+
+        return delivered, failed
+
+    def enforce_limits(self):
+        """Drops entries older than the age limit, then the oldest entries until the spool fits its size cap."""
+        with self._lock:
+            now = time.time()
+            entries = []
+            total_size = 0
+
+            for entry_path in self._entry_paths(include_claimed=True):
+                if entry_path.endswith(self.claimed_suffix):
+                    # Being retried right now, it still takes up space but must not be removed underneath the retry.
+                    total_size += self._directory_size(entry_path)
+                    continue
+
+                entry = self._read_entry(entry_path)
+                try:
+                    created = entry.get("created", 0) if entry else os.path.getmtime(entry_path)
+                except OSError:
+                    continue
+
+                if now - created > self.max_age_seconds:
+                    module_logger.warning(f"<<Evicting>> expired spool entry {entry_path}")
+                    shutil.rmtree(entry_path, ignore_errors=True)
+                    continue
+
+                # Entries record their size when they are spooled, older ones are measured.
+                entry_size = entry.get("size") if entry and "size" in entry else self._directory_size(entry_path)
+                entries.append((created, entry_path, entry_size))
+                total_size += entry_size
+
+            for created, entry_path, entry_size in sorted(entries):
+                if total_size <= self.max_size_bytes:
+                    break
+                module_logger.warning(f"<<Evicting>> spool entry {entry_path}, spool is over its size cap")
+                shutil.rmtree(entry_path, ignore_errors=True)
+                total_size -= entry_size
+
+            self._size_bytes = total_size
+            try:
+                with open(os.path.join(self.spool_path, self.limits_stamp_name), "w") as stamp_file:
+                    stamp_file.write(str(now))
+            except OSError as e:
+                module_logger.warning(f"<<Retry>> <<Spool>> could not write its limits stamp: {e}")
+
+    def _limits_check_due(self):
+        try:
+            stamp_path = os.path.join(self.spool_path, self.limits_stamp_name)
+            return time.time() - os.path.getmtime(stamp_path) >= self.limits_check_interval
+        except OSError:
+            return True
+
+    def _forget_size(self, entry):
+        with self._lock:
+            if self._size_bytes is not None:
+                self._size_bytes = max(0, self._size_bytes - entry.get("size", 0))
+
+    def _retry_entry(self, entry_path, entry, global_config_data):
+        system_config = global_config_data.get("systems", {}).get(entry.get("system_short_name"), {})
+        destination_config = find_destination_config(system_config, entry["destination"], entry["destination_id"])
+        if not destination_config:
+            module_logger.warning(
+                f"<<Retry>> <<Spool>> {entry['destination']} {entry['destination_id']} is no longer configured, retrying later")
+            return False
+
+        audio_files = {extension: os.path.join(entry_path, file_name) for extension, file_name in
+                       entry.get("files", {}).items()}
+
+        try:
+            return call_with_breaker(get_circuit_breaker(entry["destination"], entry["destination_id"]),
+                                     resend_to_destination, entry["destination"], destination_config, audio_files,
+                                     entry["call_data"])
+        except Exception as e:
+            module_logger.error(f"<<Retry>> to {entry['destination']} <<failed>>: {e}")
+            return False
+
+    def _entry_paths(self, include_claimed=False):
+        entry_paths = []
+        if not os.path.isdir(self.spool_path):
+            return entry_paths
+
+        for destination in os.listdir(self.spool_path):
+            destination_path = os.path.join(self.spool_path, destination)
+            if not os.path.isdir(destination_path):
+                continue
+            for entry_id in os.listdir(destination_path):
+                if entry_id.endswith(self.claimed_suffix):
+                    claimed_path = os.path.join(destination_path, entry_id)
+                    if include_claimed:
+                        entry_paths.append(claimed_path)
+                    else:
+                        self._release_stale_claim(claimed_path)
+                    continue
+                entry_paths.append(os.path.join(destination_path, entry_id))
+
+        # Entry ids start with their creation time, so this retries and evicts oldest first.
+        return sorted(entry_paths, key=os.path.basename)
+
+    def _claim(self, entry_path):
+        """Renames the entry so concurrent uploader processes never retry the same delivery twice."""
+        claimed_path = entry_path + self.claimed_suffix
+        try:
+            os.rename(entry_path, claimed_path)
+        except OSError:
+            return None
+
+        # A rename leaves the directory's mtime alone, the claim time is what _release_stale_claim goes by.
+        try:
+            os.utime(claimed_path)
+        except OSError:
+            # Without a fresh mtime the claim could look stale to another process, so it is given up.
+            try:
+                os.rename(claimed_path, entry_path)
+            except OSError:
+                pass
+            return None
+        return claimed_path
+
+    def _release_stale_claim(self, claimed_path):
+        # A claim that outlived any reasonable retry means its process died mid retry. _claim set the mtime to the
+        # claim time.
+        try:
+            if time.time() - os.path.getmtime(claimed_path) > self.max_delay:
+                os.rename(claimed_path, claimed_path[:-len(self.claimed_suffix)])
+        except OSError:
+            pass
+
+    def _backoff(self, attempts):
+        delay = min(self.max_delay, self.base_delay * (2 ** attempts))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _read_entry(self, entry_path):
+        try:
+            with open(os.path.join(entry_path, self.entry_file_name), 'r') as entry_file:
+                return json.load(entry_file)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def _write_entry(self, entry_path, entry):
+        entry_file_path = os.path.join(entry_path, self.entry_file_name)
+        with open(entry_file_path + ".tmp", 'w') as entry_file:
+            json.dump(entry, entry_file)
+        os.replace(entry_file_path + ".tmp", entry_file_path)
+
+    @staticmethod
+    def _link_or_copy(source_path, destination_path):
+        try:
+            os.link(source_path, destination_path)
+        except OSError:
+            shutil.copy(source_path, destination_path)
+
+    @staticmethod
+    def _directory_size(path):
+        size = 0
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return size
@@ -0,0 +1,149 @@
+import bisect
+import logging
+import threading
+
+module_logger = logging.getLogger('icad_tr_uploader.routing')
+
+# Sections that have an allowed_talkgroups list.
+filtered_sections = ("tone_detection", "transcribe", "icad_player")
+# Sections that run for every talkgroup once enabled, list sections once any of their entries is enabled.
+unfiltered_sections = ("audio_compression", "audio_analysis", "archive", "openmhz", "broadcastify_calls")
+list_sections = ("rdio_systems", "icad_tone_detect_legacy")
+
+_system_routes = {}
+_system_routes_lock = threading.Lock()
+
+
+def get_system_routes(system_short_name, system_config):
+    """
+    Returns the compiled SystemRoutes for a system, compiling it the first time the system is seen. A system whose
+    config was replaced is compiled again.
+    """
+    with _system_routes_lock:
+        system_routes = _system_routes.get(system_short_name)
+        if system_routes is None or system_routes.system_config is not system_config:
+            system_routes = _system_routes[system_short_name] = SystemRoutes(system_config)
+            module_logger.debug(f"Compiled talkgroup routes for {system_short_name}")
+        return system_routes
+
+
+def compile_routing_tables(global_config_data):
+    """Compiles the routes of every configured system up front."""
+    for system_short_name, system_config in global_config_data.get("systems", {}).items():
+        get_system_routes(system_short_name, system_config)
+
+
+class TalkgroupFilter:
+    """
+    Compiled allowed_talkgroups list. Entries are talkgroup numbers, "*" for every talkgroup, ranges such as
+    "100-199" and prefixes such as "45*" for every talkgroup whose decimal starts with 45.
+    """
+
+    __slots__ = ("match_all", "talkgroups", "range_starts", "range_ends", "prefixes")
+
+    def __init__(self, allowed_talkgroups):
+        talkgroups = set()
+        ranges = []
+        prefixes = []
+        match_all = False
+
+        for entry in allowed_talkgroups or []:
+            text = str(entry).strip()
+            if text == "*":
+                match_all = True
+            elif text.isdigit():
+                talkgroups.add(int(text))
+            elif text.endswith("*") and text[:-1].isdigit():
+                prefixes.append(text[:-1])
+            elif text.count("-") == 1 and all(part.strip().isdigit() for part in text.split("-")):
+                start, end = sorted(int(part) for part in text.split("-"))
+                ranges.append((start, end))
+            else:
+                module_logger.warning(f"Ignoring talkgroup entry {entry!r}, it is not a number, range or prefix")
+
+        # Overlapping ranges are merged so a talkgroup can be found with one binary search.
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+
+        self.match_all = match_all
+        self.talkgroups = frozenset(talkgroups)
+        self.range_starts = tuple(start for start, end in merged)
+        self.range_ends = tuple(end for start, end in merged)
+        self.prefixes = tuple(prefixes)
+
+    def __contains__(self, talkgroup):
+        if self.match_all or talkgroup in self.talkgroups:
+            return True
+
+        index = bisect.bisect_right(self.range_starts, talkgroup) - 1
+        if index >= 0 and talkgroup <= self.range_ends[index]:
+            return True
+
+        return bool(self.prefixes) and str(talkgroup).startswith(self.prefixes)
+
+
+class SystemRoutes:
+    """
+    A system's config compiled into what runs for each talkgroup.
+
+    The stages and destinations a talkgroup is routed to, and its talkgroup_config entry, are worked out the first
+    time the talkgroup is seen and looked up from then on.
+    """
+
+    def __init__(self, system_config):
+        self.system_config = system_config
+
+        enabled = {section for section in filtered_sections + unfiltered_sections if
+                   system_config.get(section, {}).get("enabled", 0) == 1}
+        if system_config.get("archive", {}).get("archive_days", 0) < 1:
+            enabled.discard("archive")
+        enabled.update(section for section in list_sections if
+                       any(entry.get("enabled", 0) == 1 for entry in system_config.get(section, [])))
+        self.enabled_sections = frozenset(enabled)
+
+        self.filters = {section: TalkgroupFilter(system_config.get(section, {}).get("allowed_talkgroups", [])) for
+                        section in filtered_sections if section in self.enabled_sections}
+
+        talkgroup_config = system_config.get("talkgroup_config", {})
+        self._talkgroup_configs = {}
+        self._talkgroup_config_patterns = []
+        for key, config in talkgroup_config.items():
+            if str(key).strip().isdigit():
+                self._talkgroup_configs[int(key)] = config
+            elif key != "*":
+                self._talkgroup_config_patterns.append((TalkgroupFilter([key]), config))
+        self._default_talkgroup_config = talkgroup_config.get("*", {})
+
+        self._routes = {}
+
+    def is_enabled(self, section):
+        """True if a section is enabled for the system, whatever the talkgroup."""
+        return section in self.enabled_sections
+
+    def route(self, talkgroup):
+        """Returns the frozenset of enabled sections a talkgroup's calls go through."""
+        sections = self._routes.get(talkgroup)
+        if sections is None:
+            sections = self._routes[talkgroup] = frozenset(
+                section for section in self.enabled_sections if
+                section not in self.filters or talkgroup in self.filters[section])
+        return sections
+
+    def talkgroup_config(self, talkgroup):
+        """Returns the talkgroup's talkgroup_config entry, the first matching range or prefix, then the "*" entry."""
+        if not talkgroup or talkgroup <= 0:
+            return {}
+
+        config = self._talkgroup_configs.get(talkgroup)
+        if config:
+            return config
+
+        for talkgroup_filter, config in self._talkgroup_config_patterns:
+            if talkgroup in talkgroup_filter:
+                return config
+
+        return self._default_talkgroup_config
@@ -0,0 +1,57 @@
+import contextvars
+import inspect
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+module_logger = logging.getLogger('icad_tr_uploader.task_graph')
+
+
+def run_task_graph(tasks, max_workers=8, upload_engine=None):
+    """
+    Runs a set of tasks concurrently, starting each one as soon as the tasks it depends on have finished.
+
+    A dependency only orders the tasks, it does not gate them. A task whose dependency failed still runs and is
+    expected to check for whatever it needed itself.
+
+    :param tasks: Dict of task name to a tuple of (callable, list of dependency task names). A coroutine function
+        runs on upload_engine instead of a worker thread.
+    :param max_workers: Maximum number of tasks running at once in worker threads.
+    :param upload_engine: AsyncUploadEngine for the coroutine function tasks.
+    :return: Dict of task name to the callable's return value, None if it raised.
+    """
+    results = {}
+    if not tasks:
+        return results
+
+    for name, (_, dependencies) in tasks.items():
+        unknown = [dependency for dependency in dependencies if dependency not in tasks]
+        if unknown:
+            raise ValueError(f"Task {name} depends on unknown tasks {unknown}")
+
+    waiting = dict(tasks)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tasks)))) as executor:
+        while waiting or running:
+            for name, (task, dependencies) in list(waiting.items()):
+                if all(dependency in results for dependency in dependencies):
+                    # Each task runs in a copy of the caller's context, so its log lines keep the call's fields.
+                    if upload_engine and inspect.iscoroutinefunction(task):
+                        running[upload_engine.submit(task())] = name
+                    else:
+                        running[executor.submit(contextvars.copy_context().run, task)] = name
+                    del waiting[name]
+
+            if not running:
+                raise ValueError(f"Task graph has a dependency cycle between {list(waiting)}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    module_logger.error(f"<<Task>> {name} <<failed>>: {e}", exc_info=True)
+                    results[name] = None
+
+    return results
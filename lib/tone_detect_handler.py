@@ -1,29 +1,248 @@
-import io
 import logging
+import multiprocessing
+import random
+import threading
 import traceback
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.shared_memory import SharedMemory
 
+import numpy as np
 from icad_tone_detection import tone_detect
+from pydub import AudioSegment
+
+from lib.metrics_handler import count
 
 module_logger = logging.getLogger('icad_tr_uploader.tone_detect')
 
+_tone_detect_pool = None
+
 
-def get_tones(tone_detect_config, wav_file_path):
+def get_tones(tone_detect_config, call_audio):
     detected_tones = {
         "two_tone": [],
         "long_tone": [],
         "hi_low_tone": []
     }
     try:
+        # Hand tone_detect the call's already decoded samples so it does not decode the WAV again.
+        decoded_audio = call_audio.decode()
+        prefilter_config = tone_detect_config.get("prefilter", {})
+        may_have_tones, reason = True, ""
+        if decoded_audio and prefilter_config.get("enabled", 0) == 1:
+            may_have_tones, reason = screen_for_tones(tone_detect_config, decoded_audio)
+            # A sample of skipped calls still gets a full run, so false skips can be counted.
+            audit = not may_have_tones and random.random() < prefilter_config.get("audit_rate", 0)
+            count("icad_tr_uploader_tone_prefilter_total", outcome="skipped" if not may_have_tones else "passed")
+            if not may_have_tones and not audit:
+                module_logger.debug(f"<<Tone>> <<Detect>> skipped, {reason}")
+                return detected_tones
+
+        if decoded_audio and _tone_detect_pool:
+            detected_tones.update(_tone_detect_pool.detect(tone_detect_config, decoded_audio))
+        elif decoded_audio:
+            detected_tones.update(_detect_tones(tone_detect_config, _to_audio_segment(decoded_audio.samples,
+                                                                                     decoded_audio.sample_rate)))
+        else:
+            detected_tones.update(_detect_tones(tone_detect_config, call_audio.path(".wav")))
 
-        results = tone_detect(wav_file_path, tone_detect_config.get("matching_threshold", 2), tone_detect_config.get("time_resolution_ms", 50), tone_detect_config.get("tone_a_min_length", 0.8), tone_detect_config.get("tone_b_min_length", 2.8), tone_detect_config.get("hi_low_interval",0.2), tone_detect_config.get("hi_low_min_alternations", 3), tone_detect_config.get("long_tone_min_length", 1.5))
-        detected_tones.update({
-            "two_tone": results.two_tone_result,
-            "long_tone": results.long_result,
-            "hi_low_tone": results.hi_low_result
-        })
+        if not may_have_tones:
+            count("icad_tr_uploader_tone_prefilter_audits_total",
+                  outcome="false_skip" if any(detected_tones.values()) else "correct_skip")
+        if not may_have_tones and any(detected_tones.values()):
+            module_logger.warning(f"<<Tone>> <<Detect>> prefilter would have skipped a call with tones, {reason}")
 
     except Exception as e:
         traceback.print_exc()
         module_logger.error(f"<<Tone>> <<Detect>> - Error {e}")
 
     return detected_tones
+
+
+def screen_for_tones(tone_detect_config, decoded_audio):
+    """
+    Cheap check for whether a call can hold tones tone_detect would report.
+
+    The call is cut into frames and frames quieter than energy_floor_dbfs are dropped. A remaining frame is tonal when
+    a narrow peak inside the tone band holds at least tonality of its energy, voice spreads its energy over many
+    harmonics where a paging tone puts nearly all of it in one place. The call passes when tonal frames run for at
+    least min_tone_length seconds. Gaps up to hi_low_interval are bridged so warble and the A to B change count as
+    one run.
+
+    :return: Tuple of (may have tones, reason it does not).
+    """
+    prefilter_config = tone_detect_config.get("prefilter", {})
+    min_tone_length = prefilter_config.get("min_tone_length") or 0.8 * min(
+        tone_detect_config.get("tone_a_min_length", 0.8), tone_detect_config.get("long_tone_min_length", 1.5))
+
+    if decoded_audio.duration < min_tone_length:
+        return False, f"call is {decoded_audio.duration:.2f}s, shorter than {min_tone_length:.2f}s"
+
+    sample_rate = decoded_audio.sample_rate
+    frame_seconds = tone_detect_config.get("time_resolution_ms", 50) / 1000
+    frame_length = max(64, int(sample_rate * frame_seconds))
+    frame_count = len(decoded_audio.samples) // frame_length
+    frames = decoded_audio.normalized()[:frame_count * frame_length].reshape(frame_count, frame_length)
+
+    # Coarse energy envelope, silence and hiss never hold a tone.
+    loud = np.mean(np.square(frames), axis=1) > 10 ** (prefilter_config.get("energy_floor_dbfs", -45) / 10)
+    if not np.any(loud):
+        return False, "no frame above the energy floor"
+
+    spectrum = np.square(np.abs(np.fft.rfft(frames[loud] * np.hanning(frame_length), axis=1)))
+    frequencies = np.fft.rfftfreq(frame_length, 1 / sample_rate)
+    band = (frequencies >= prefilter_config.get("band_low", 250)) & (frequencies <= prefilter_config.get("band_high", 3000))
+
+    # A windowed pure tone spreads over its peak bin and the two next to it.
+    band_spectrum = np.pad(spectrum[:, band], ((0, 0), (1, 1)))
+    peak_bins = np.argmax(band_spectrum, axis=1)
+    rows = np.arange(len(peak_bins))
+    peak_energy = band_spectrum[rows, peak_bins - 1] + band_spectrum[rows, peak_bins] + band_spectrum[rows, peak_bins + 1]
+
+    tonal = np.zeros(frame_count, dtype=bool)
+    tonal[loud] = peak_energy / np.maximum(np.sum(spectrum, axis=1), 1e-12) >= prefilter_config.get("tonality", 0.6)
+
+    tonal_frames = np.flatnonzero(tonal)
+    if not len(tonal_frames):
+        return False, "no narrowband peak in the tone band"
+
+    gap_frames = int(tone_detect_config.get("hi_low_interval", 0.2) / frame_seconds) + 1
+    run_breaks = np.flatnonzero(np.diff(tonal_frames) > gap_frames)
+    run_starts = tonal_frames[np.concatenate(([0], run_breaks + 1))]
+    run_ends = tonal_frames[np.concatenate((run_breaks, [len(tonal_frames) - 1]))]
+    longest_run = float(np.max(run_ends - run_starts + 1)) * frame_length / sample_rate
+
+    if longest_run < min_tone_length:
+        return False, f"longest tone is {longest_run:.2f}s, shorter than {min_tone_length:.2f}s"
+
+    return True, ""
+
+
+def start_tone_detect_pool(pool_config):
+    """Starts the shared tone detection process pool, get_tones uses it from then on. Returns the pool."""
+    global _tone_detect_pool
+    if _tone_detect_pool is None:
+        _tone_detect_pool = ToneDetectPool(max_workers=pool_config.get("max_workers", 2),
+                                           max_queue_size=pool_config.get("max_queue_size", 8),
+                                           timeout=pool_config.get("timeout", 30))
+    return _tone_detect_pool
+
+
+def stop_tone_detect_pool():
+    global _tone_detect_pool
+    if _tone_detect_pool is not None:
+        _tone_detect_pool.shutdown()
+        _tone_detect_pool = None
+
+
+class ToneDetectPool:
+    """
+    Runs tone detection in worker processes so the FFT work never holds the uploader's GIL.
+
+    Workers are spawned once, import the detection library and run a warm up detection before taking jobs. Samples
+    are passed through shared memory rather than pickled. At most max_queue_size jobs are in flight, a caller that
+    can not get a slot waits up to timeout seconds and then detects in its own process so the call still gets its
+    tones.
+    """
+
+    def __init__(self, max_workers=2, max_queue_size=8, timeout=30):
+        self.max_workers = max(1, max_workers)
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max(1, max_queue_size))
+        self._executor_lock = threading.Lock()
+        self._executor = self._create_executor()
+
+    def detect(self, tone_detect_config, decoded_audio):
+        """
+        Detects tones in decoded_audio on a worker process.
+
+        :return: Dict of two_tone, long_tone and hi_low_tone results, empty results if the job timed out.
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            module_logger.warning("<<Tone>> <<Detect>> pool queue is full, detecting in process")
+            return _detect_tones(tone_detect_config, _to_audio_segment(decoded_audio.samples,
+                                                                       decoded_audio.sample_rate))
+
+        shared_memory = None
+        try:
+            shared_memory = SharedMemory(create=True, size=max(1, decoded_audio.samples.nbytes))
+            np.ndarray(decoded_audio.samples.shape, dtype=np.int16, buffer=shared_memory.buf)[:] = decoded_audio.samples
+
+            executor, future = self._submit(_detect_in_worker, tone_detect_config, shared_memory.name,
+                                  len(decoded_audio.samples), decoded_audio.sample_rate)
+        except Exception:
+            self._release(shared_memory)
+            raise
+
+        # The slot and the shared memory are only released once the worker is done with them, even after a timeout.
+        future.add_done_callback(lambda _: self._release(shared_memory))
+
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            module_logger.error(f"<<Tone>> <<Detect>> timed out after {self.timeout}s")
+            return {}
+        except BrokenProcessPool as e:
+            module_logger.error(f"<<Tone>> <<Detect>> worker died, restarting the pool: {e}")
+            self._restart(executor)
+            return {}
+
+    def shutdown(self):
+        with self._executor_lock:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _submit(self, function, *args):
+        with self._executor_lock:
+            return self._executor, self._executor.submit(function, *args)
+
+    def _restart(self, broken_executor):
+        with self._executor_lock:
+            # Every job on a broken pool fails at once, only the first one to notice replaces it.
+            if self._executor is not broken_executor:
+                return
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = self._create_executor()
+
+    def _create_executor(self):
+        # Spawned rather than forked, forking a process that is running threads can deadlock the children.
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_warm_worker)
+
+    def _release(self, shared_memory):
+        if shared_memory is not None:
+            shared_memory.close()
+            shared_memory.unlink()
+        self._slots.release()
+
+
+def _detect_tones(tone_detect_config, audio_input):
+    results = tone_detect(audio_input, tone_detect_config.get("matching_threshold", 2), tone_detect_config.get("time_resolution_ms", 50), tone_detect_config.get("tone_a_min_length", 0.8), tone_detect_config.get("tone_b_min_length", 2.8), tone_detect_config.get("hi_low_interval",0.2), tone_detect_config.get("hi_low_min_alternations", 3), tone_detect_config.get("long_tone_min_length", 1.5))
+    return {
+        "two_tone": results.two_tone_result,
+        "long_tone": results.long_result,
+        "hi_low_tone": results.hi_low_result
+    }
+
+
+def _to_audio_segment(samples, sample_rate):
+    return AudioSegment(data=samples.tobytes(), sample_width=2, frame_rate=sample_rate, channels=1)
+
+
+def _warm_worker():
+    # One detection on a short silence loads the lazily imported SciPy and NumPy code before the first real call.
+    try:
+        _detect_tones({}, _to_audio_segment(np.zeros(8000, dtype=np.int16), 8000))
+    except Exception as e:
+        module_logger.warning(f"<<Tone>> <<Detect>> worker warm up failed: {e}")
+
+
+def _detect_in_worker(tone_detect_config, shared_memory_name, sample_count, sample_rate):
+    # Spawned workers share the parent's resource tracker, so attaching here does not register the segment twice.
+    shared_memory = SharedMemory(name=shared_memory_name)
+    try:
+        samples = np.ndarray((sample_count,), dtype=np.int16, buffer=shared_memory.buf)
+        audio_input = _to_audio_segment(samples, sample_rate)
+        del samples
+        return _detect_tones(tone_detect_config, audio_input)
+    finally:
+        shared_memory.close()
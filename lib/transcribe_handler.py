@@ -1,13 +1,47 @@
 import io
 import json
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 
 import requests
 import logging
 
+from lib.circuit_breaker import get_circuit_breaker, call_with_breaker, call_with_breaker_async
+from lib.http_session_handler import get_session, get_timeout
+from lib.metrics_handler import count, observe
+from lib.upload_engine import aiohttp, build_form_data, get_client_session, get_client_timeout, get_upload_engine
+
 module_logger = logging.getLogger('icad_tr_uploader.transcribe')
 
+_transcribe_batchers = {}
+_transcribe_batchers_lock = threading.Lock()
+
+
+def transcribe_audio(transcribe_config, call_audio, call_data, talkgroup_config=None):
+    """
+    Transcribes a call, through the batcher for its API when batching is enabled and otherwise as a single call,
+    which runs on the async upload engine when it is running. Either way it goes through the circuit breaker for
+    the API, an open breaker skips transcription.
+
+    :return: The transcript from the API, None if transcription failed.
+    """
+    breaker = get_circuit_breaker("transcribe", transcribe_config.get("api_url", ""))
+    if transcribe_config.get("batch", {}).get("enabled", 0) == 1 and transcribe_config.get("batch", {}).get(
+            "batch_api_url"):
+        return call_with_breaker(breaker, get_transcribe_batcher(transcribe_config).transcribe, call_audio, call_data,
+                                 talkgroup_config)
+
+    upload_engine = get_upload_engine()
+    if upload_engine:
+        return upload_engine.run(call_with_breaker_async(breaker, upload_to_transcribe_async, transcribe_config,
+                                                         call_audio, call_data, talkgroup_config=talkgroup_config))
+
+    return call_with_breaker(breaker, upload_to_transcribe, transcribe_config, call_audio, call_data,
+                             talkgroup_config=talkgroup_config)
 
-def upload_to_transcribe(transcribe_config, wav_file_path, call_data, talkgroup_config=None):
+
+def upload_to_transcribe(transcribe_config, call_audio, call_data, talkgroup_config=None):
     url = transcribe_config['api_url']
     module_logger.info(f'Starting upload to <<iCAD>> <<Transcribe>>: {url}')
 
@@ -20,13 +54,14 @@ def upload_to_transcribe(transcribe_config, wav_file_path, call_data, talkgroup_
         json_string = json.dumps(call_data)
         json_bytes = json_string.encode('utf-8')
 
-        with open(wav_file_path, 'rb') as audio_file:
-             data = {
-                 'audioFile': audio_file,
-                 'jsonFile': json_bytes
-             }
+        data = {
+            'audioFile': (call_audio.name(".wav"), call_audio.reader(".wav")),
+            'jsonFile': json_bytes
+        }
 
-        response = requests.post(url, files=data, data=config_data)
+        # Transcription takes much longer than an upload, so it gets its own default read timeout.
+        response = get_session(url).post(url, files=data, data=config_data,
+                                         timeout=get_timeout(transcribe_config, read_timeout=300))
         response.raise_for_status()
         response_json = response.json()
         module_logger.info(f'<<iCAD>> <<Transcribe>> successfully transcribed audio: {url}')
@@ -39,3 +74,195 @@ def upload_to_transcribe(transcribe_config, wav_file_path, call_data, talkgroup_
     except Exception as err:
         module_logger.error(f"<<Unexpected>> <<error>> occurred while uploading to <<iCAD>> <<Transcribe>> API: {err}")
         return None
+
+
+async def upload_to_transcribe_async(transcribe_config, call_audio, call_data, talkgroup_config=None):
+    """upload_to_transcribe for the async upload engine, the WAV is streamed from the call's shared buffer."""
+    url = transcribe_config['api_url']
+    module_logger.info(f'Starting upload to <<iCAD>> <<Transcribe>>: {url}')
+
+    config_data = {}
+    if talkgroup_config:
+        config_data['whisper_config_data'] = json.dumps(talkgroup_config.get("whisper", {}))
+
+    try:
+        files = {
+            'audioFile': (call_audio.name(".wav"), call_audio.reader(".wav"), None),
+            'jsonFile': ('jsonFile', json.dumps(call_data).encode('utf-8'), None)
+        }
+
+        # Transcription takes much longer than an upload, so it gets its own default read timeout.
+        async with get_client_session().post(url, data=build_form_data(config_data, files),
+                                             timeout=get_client_timeout(transcribe_config, read_timeout=300)) as response:
+            response.raise_for_status()
+            response_json = await response.json(content_type=None)
+        module_logger.info(f'<<iCAD>> <<Transcribe>> successfully transcribed audio: {url}')
+
+        return response_json
+
+    except aiohttp.ClientResponseError as err:
+        module_logger.error(f"<<HTTP>> <<error>> occurred while uploading to <<iCAD>> <<Transcribe>> API: {err}")
+        return None
+    except Exception as err:
+        module_logger.error(f"<<Unexpected>> <<error>> occurred while uploading to <<iCAD>> <<Transcribe>> API: {err}")
+        return None
+
+
+def get_transcribe_batcher(transcribe_config):
+    """Returns the shared TranscribeBatcher for a transcribe config, calls only share a batch with the same API."""
+    batcher_key = json.dumps(transcribe_config, sort_keys=True)
+    with _transcribe_batchers_lock:
+        if batcher_key not in _transcribe_batchers:
+            _transcribe_batchers[batcher_key] = TranscribeBatcher(transcribe_config)
+        return _transcribe_batchers[batcher_key]
+
+
+def stop_transcribe_batchers():
+    """Sends every pending batch and stops the batchers."""
+    with _transcribe_batchers_lock:
+        batchers = list(_transcribe_batchers.values())
+        _transcribe_batchers.clear()
+
+    for batcher in batchers:
+        batcher.shutdown()
+
+
+class TranscribeBatcher:
+    """
+    Collects calls for one transcribe API and sends them together to its batch_api_url.
+
+    A batch is sent once it holds max_batch_size calls, once its first call has waited max_wait_ms, or once no new
+    call arrived for idle_ms. One batch is in flight at a time and calls arriving meanwhile form the next one. The
+    batch is a multipart POST with an audioFiles and a jsonFiles part per call, answered with a JSON list holding a
+    transcript per call in the same order. A batch of one, or a batch the API rejects, goes out over the single call
+    protocol instead, each call from its own caller's thread so the batcher can go on with the next batch.
+    """
+
+    # Answer to a queued call that has to be sent over the single call protocol.
+    send_single = object()
+
+    def __init__(self, transcribe_config):
+        batch_config = transcribe_config.get("batch", {})
+        self.transcribe_config = transcribe_config
+        self.batch_api_url = batch_config.get("batch_api_url")
+        self.max_batch_size = max(1, batch_config.get("max_batch_size", 8))
+        self.max_wait = batch_config.get("max_wait_ms", 500) / 1000
+        self.idle_wait = batch_config.get("idle_ms", 100) / 1000
+        self._condition = threading.Condition()
+        self._pending = []
+        self._last_arrival = 0.0
+        self._stopping = False
+        self._thread = threading.Thread(target=self._flush_loop, name="transcribe-batcher", daemon=True)
+        self._thread.start()
+
+    def transcribe(self, call_audio, call_data, talkgroup_config=None):
+        """Queues a call for the next batch and waits for its transcript, None if transcription failed."""
+        future = Future()
+        with self._condition:
+            if self._stopping:
+                return upload_to_transcribe(self.transcribe_config, call_audio, call_data, talkgroup_config)
+            self._pending.append((time.monotonic(), call_audio, call_data, talkgroup_config, future))
+            self._last_arrival = time.monotonic()
+            self._condition.notify_all()
+
+        # Room for the batch to fill, a batch sent ahead of it and this call's own batch.
+        timeout = self.max_wait + 2 * get_timeout(self.transcribe_config, read_timeout=300)[1]
+        try:
+            transcript = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            module_logger.error(f"<<iCAD>> <<Transcribe>> batch did not answer within {timeout:.0f}s")
+            return None
+
+        if transcript is self.send_single:
+            return upload_to_transcribe(self.transcribe_config, call_audio, call_data, talkgroup_config)
+        return transcript
+
+    def shutdown(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _flush_loop(self):
+        while True:
+            with self._condition:
+                batch = self._next_batch()
+                if batch is None:
+                    return
+            try:
+                self._send(batch)
+            except Exception as err:
+                # The thread is shared by every batched call, so a bad batch must not take it down.
+                module_logger.error(f"<<iCAD>> <<Transcribe>> batch <<failed>>, sending it as single calls: {err}",
+                                    exc_info=True)
+                for queued, call_audio, call_data, talkgroup_config, future in batch:
+                    if not future.done():
+                        count("icad_tr_uploader_transcribe_single_calls_total", api_url=self.batch_api_url,
+                              reason="fallback")
+                        future.set_result(self.send_single)
+
+    def _next_batch(self):
+        # Called holding the condition, waits until a batch is due and takes it off the queue.
+        while True:
+            if self._pending:
+                now = time.monotonic()
+                flush_at = min(self._pending[0][0] + self.max_wait, self._last_arrival + self.idle_wait)
+                if self._stopping or len(self._pending) >= self.max_batch_size or now >= flush_at:
+                    batch = self._pending[:self.max_batch_size]
+                    del self._pending[:self.max_batch_size]
+                    return batch
+                self._condition.wait(flush_at - now)
+            elif self._stopping:
+                return None
+            else:
+                self._condition.wait()
+
+    def _send(self, batch):
+        if len(batch) == 1:
+            count("icad_tr_uploader_transcribe_single_calls_total", api_url=self.batch_api_url, reason="alone")
+            batch[0][-1].set_result(self.send_single)
+            return
+
+        send_start = time.monotonic()
+        wait = send_start - batch[0][0]
+        transcripts = self._post_batch(batch)
+        if transcripts is None:
+            count("icad_tr_uploader_transcribe_single_calls_total", len(batch), api_url=self.batch_api_url,
+                  reason="fallback")
+            transcripts = [self.send_single] * len(batch)
+        else:
+            latency = time.monotonic() - send_start
+            observe("icad_tr_uploader_transcribe_batch_seconds", latency, api_url=self.batch_api_url)
+            observe("icad_tr_uploader_transcribe_batch_wait_seconds", wait, api_url=self.batch_api_url)
+            count("icad_tr_uploader_transcribe_batched_calls_total", len(batch), api_url=self.batch_api_url)
+            module_logger.debug(
+                f"<<iCAD>> <<Transcribe>> batch of {len(batch)} calls, waited {wait:.3f}s, sent in {latency:.2f}s")
+
+        for (queued, call_audio, call_data, talkgroup_config, future), transcript in zip(batch, transcripts):
+            future.set_result(transcript)
+
+    def _post_batch(self, batch):
+        url = self.batch_api_url
+        try:
+            files = []
+            whisper_config = []
+            for queued, call_audio, call_data, talkgroup_config, future in batch:
+                json_name = call_audio.name(".wav").rsplit(".", 1)[0] + ".json"
+                files.append(('audioFiles', (call_audio.name(".wav"), call_audio.reader(".wav"))))
+                files.append(('jsonFiles', (json_name, json.dumps(call_data).encode('utf-8'))))
+                whisper_config.append((talkgroup_config or {}).get("whisper", {}))
+
+            response = get_session(url).post(url, files=files,
+                                             data={'whisper_config_data': json.dumps(whisper_config)},
+                                             timeout=get_timeout(self.transcribe_config, read_timeout=300))
+            response.raise_for_status()
+            transcripts = response.json()
+            if not isinstance(transcripts, list) or len(transcripts) != len(batch):
+                raise ValueError(f"expected a list of {len(batch)} transcripts")
+        except Exception as err:
+            module_logger.warning(
+                f"<<iCAD>> <<Transcribe>> batch of {len(batch)} calls <<failed>>, sending them as single calls: {err}")
+            return None
+
+        module_logger.info(f'<<iCAD>> <<Transcribe>> successfully transcribed a batch of {len(batch)} calls: {url}')
+        return transcripts
@@ -0,0 +1,166 @@
+import asyncio
+import contextvars
+import logging
+import threading
+
+from lib.http_session_handler import get_timeout, record_response_status
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+module_logger = logging.getLogger('icad_tr_uploader.upload_engine')
+
+_upload_engine = None
+_upload_engine_settings = None
+_missing_aiohttp_logged = False
+_upload_engine_lock = threading.Lock()
+
+# Session of the engine a coroutine was submitted to, uploads on a replaced engine keep using their own loop's session.
+_client_session = contextvars.ContextVar("icad_tr_uploader_client_session", default=None)
+
+
+def configure_upload_engine(http_config):
+    """
+    Starts the shared upload engine when the http section turns on async_engine, replaces it when its connection
+    limits change and stops it when it is turned off. Uploads already running on a replaced engine are allowed to
+    finish.
+
+    :return: The running AsyncUploadEngine, or None if the async engine is off or aiohttp is not installed.
+    """
+    global _upload_engine, _upload_engine_settings, _missing_aiohttp_logged
+
+    settings = None
+    if http_config.get("async_engine", 0) == 1:
+        settings = (http_config.get("async_max_connections", 512), http_config.get("pool_maxsize", 10))
+
+    with _upload_engine_lock:
+        if settings == _upload_engine_settings:
+            return _upload_engine
+
+        if settings and aiohttp is None:
+            if not _missing_aiohttp_logged:
+                module_logger.warning("<<Async>> <<engine>> needs aiohttp, uploading with requests instead")
+                _missing_aiohttp_logged = True
+            return None
+
+        previous_engine = _upload_engine
+        _upload_engine = AsyncUploadEngine(*settings) if settings else None
+        _upload_engine_settings = settings
+
+    if previous_engine:
+        threading.Thread(target=previous_engine.shutdown, name="upload-engine-drain", daemon=True).start()
+    return _upload_engine
+
+
+def get_upload_engine():
+    return _upload_engine
+
+
+def stop_upload_engine():
+    global _upload_engine, _upload_engine_settings
+    with _upload_engine_lock:
+        upload_engine, _upload_engine, _upload_engine_settings = _upload_engine, None, None
+    if upload_engine:
+        upload_engine.shutdown()
+
+
+def get_client_session():
+    """The aiohttp session of the engine running the current upload, shared by every async destination handler."""
+    return _client_session.get()
+
+
+def get_client_timeout(destination_config=None, connect_timeout=None, read_timeout=None):
+    """aiohttp timeout from the same settings as get_timeout. The read timeout applies to each read, as in requests."""
+    connect, read = get_timeout(destination_config, connect_timeout, read_timeout)
+    return aiohttp.ClientTimeout(total=None, sock_connect=connect, sock_read=read)
+
+
+def build_form_data(fields=None, files=None):
+    """
+    Builds a multipart body the way requests builds one from data and files.
+
+    :param fields: Dict of form fields. Iterable values other than strings become one field per item, as requests
+        sends them, and None values are left out.
+    :param files: Dict of field name to (file name, file object or bytes, content type). File objects are streamed
+        in chunks rather than read into memory.
+    """
+    form_data = aiohttp.FormData()
+    for name, value in (fields or {}).items():
+        for item in ([value] if isinstance(value, (str, bytes)) or not hasattr(value, "__iter__") else value):
+            if item is not None:
+                form_data.add_field(name, item if isinstance(item, bytes) else str(item))
+
+    for name, (file_name, file_object, content_type) in (files or {}).items():
+        form_data.add_field(name, file_object, filename=file_name, content_type=content_type)
+
+    return form_data
+
+
+class AsyncUploadEngine:
+    """
+    Runs the async destination handlers on one asyncio event loop in a background thread.
+
+    Every upload shares one aiohttp session, so waiting on a slow destination costs a coroutine instead of a thread.
+    Open connections are capped at max_connections overall and max_connections_per_host for each host, uploads past
+    the cap wait for a free connection.
+    """
+
+    def __init__(self, max_connections=512, max_connections_per_host=10):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="upload-engine", daemon=True)
+        self._thread.start()
+        self.session = None
+        self.session = self.run(self._create_session(max_connections, max_connections_per_host))
+        module_logger.info(f"<<Async>> <<engine>> started, {max_connections} connections, "
+                           f"{max_connections_per_host} per host")
+
+    def submit(self, coroutine):
+        """
+        Schedules a coroutine on the engine's loop from any thread.
+
+        The coroutine runs with the caller's context variables, so its log lines keep the call's fields.
+
+        :return: concurrent.futures.Future of the coroutine's result.
+        """
+        return asyncio.run_coroutine_threadsafe(_run_in_context(contextvars.copy_context(), self.session, coroutine),
+                                                self._loop)
+
+    def run(self, coroutine, timeout=None):
+        """Runs a coroutine on the engine's loop and waits for its result."""
+        return self.submit(coroutine).result(timeout)
+
+    def shutdown(self, timeout=60):
+        """Waits up to timeout seconds for running uploads, then closes the session and stops the loop."""
+        try:
+            self.run(self._drain(timeout))
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+
+    @staticmethod
+    async def _create_session(max_connections, max_connections_per_host):
+        connector = aiohttp.TCPConnector(limit=max_connections, limit_per_host=max_connections_per_host)
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_end.append(_record_response_status)
+        return aiohttp.ClientSession(connector=connector, trace_configs=[trace_config])
+
+    async def _drain(self, timeout):
+        running = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        if running:
+            await asyncio.wait(running, timeout=timeout)
+        await self.session.close()
+
+
+async def _record_response_status(session, trace_config_context, params):
+    record_response_status(params.response)
+
+
+async def _run_in_context(context, client_session, coroutine):
+    # The task runs in a copy of the loop thread's context, the caller's variables are set on that copy.
+    for variable, value in context.items():
+        variable.set(value)
+    _client_session.set(client_session)
+    return await coroutine
@@ -1,13 +1,12 @@
-import json
 import argparse
 import os
+import signal
+import threading
 import time
 import traceback
-from pathlib import Path
 
-from lib.audio_file_handler import save_temporary_files, load_call_json
-from lib.call_processor import process_tr_call
-from lib.config_handler import load_config_file
+from lib.config_handler import ConfigManager
+from lib.daemon_client import submit_call
 from lib.logging_handler import CustomLogger
 
 app_name = "icad_tr_uploader"
@@ -28,9 +27,20 @@ config_path = os.path.join(root_path, 'etc')
 logging_instance = CustomLogger(1, f'{app_name}',
                                 os.path.join(log_path, log_file_name))
 
-try:
-    config_data = load_config_file(os.path.join(config_path, config_file_name))
+
+
+def apply_logging_config(config_data):
     logging_instance.set_log_level(config_data["log_level"])
+    logging_instance.configure(config_data.get("logging", {}))
+
+
+config_manager = ConfigManager(os.path.join(config_path, config_file_name), on_reload=apply_logging_config)
+
+try:
+    if not config_manager.load():
+        raise ValueError(f"{config_manager.file_path} did not load, see the errors above")
+    config_data = config_manager.current
+    apply_logging_config(config_data)
     logger = logging_instance.logger
     logger.info("Loaded Config File")
 except Exception as e:
@@ -44,28 +54,74 @@ def parse_arguments():
     parser = argparse.ArgumentParser(description='Process Arguments.')
     parser.add_argument("-s", "--system_short_name", type=str, help="System Short Name.")
     parser.add_argument("-a", "--audio_wav_path", type=str, help="Path to WAV.")
+    parser.add_argument("-d", "--daemon", action="store_true", help="Run as a resident uploader daemon.")
     args = parser.parse_args()
 
     return args
 
 
+def run_daemon():
+    # Imported here so the per-call client never pays for loading the storage and detection libraries.
+    from lib.daemon_handler import UploaderDaemon
+
+    # The daemon is the one long running writer of the log files, so it is the one that rotates them.
+    logging_instance.configure(config_data.get("logging", {}), rotate=True)
+
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+
+    uploader_daemon = UploaderDaemon(config_manager)
+    signal.signal(signal.SIGHUP, lambda signum, frame: uploader_daemon.request_reload())
+    try:
+        uploader_daemon.start()
+    except (OSError, RuntimeError) as e:
+        logger.error(f"<<Failed>> to start <<daemon>>: {e}")
+        exit(1)
+
+    stop_event.wait()
+    uploader_daemon.shutdown()
+
+
+def run_single_call(args):
+    from lib.call_processor import process_call_job
+    from lib.metrics_handler import write_metrics_textfile
+
+    call_processed = process_call_job(config_data, args.system_short_name, args.audio_wav_path)
+
+    metrics_config = config_data.get("metrics", {})
+    if metrics_config.get("enabled", 0) == 1 and metrics_config.get("textfile_path"):
+        write_metrics_textfile(metrics_config.get("textfile_path"))
+
+    if not call_processed:
+        exit(1)
+
+
 def main():
     logger.debug("Running Main")
 
     args = parse_arguments()
 
-    # copy files to tmp
-    copy_result = save_temporary_files(config_data.get('temp_file_path', '/dev/shm'), args.audio_wav_path)
-    if not copy_result:
-        exit(1)
+    if args.daemon:
+        run_daemon()
+        return
 
-    # load call data
-    call_data = load_call_json(os.path.join(config_data.get('temp_file_path', '/dev/shm'), os.path.basename(args.audio_wav_path).replace(".wav", ".json")))
-    if not call_data:
+    if not args.system_short_name or not args.audio_wav_path:
+        logger.error("<<System>> <<Short>> <<Name>> and <<WAV>> <<Path>> are required.")
         exit(1)
 
-    # start call processing
-    process_tr_call(config_data, os.path.join(config_data.get('temp_file_path', '/dev/shm'), os.path.basename(args.audio_wav_path)), call_data, args.system_short_name)
+    daemon_config = config_data.get("daemon", {})
+    if daemon_config.get("enabled", 0) == 1:
+        if submit_call(daemon_config.get("socket_path", "/tmp/icad_tr_uploader.sock"), args.system_short_name,
+                       os.path.abspath(args.audio_wav_path), daemon_config.get("submit_timeout", 2)):
+            return
+
+        if daemon_config.get("fallback_local", 1) != 1:
+            exit(1)
+
+        logger.warning("<<Daemon>> unavailable, processing call locally.")
+
+    run_single_call(args)
 
 
 if __name__ == '__main__':